@@ -188,7 +188,13 @@ class Block(rlp.Serializable):
 BLANK_UNCLES_HASH = sha3(rlp.encode([]))
 
 
-class FakeHeader():
+# A compact header holding just what states keep their previous headers
+# for (BLOCKHASH, difficulty and gas limit calculation, uncle checks), with
+# the hash computed once rather than on every access
+class FakeHeader(object):
+
+    __slots__ = ('hash', 'number', 'timestamp', 'difficulty', 'gas_limit',
+                 'gas_used', 'uncles_hash')
 
     def __init__(self, hash=b'\x00' * 32, number=0, timestamp=0, difficulty=1,
                  gas_limit=3141592, gas_used=0, uncles_hash=BLANK_UNCLES_HASH):
@@ -200,6 +206,15 @@ class FakeHeader():
         self.gas_used = gas_used
         self.uncles_hash = uncles_hash
 
+    @classmethod
+    def from_header(cls, header):
+        if isinstance(header, FakeHeader):
+            return header
+        return cls(hash=header.hash, number=header.number,
+                   timestamp=header.timestamp, difficulty=header.difficulty,
+                   gas_limit=header.gas_limit, gas_used=header.gas_used,
+                   uncles_hash=header.uncles_hash)
+
     def to_block_header(self):
         return BlockHeader(
             difficulty=self.difficulty,
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+import rlp
+from ethereum import utils
+
+DEFAULT_CODE_CACHE_BYTES = 16 * 1024 * 1024
+
+
+# Everything about a piece of code that can be worked out before running it
+class CodeAnalysis(object):
+
+    def __init__(self, codelen, jumpdests, pushcache):
+        self.codelen = codelen
+        # bit i is set iff code[i] is a JUMPDEST outside of push data
+        self.jumpdests = jumpdests
+        # offset of a PUSHn -> the value it pushes
+        self.pushcache = pushcache
+        # fork flags -> fastvm basic blocks, filled in by fastvm on use
+        self.blocks = {}
+
+    def is_jumpdest(self, pc):
+        return pc < self.codelen and \
+            self.jumpdests[pc >> 3] & (1 << (pc & 7)) != 0
+
+
+def analyze(code):
+    """find the valid jump destinations and push constants of `code`"""
+    codelen = len(code)
+    jumpdests = bytearray((codelen + 7) // 8)
+    pushcache = {}
+    code = bytearray(code) + bytearray(32)
+    i = 0
+    while i < codelen:
+        codebyte = code[i]
+        if codebyte == 0x5b:
+            jumpdests[i >> 3] |= 1 << (i & 7)
+        if 0x60 <= codebyte <= 0x7f:
+            pushcache[i] = utils.bytes_to_int(code[i + 1: i + codebyte - 0x5e])
+            i += codebyte - 0x5e
+        else:
+            i += 1
+    return CodeAnalysis(codelen, jumpdests, pushcache)
+
+
+# Bounded LRU cache of code analyses, keyed by code hash
+class CodeCache(object):
+
+    def __init__(self, max_bytes=DEFAULT_CODE_CACHE_BYTES, db=None):
+        """
+        :param max_bytes: approximate budget, counted in bytes of code
+        :param db: if given, analyses are also stored in (and loaded from)
+                   this database, under b'analysis:' + code hash
+        """
+        self.max_bytes = max_bytes
+        self.db = db
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def get(self, code, code_hash=None):
+        """returns the CodeAnalysis of `code`
+
+        :param code_hash: sha3 of `code`, if the caller already knows it
+        """
+        if code_hash is None:
+            code_hash = utils.sha3(code)
+        analysis = self.cache.pop(code_hash, None)
+        if analysis is None:
+            self.misses += 1
+            analysis = self._load(code_hash)
+            if analysis is None:
+                analysis = analyze(code)
+                self._store(code_hash, analysis)
+            self.cache_bytes += len(code)
+        else:
+            self.hits += 1
+        self.cache[code_hash] = analysis
+        while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= evicted.codelen
+        return analysis
+
+    def _load(self, code_hash):
+        if self.db is None:
+            return None
+        try:
+            data = self.db.get(b'analysis:' + code_hash)
+        except KeyError:
+            return None
+        codelen, jumpdests, pushes = rlp.decode(data)
+        return CodeAnalysis(
+            utils.big_endian_to_int(codelen), bytearray(jumpdests),
+            {utils.big_endian_to_int(k): utils.big_endian_to_int(v)
+             for k, v in pushes})
+
+    def _store(self, code_hash, analysis):
+        if self.db is None:
+            return
+        self.db.put(b'analysis:' + code_hash, rlp.encode([
+            analysis.codelen, bytes(analysis.jumpdests),
+            [[k, v] for k, v in sorted(analysis.pushcache.items())]]))
+
+    def clear(self):
+        self.cache.clear()
+        self.cache_bytes = 0
+
+
+# Shared by vm and fastvm
+code_cache = CodeCache()
+
+
+def configure(max_bytes=None, db=None):
+    """resize the shared cache and/or make it persist analyses to `db`"""
+    if max_bytes is not None:
+        code_cache.max_bytes = max_bytes
+    code_cache.db = db
@@ -139,7 +139,7 @@ def add_transactions(state, block, txqueue, min_gasprice=0):
         return
     pre_txs = len(block.transactions)
     log.info('Adding transactions, %d in txqueue, %d dunkles' %
-             (len(txqueue.txs), pre_txs))
+             (len(txqueue), pre_txs))
     transactions, caspert_vote_transactions = [], []
     for ordered_tx in txqueue.txs:
         if ordered_tx.tx.to == state.config['CASPER_ADDRESS'] and ordered_tx.tx.data[0:4] == b'\xe9\xdc\x06\x14':
@@ -149,7 +149,8 @@ def add_transactions(state, block, txqueue, min_gasprice=0):
     txqueue.tx = transactions + caspert_vote_transactions
     while True:
         tx = txqueue.pop_transaction(max_gas=state.gas_limit - state.gas_used,
-                                     min_gasprice=min_gasprice)
+                                     min_gasprice=min_gasprice,
+                                     get_nonce=state.get_nonce)
         if tx is None:
             break
         try:
@@ -202,7 +203,7 @@ def verify_execution_results(state, block):
 
 # Make the root of a receipt tree
 def mk_receipt_sha(receipts):
-    t = trie.Trie(EphemDB())
+    t = trie.Trie(EphemDB(), write_back=True)
     for i, receipt in enumerate(receipts):
         t.update(rlp.encode(i), rlp.encode(receipt))
     return t.root_hash
@@ -222,6 +223,9 @@ def update_block_env_variables(state, block):
     state.timestamp = block.header.timestamp
     state.gas_limit = block.header.gas_limit
     state.block_number = block.header.number
-    state.recent_uncles[state.block_number] = [x.hash for x in block.uncles]
+    # replaced rather than edited in place, so that snapshots can share it
+    recent_uncles = dict(state.recent_uncles)
+    recent_uncles[state.block_number] = [x.hash for x in block.uncles]
+    state.recent_uncles = recent_uncles
     state.block_coinbase = block.header.coinbase
     state.block_difficulty = block.header.difficulty
@@ -94,6 +94,22 @@ default_config = dict(
         '60ff331436604014161560155760203560003555005b6000355460205260206020f3'),
     # Custom specials
     CUSTOM_SPECIALS={},
+    # Worker processes used to recover the senders of a block's
+    # transactions before executing it (0 or 1: recover serially)
+    SENDER_RECOVERY_WORKERS=0,
+    # Worker processes used to compute the storage roots of the accounts
+    # changed by a state commit (0 or 1: compute them serially)
+    STORAGE_COMMIT_WORKERS=0,
+    # Worker processes used to build the subtrees under the root of the
+    # account trie when it is built from scratch, by snapshot import and
+    # genesis loading (0 or 1: build it serially)
+    TRIE_BUILD_WORKERS=0,
+    # Worker processes used by Chain.verify_seals to check the proof of
+    # work of a batch of headers (0 or 1: check them serially)
+    SEAL_VERIFY_WORKERS=0,
+    # EVM interpreter: 'vm' (one opcode at a time) or 'fastvm' (charges
+    # static gas and checks the stack once per basic block)
+    VM_IMPLEMENTATION='vm',
 )
 assert default_config['NEPHEW_REWARD'] == \
     default_config['BLOCK_REWARD'] // 32
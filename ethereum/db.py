@@ -1,6 +1,9 @@
+import rlp
 from ethereum import utils
 from ethereum.slogging import get_logger
 from rlp.utils import str_to_bytes
+from collections import OrderedDict
+import sqlite3
 import sys
 if sys.version_info.major == 2:
     from repoze.lru import lru_cache
@@ -14,7 +17,15 @@ databases = {}
 
 
 class BaseDB(object):
-    pass
+
+    def get_node(self, key, offset=0):
+        """get the value under key, skip `offset` bytes and rlp decode it
+
+        Wrappers that store a header in front of the value (RefcountDB)
+        pass its length down so that caching layers below them can keep
+        the decoded form.
+        """
+        return rlp.decode(self.get(key)[offset:])
 
 
 class _EphemDB(BaseDB):
@@ -51,6 +62,22 @@ class _EphemDB(BaseDB):
 DB = EphemDB = _EphemDB
 
 
+# An in-memory database, optionally preloaded with `nodes`, that records
+# the puts made against it, so that work done in another process can be
+# replayed against the real database
+class RecordingDB(_EphemDB):
+
+    def __init__(self, nodes=None):
+        super(RecordingDB, self).__init__()
+        if nodes:
+            self.db.update(nodes)
+        self.puts = []
+
+    def put(self, key, value):
+        self.puts.append((key, value))
+        self.db[key] = value
+
+
 # Used for SPV proof creation
 class ListeningDB(BaseDB):
 
@@ -100,6 +127,11 @@ class OverlayDB(BaseDB):
             return self.overlay[key]
         return self.db.get(key)
 
+    def get_node(self, key, offset=0):
+        if key in self.overlay:
+            return rlp.decode(self.get(key)[offset:])
+        return self.db.get_node(key, offset)
+
     def put(self, key, value):
         self.overlay[key] = value
 
@@ -124,6 +156,195 @@ class OverlayDB(BaseDB):
         return utils.big_endian_to_int(str_to_bytes(self.__repr__()))
 
 
+# Persistent store; writes are staged and flushed as one batch per commit
+class SQLiteDB(BaseDB):
+
+    def __init__(self, path):
+        """key value store backed by a single sqlite table
+
+        :param path: database file, or ':memory:'
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv '
+            '(key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+        self.conn.commit()
+        self.kv = None
+        # key -> value, or None for a pending delete
+        self.uncommitted = {}
+
+    def _get_committed(self, key):
+        row = self.conn.execute('SELECT value FROM kv WHERE key = ?',
+                                (sqlite3.Binary(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return bytes(row[0])
+
+    def get(self, key):
+        key = utils.to_string(key)
+        if key in self.uncommitted:
+            if self.uncommitted[key] is None:
+                raise KeyError(key)
+            return self.uncommitted[key]
+        return self._get_committed(key)
+
+    def put(self, key, value):
+        self.uncommitted[utils.to_string(key)] = utils.to_string(value)
+
+    def delete(self, key):
+        key = utils.to_string(key)
+        if not self._has_key(key):
+            raise KeyError(key)
+        self.uncommitted[key] = None
+
+    def commit(self):
+        if not self.uncommitted:
+            return
+        puts, deletes = [], []
+        for key, value in self.uncommitted.items():
+            if value is None:
+                deletes.append((sqlite3.Binary(key),))
+            else:
+                puts.append((sqlite3.Binary(key), sqlite3.Binary(value)))
+        log.debug('committing', puts=len(puts), deletes=len(deletes))
+        # a single transaction: either the whole batch lands or none of it
+        with self.conn:
+            self.conn.executemany('DELETE FROM kv WHERE key = ?', deletes)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', puts)
+        self.uncommitted = {}
+
+    def revert(self):
+        self.uncommitted = {}
+
+    def close(self):
+        self.conn.close()
+
+    def _has_key(self, key):
+        key = utils.to_string(key)
+        if key in self.uncommitted:
+            return self.uncommitted[key] is not None
+        try:
+            self._get_committed(key)
+            return True
+        except KeyError:
+            return False
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.path == other.path
+
+    def __hash__(self):
+        return utils.big_endian_to_int(str_to_bytes(self.__repr__()))
+
+
+def _copy_node(node):
+    # the trie edits decoded nodes in place, so hand out private copies
+    return [_copy_node(x) if isinstance(x, list) else x for x in node]
+
+
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+
+
+# Read cache for decoded trie nodes, for use under RefcountDB
+class CachingDB(BaseDB):
+
+    def __init__(self, db, max_bytes=DEFAULT_CACHE_BYTES):
+        """bounded LRU cache in front of another database
+
+        Values are cached together with their rlp-decoded form, so that
+        repeated trie walks skip both the backend read and the decode.
+        All writes go straight through to the wrapped database.
+
+        :param db: the wrapped database
+        :param max_bytes: approximate budget (keys plus raw values)
+        """
+        self.db = db
+        self.kv = None
+        self.max_bytes = max_bytes
+        # key -> [raw value, decoded node or None, decode offset]
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def _lookup(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = [self.db.get(key), None, 0]
+            self.cache_bytes += len(key) + len(entry[0])
+        else:
+            self.hits += 1
+        # re-insert to mark as most recently used
+        self.cache[key] = entry
+        while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+            self._evict(next(iter(self.cache)))
+        return entry
+
+    def _evict(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.cache_bytes -= len(key) + len(entry[0])
+
+    def get(self, key):
+        return self._lookup(key)[0]
+
+    def get_node(self, key, offset=0):
+        entry = self._lookup(key)
+        if entry[1] is None or entry[2] != offset:
+            entry[1] = rlp.decode(entry[0][offset:])
+            entry[2] = offset
+        return _copy_node(entry[1])
+
+    def put(self, key, value):
+        self.db.put(key, value)
+        entry = self.cache.get(key)
+        if entry is None:
+            return
+        # refcount bumps only touch the header; keep the decoded node then
+        keep = entry[1] is not None and \
+            entry[0][entry[2]:] == value[entry[2]:]
+        self.cache_bytes += len(value) - len(entry[0])
+        entry[0] = value
+        if not keep:
+            entry[1] = None
+
+    def delete(self, key):
+        self._evict(key)
+        self.db.delete(key)
+
+    def commit(self):
+        self.db.commit()
+
+    def revert(self):
+        self.cache.clear()
+        self.cache_bytes = 0
+        self.db.revert()
+
+    def _has_key(self, key):
+        return key in self.cache or key in self.db
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.db == other.db
+
+    def __hash__(self):
+        return utils.big_endian_to_int(str_to_bytes(self.__repr__()))
+
+
 @lru_cache(128)
 def add1(b):
     v = utils.big_endian_to_int(b)
@@ -145,6 +366,9 @@ class RefcountDB(BaseDB):
     def get(self, key):
         return self.db.get(key)[4:]
 
+    def get_node(self, key, offset=0):
+        return self.db.get_node(key, offset + 4)
+
     def get_refcount(self, key):
         try:
             return utils.big_endian_to_int(self.db.get(key)[:4])
@@ -154,7 +154,7 @@ return(1)
 # eg. x = call_casper(state, 'getValidationCode', [2, 5])
 def call_casper(state, fun, args=[], gas=1000000, value=0):
     ct = get_casper_ct()
-    abidata = vm.CallData([utils.safe_ord(x) for x in ct.encode(fun, args)])
+    abidata = vm.CallData(ct.encode(fun, args))
     msg = vm.Message(casper_config['METROPOLIS_ENTRY_POINT'], casper_config['CASPER_ADDR'],
                      value, gas, abidata)
     o = apply_const_message(state, msg)
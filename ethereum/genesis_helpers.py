@@ -1,4 +1,5 @@
-from ethereum.state import State
+from ethereum.state import State, BLANK_HASH
+from ethereum import securetrie
 from ethereum.block import Block, BlockHeader, BLANK_UNCLES_HASH
 from ethereum.utils import (
     decode_hex,
@@ -8,6 +9,8 @@ from ethereum.utils import (
     parse_as_int,
     normalize_address,
     to_string,
+    sha3,
+    encode_int32,
 )
 from ethereum.config import Env
 from ethereum.consensus_strategy import get_consensus_strategy
@@ -15,6 +18,10 @@ from ethereum.db import OverlayDB, RefcountDB
 import rlp
 import json
 
+# alloc entries without any of these (or with an empty storage) leave
+# their account alone
+GENESIS_ACCOUNT_FIELDS = ('wei', 'balance', 'code', 'nonce', 'storage')
+
 
 def block_from_genesis_declaration(genesis_data, env):
     h = BlockHeader(nonce=parse_as_bin(genesis_data["nonce"]),
@@ -40,24 +47,40 @@ def state_from_genesis_declaration(
     else:
         block = block_from_genesis_declaration(genesis_data, env)
 
-    state = State(env=env)
+    # the alloc goes straight into tries built bottom-up, with the same
+    # result as setting every account on a State and committing it
+    env.db.put(BLANK_HASH, b'')
+    rdb = RefcountDB(env.db)
+    workers = env.config.get('TRIE_BUILD_WORKERS', 0)
+    spurious_dragon = block.header.number >= \
+        env.config['SPURIOUS_DRAGON_FORK_BLKNUM']
+    accounts = {}
     for addr, data in genesis_data["alloc"].items():
         addr = normalize_address(addr)
         assert len(addr) == 20
-        if 'wei' in data:
-            state.set_balance(addr, parse_as_int(data['wei']))
-        if 'balance' in data:
-            state.set_balance(addr, parse_as_int(data['balance']))
-        if 'code' in data:
-            state.set_code(addr, parse_as_bin(data['code']))
-        if 'nonce' in data:
-            state.set_nonce(addr, parse_as_int(data['nonce']))
-        if 'storage' in data:
-            for k, v in data['storage'].items():
-                state.set_storage_data(
-                    addr, big_endian_to_int(
-                        parse_as_bin(k)), big_endian_to_int(
-                        parse_as_bin(v)))
+        if not any(data.get(k) not in (None, {})
+                   for k in GENESIS_ACCOUNT_FIELDS):
+            continue
+        nonce = parse_as_int(data['nonce']) if 'nonce' in data else \
+            env.config['ACCOUNT_INITIAL_NONCE']
+        balance = parse_as_int(data.get('balance', data.get('wei', 0)))
+        code = parse_as_bin(data.get('code', ''))
+        if not (nonce or balance or code or allow_empties or
+                not spurious_dragon):
+            continue
+        code_hash = sha3(code)
+        env.db.put(code_hash, code)
+        storage = {}
+        for k, v in data.get('storage', {}).items():
+            storage[big_endian_to_int(parse_as_bin(k))] = \
+                big_endian_to_int(parse_as_bin(v))
+        storage_root = securetrie.build_trie(rdb, sorted(
+            ((encode_int32(k), rlp.encode(v)) for k, v in storage.items()
+             if v), key=lambda kv: sha3(kv[0])))
+        accounts[addr] = rlp.encode([nonce, balance, storage_root, code_hash])
+    state = State(securetrie.build_trie(
+        rdb, sorted(accounts.items(), key=lambda kv: sha3(kv[0])), workers),
+        env)
     get_consensus_strategy(state.config).initialize(state, block)
     if executing_on_head:
         state.executing_on_head = True
@@ -18,7 +18,7 @@ from ethereum.exceptions import InvalidTransaction, VerificationFailed
 from ethereum.slogging import get_logger
 from ethereum.config import Env
 from ethereum.state import State, dict_to_prev_header
-from ethereum.block import Block, BlockHeader, BLANK_UNCLES_HASH
+from ethereum.block import Block, BlockHeader, BLANK_UNCLES_HASH, FakeHeader
 from ethereum.pow.consensus import initialize
 from ethereum.genesis_helpers import mk_basic_state, state_from_genesis_declaration, initialize_genesis_keys
 
@@ -328,7 +328,8 @@ class Chain(object):
         b = block
         header_depth = state.config['PREV_HEADER_DEPTH']
         for i in range(header_depth + 1):
-            state.prev_headers.append(b.header)
+            state.prev_headers.append(
+                FakeHeader.from_header(b.header) if i else b.header)
             if i < 6:
                 state.recent_uncles[state.block_number - i] = []
                 for u in b.uncles:
@@ -17,6 +17,7 @@ from ethereum import opcodes
 from ethereum.transactions import Transaction
 from ethereum.consensus_strategy import get_consensus_strategy
 from ethereum import vm
+from ethereum import fastvm
 from ethereum.specials import specials as default_specials
 from ethereum.config import Env, default_config
 from ethereum.db import BaseDB, EphemDB
@@ -170,29 +171,34 @@ def validate_transaction(state, tx):
     return True
 
 
-def apply_message(state, msg=None, **kwargs):
+def apply_message(state, msg=None, tracer=None, **kwargs):
     if msg is None:
         msg = vm.Message(**kwargs)
     else:
         assert not kwargs
-    ext = VMExt(state, transactions.Transaction(0, 0, 21000, b'', 0, b''))
+    ext = VMExt(state, transactions.Transaction(0, 0, 21000, b'', 0, b''),
+                tracer)
     result, gas_remained, data = apply_msg(ext, msg)
     return bytearray_to_bytestr(data) if result else None
 
 
-def apply_transaction(state, tx):
+def apply_transaction(state, tx, tracer=None):
+    """applies `tx` to `state`
+
+    :param tracer: an ethereum.tracer.Tracer to notify while executing
+    """
     casper_contract = tx.to == state.env.config['CASPER_ADDRESS']
     vote = tx.data[0:4] == b'\xe9\xdc\x06\x14'
     null_sender = tx.sender == b'\xff' * 20
     if casper_contract and vote and null_sender:
         log_tx.debug("Applying CASPER VOTE transaction: {}".format(tx))
-        return _apply_casper_vote_transaction(state, tx)
+        return _apply_casper_vote_transaction(state, tx, tracer)
     else:
         log_tx.debug("Applying transaction (non-CASPER VOTE): {}".format(tx))
-        return _apply_transaction(state, tx)
+        return _apply_transaction(state, tx, tracer)
 
 
-def _apply_casper_vote_transaction(state, tx):
+def _apply_casper_vote_transaction(state, tx, tracer=None):
     state.logs = []
 
     validate_transaction(state, tx)
@@ -208,7 +214,7 @@ def _apply_casper_vote_transaction(state, tx):
     assert state.get_balance(tx.sender) >= tx.startgas * tx.gasprice
     state.delta_balance(tx.sender, -tx.startgas * tx.gasprice)
 
-    message_data = vm.CallData([safe_ord(x) for x in tx.data], 0, len(tx.data))
+    message_data = vm.CallData(tx.data, 0, len(tx.data))
     message = vm.Message(
         tx.sender,
         tx.to,
@@ -219,7 +225,7 @@ def _apply_casper_vote_transaction(state, tx):
         code_address=tx.to)
 
     # MESSAGE
-    ext = VMExt(state, tx)
+    ext = VMExt(state, tx, tracer)
 
     result, gas_remained, data = apply_msg(ext, message)
 
@@ -262,7 +268,7 @@ def _apply_casper_vote_transaction(state, tx):
     return success, output
 
 
-def _apply_transaction(state, tx):
+def _apply_transaction(state, tx, tracer=None):
     state.logs = []
     state.suicides = []
     state.refunds = 0
@@ -287,7 +293,7 @@ def _apply_transaction(state, tx):
     assert state.get_balance(tx.sender) >= tx.startgas * tx.gasprice
     state.delta_balance(tx.sender, -tx.startgas * tx.gasprice)
 
-    message_data = vm.CallData([safe_ord(x) for x in tx.data], 0, len(tx.data))
+    message_data = vm.CallData(tx.data, 0, len(tx.data))
     message = vm.Message(
         tx.sender,
         tx.to,
@@ -298,7 +304,7 @@ def _apply_transaction(state, tx):
         code_address=tx.to)
 
     # MESSAGE
-    ext = VMExt(state, tx)
+    ext = VMExt(state, tx, tracer)
 
     if tx.to != b'':
         result, gas_remained, data = apply_msg(ext, message)
@@ -366,14 +372,24 @@ def _apply_transaction(state, tx):
     return success, output
 
 
+# Interpreters selectable with the VM_IMPLEMENTATION config key
+vm_implementations = {
+    'vm': vm,
+    'fastvm': fastvm,
+}
+
+
 # VM interface
 class VMExt():
 
-    def __init__(self, state, tx):
+    def __init__(self, state, tx, tracer=None):
         self.specials = {k: v for k, v in default_specials.items()}
         for k, v in state.config['CUSTOM_SPECIALS']:
             self.specials[k] = v
         self._state = state
+        self.tracer = tracer
+        self.vm_execute = vm_implementations[
+            state.config.get('VM_IMPLEMENTATION', 'vm')].vm_execute
         self.get_code = state.get_code
         self.set_code = state.set_code
         self.get_balance = state.get_balance
@@ -431,19 +447,26 @@ def _apply_msg(ext, msg, code):
             pre_storage=ext.log_storage(msg.to),
             static=msg.static, depth=msg.depth)
 
+    tracer = ext.tracer
+    if tracer is not None and tracer.on_call is not None:
+        tracer.on_call(msg)
+
     # Transfer value, instaquit if not enough
     snapshot = ext.snapshot()
     if msg.transfers_value:
         if not ext.transfer_value(msg.sender, msg.to, msg.value):
             log_msg.debug('MSG TRANSFER FAILED', have=ext.get_balance(msg.to),
                           want=msg.value)
+            if tracer is not None and tracer.on_return is not None and \
+                    not msg.is_create:
+                tracer.on_return(msg, 1, msg.gas, [])
             return 1, msg.gas, []
 
     # Main loop
     if msg.code_address in ext.specials:
         res, gas, dat = ext.specials[msg.code_address](ext, msg)
     else:
-        res, gas, dat = vm.vm_execute(ext, msg, code)
+        res, gas, dat = ext.vm_execute(ext, msg, code)
 
     if trace_msg:
         log_msg.debug('MSG APPLIED', gas_remained=gas,
@@ -455,6 +478,11 @@ def _apply_msg(ext, msg, code):
         log_msg.debug('REVERTING')
         ext.revert(snapshot)
 
+    # a creation is only over once its code is deposited
+    if tracer is not None and tracer.on_return is not None and \
+            not msg.is_create:
+        tracer.on_return(msg, res, gas, dat)
+
     return res, gas, dat
 
 
@@ -487,7 +515,7 @@ def create_contract(ext, msg):
 
     msg.is_create = True
     # assert not ext.get_code(msg.to)
-    msg.data = vm.CallData([], 0, 0)
+    msg.data = vm.CallData(b'', 0, 0)
     snapshot = ext.snapshot()
 
     ext.set_nonce(msg.to, 1 if ext.post_spurious_dragon_hardfork() else 0)
@@ -501,10 +529,7 @@ def create_contract(ext, msg):
             "data<%d>" %
             len(dat)))
 
-    if res:
-        if not len(dat):
-            # ext.set_code(msg.to, b'')
-            return 1, gas, msg.to
+    if res and len(dat):
         gcost = len(dat) * opcodes.GCONTRACTBYTE
         if gas >= gcost and (
                 len(dat) <= 24576 or not ext.post_spurious_dragon_hardfork()):
@@ -518,10 +543,18 @@ def create_contract(ext, msg):
                 block_number=ext.block_number)
             if ext.post_homestead_hardfork():
                 ext.revert(snapshot)
-                return 0, 0, b''
-        ext.set_code(msg.to, bytearray_to_bytestr(dat))
-        log_msg.debug('SETTING CODE', addr=encode_hex(msg.to), lendat=len(dat))
-        return 1, gas, msg.to
-    else:
+                res, gas, dat = 0, 0, b''
+        if res:
+            ext.set_code(msg.to, bytearray_to_bytestr(dat))
+            log_msg.debug('SETTING CODE', addr=encode_hex(msg.to),
+                          lendat=len(dat))
+    elif not res:
         ext.revert(snapshot)
-        return 0, gas, dat
+
+    tracer = ext.tracer
+    if tracer is not None and tracer.on_return is not None:
+        tracer.on_return(msg, res, gas, dat)
+
+    if res:
+        return 1, gas, msg.to
+    return 0, gas, dat
@@ -7,6 +7,7 @@ from ethereum.common import mk_block_from_prevstate, validate_header, \
     validate_casper_vote_transaction_ordering
 from ethereum.consensus_strategy import get_consensus_strategy
 from ethereum.messages import apply_transaction
+from ethereum.transactions import recover_senders
 from ethereum.state import State
 from ethereum.utils import sha3, encode_hex
 import rlp
@@ -27,6 +28,9 @@ def apply_block(state, block):
         assert validate_transaction_tree(state, block)
         # Makes sure all casper vote transactions come first
         assert validate_casper_vote_transaction_ordering(state, block)
+        # Recover all senders up front, possibly in parallel
+        recover_senders(block.transactions,
+                        state.config.get('SENDER_RECOVERY_WORKERS', 0))
         # Process transactions
         for tx in block.transactions:
             apply_transaction(state, tx)
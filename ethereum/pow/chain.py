@@ -17,7 +17,7 @@ from ethereum.slogging import get_logger, configure_logging
 from ethereum.config import Env
 from ethereum.state import State, dict_to_prev_header
 from ethereum.block import Block, BlockHeader, BLANK_UNCLES_HASH, FakeHeader
-from ethereum.pow.consensus import initialize
+from ethereum.pow.consensus import initialize, verify_seals
 from ethereum.genesis_helpers import mk_basic_state, state_from_genesis_declaration, \
     initialize_genesis_keys
 from ethereum.db import RefcountDB
@@ -39,6 +39,9 @@ class Chain(object):
             self.state = self.mk_poststate_of_blockhash(
                 self.db.get('head_hash'))
             self.state.executing_on_head = True
+            if not self.state.has_flat_index():
+                self.state.rebuild_flat_index()
+                self.db.commit()
             print('Initializing chain from saved head, #%d (%s)' %
                   (self.state.prev_headers[0].number, encode_hex(self.state.prev_headers[0].hash)))
         elif genesis is None:
@@ -85,6 +88,8 @@ class Chain(object):
                 header = self.state.prev_headers[0]
             self.genesis = Block(header)
             self.state.prev_headers[0] = header
+            self.state.rebuild_flat_index()
+            self.state.executing_on_head = True
             initialize_genesis_keys(self.state, self.genesis)
         else:
             self.genesis = self.get_block_by_number(0)
@@ -131,7 +136,8 @@ class Chain(object):
         b = block
         header_depth = state.config['PREV_HEADER_DEPTH']
         for i in range(header_depth + 1):
-            state.prev_headers.append(b.header)
+            state.prev_headers.append(
+                FakeHeader.from_header(b.header) if i else b.header)
             if i < 6:
                 state.recent_uncles[state.block_number - i] = []
                 for u in b.uncles:
@@ -221,6 +227,14 @@ class Chain(object):
             block = block.hash
         return [self.get_block(h) for h in self.get_child_hashes(block)]
 
+    # Get the storage slots (address + 32 byte key) edited by a block
+    def get_changed_storage(self, blockhash):
+        try:
+            data = self.db.get(b'changed_storage:' + blockhash)
+        except KeyError:
+            return []
+        return [data[i: i + 52] for i in range(0, len(data), 52)]
+
     # Get the score (AKA total difficulty in PoW) of a given block
     def get_score(self, block):
         if not block:
@@ -273,12 +287,17 @@ class Chain(object):
                      head=encode_hex(block.header.prevhash[:4]))
             self.state.deletes = []
             self.state.changed = {}
+            self.state.changed_storage = {}
+            self.state.wiped_storage = {}
             try:
                 apply_block(self.state, block)
             except (AssertionError, KeyError, ValueError, InvalidTransaction, VerificationFailed) as e:
                 log.info('Block %d (%s) with parent %s invalid, reason: %s' %
                          (block.number, encode_hex(block.header.hash[:4]), encode_hex(block.header.prevhash[:4]), str(e)))
                 return False
+            changed_storage = self.state.flat_storage_changes()
+            # Update the on-disk state cache
+            self.state.write_flat_index(self.state.changed, changed_storage)
             self.db.put(b'block:%d' % block.header.number, block.header.hash)
             # side effect: put 'score:' cache in db
             block_score = self.get_score(block)
@@ -306,6 +325,7 @@ class Chain(object):
             deletes = temp_state.deletes
             block_score = self.get_score(block)
             changed = temp_state.changed
+            changed_storage = temp_state.flat_storage_changes()
             # If the block should be the new head, replace the head
             if block_score > self.get_score(self.head):
                 b = block
@@ -328,6 +348,7 @@ class Chain(object):
                 # Get a list of all accounts that have been edited along the old and
                 # new chains
                 changed_accts = {}
+                changed_slots = {}
                 # Read: for i in range(common ancestor block number...new block
                 # number)
                 for i in itertools.count(replace_from):
@@ -353,6 +374,9 @@ class Chain(object):
                             b'changed:' + orig_block_at_height.hash)
                         for j in range(0, len(acct_list), 20):
                             changed_accts[acct_list[j: j + 20]] = True
+                        for k in self.get_changed_storage(
+                                orig_block_at_height.hash):
+                            changed_slots[k] = True
                     # Add data for new blocks
                     if i in new_chain:
                         new_block_at_height = new_chain[i]
@@ -368,26 +392,23 @@ class Chain(object):
                             self.db.put(b'txindex:' + tx.hash,
                                         rlp.encode([new_block_at_height.number, j]))
                         # Add to changed list
-                        if i < b.number:
+                        if i < block.number:
                             acct_list = self.db.get(
                                 b'changed:' + new_block_at_height.hash)
                             for j in range(0, len(acct_list), 20):
                                 changed_accts[acct_list[j: j + 20]] = True
+                            for k in self.get_changed_storage(
+                                    new_block_at_height.hash):
+                                changed_slots[k] = True
                     if i not in new_chain and not orig_at_height:
                         break
                 # Add changed list from new head to changed list
                 for c in changed.keys():
                     changed_accts[c] = True
+                for k in changed_storage:
+                    changed_slots[k] = True
                 # Update the on-disk state cache
-                for addr in changed_accts.keys():
-                    data = temp_state.trie.get(addr)
-                    if data:
-                        self.state.db.put(b'address:' + addr, data)
-                    else:
-                        try:
-                            self.state.db.delete(b'address:' + addr)
-                        except KeyError:
-                            pass
+                temp_state.write_flat_index(changed_accts, changed_slots)
                 self.head_hash = block.header.hash
                 self.state = temp_state
                 self.state.executing_on_head = True
@@ -407,6 +428,7 @@ class Chain(object):
         self.db.put(b'changed:' + block.hash,
                     b''.join([k.encode() if not is_string(k) else k for k in list(changed.keys())]))
         print('Saved %d address change logs' % len(changed.keys()))
+        self.db.put(b'changed_storage:' + block.hash, b''.join(changed_storage))
         self.db.put(b'deletes:' + block.hash, b''.join(deletes))
         log.debug('Saved %d trie node deletes for block %d (%s)' %
                   (len(deletes), block.number, utils.encode_hex(block.hash)))
@@ -424,6 +446,7 @@ class Chain(object):
                     rdb.delete(deletes[i: i + 32])
                 self.db.delete(b'deletes:' + old_block_hash)
                 self.db.delete(b'changed:' + old_block_hash)
+                self.db.delete(b'changed_storage:' + old_block_hash)
             except KeyError as e:
                 print(e)
                 pass
@@ -443,6 +466,15 @@ class Chain(object):
             del self.parent_queue[block.header.hash]
         return True
 
+    # Check the proof of work of a batch of headers, eg. received while
+    # catching up, in SEAL_VERIFY_WORKERS processes; add_block does not
+    # check the seals found valid again
+    def verify_seals(self, headers):
+        results = verify_seals(self.db, headers,
+                               self.config.get('SEAL_VERIFY_WORKERS', 0))
+        self.db.commit()
+        return results
+
     def __contains__(self, blk):
         if isinstance(blk, (str, bytes)):
             try:
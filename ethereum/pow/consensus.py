@@ -31,13 +31,49 @@ def initialize(state, block=None):
     # config["METROPOLIS_BLOCKHASH_STORE"]), config["METROPOLIS_GETTER_CODE"])
 
 
+# Seals found valid by verify_seals are recorded in the database under
+# this prefix and the hash of their header, which covers the mining hash,
+# mixhash, nonce, number and difficulty, so that check_pow can skip them
+VERIFIED_SEAL_PREFIX = b'verified-seal:'
+
+
+def _seal(header):
+    return (header.number, header.mining_hash, header.mixhash, header.nonce,
+            header.difficulty)
+
+
 # Check that proof of work is valid
 def check_pow(state, header):
-    assert ethpow.check_pow(header.number, header.mining_hash, header.mixhash,
-                            header.nonce, header.difficulty)
+    if VERIFIED_SEAL_PREFIX + header.hash not in state.db:
+        assert ethpow.check_pow(*_seal(header))
     return True
 
 
+def verify_seals(db, headers, workers=0):
+    """check the proof of work of many headers, eg. a segment of a chain
+    being synced, ahead of applying their blocks
+
+    The seals not already recorded in `db` are checked in a pool of
+    `workers` processes (see ethpow.check_pows), and those that are valid
+    recorded, so that check_pow does not check them again.
+
+    :param headers: list of block headers
+    :returns: list of `True` or `False`, in the order of `headers`
+    """
+    results, pending = [], []
+    for i, header in enumerate(headers):
+        verified = VERIFIED_SEAL_PREFIX + header.hash in db
+        results.append(verified)
+        if not verified:
+            pending.append(i)
+    checked = ethpow.check_pows([_seal(headers[i]) for i in pending], workers)
+    for i, valid in zip(pending, checked):
+        if valid:
+            db.put(VERIFIED_SEAL_PREFIX + headers[i].hash, b'\x01')
+            results[i] = True
+    return results
+
+
 # Get uncle blocks to add to a block on the given state
 def get_uncle_candidates(chain, state):
     uncles = []
@@ -128,5 +164,8 @@ def finalize(state, block):
 
     if state.block_number - \
             state.config['MAX_UNCLE_DEPTH'] in state.recent_uncles:
+        # replaced rather than edited in place, so that snapshots can
+        # share it
+        state.recent_uncles = dict(state.recent_uncles)
         del state.recent_uncles[state.block_number -
                                 state.config['MAX_UNCLE_DEPTH']]
@@ -1,5 +1,9 @@
 import copy
 import sys
+from ethereum.pow.ethash_utils import EPOCH_LENGTH, HASH_BYTES, WORD_BYTES, \
+    MIX_BYTES, DATASET_PARENTS, CACHE_ROUNDS, ACCESSES, fnv, xor, \
+    decode_int, encode_int, zpad, serialize_hash, sha3_256, sha3_512, keccak_256, \
+    get_cache_size, get_full_size, ListWrapper
 
 
 if sys.version_info.major == 2:
@@ -13,7 +17,7 @@ cache_seeds = [b'\x00' * 32]
 
 def mkcache(block_number):
     while len(cache_seeds) <= block_number // EPOCH_LENGTH:
-        cache_seeds.append(sha3.sha3_256(cache_seeds[-1]).digest())
+        cache_seeds.append(keccak_256(cache_seeds[-1]))
 
     seed = cache_seeds[block_number // EPOCH_LENGTH]
 
@@ -60,6 +64,19 @@ def calc_dataset(full_size, cache):
     return o
 
 
+def write_dataset(f, full_size, cache):
+    """write the full dataset to the binary file `f` item by item, in the
+    flat layout of serialize_dataset"""
+    for i in range(full_size // HASH_BYTES):
+        f.write(serialize_hash(calc_dataset_item(cache, i)))
+
+
+def from_buffer(data):
+    """a cache or dataset over a buffer in the flat layout of
+    serialize_cache, without copying it"""
+    return ListWrapper(data)
+
+
 def hashimoto(header, nonce, full_size, dataset_lookup):
     n = full_size // HASH_BYTES
     w = MIX_BYTES // WORD_BYTES
@@ -94,10 +111,20 @@ def hashimoto_full(dataset, header, nonce):
 
 
 def mine(full_size, dataset, header, difficulty):
+    """search from a random nonce on for one that meets `difficulty`
+
+    :return: the nonce, as an integer
+    """
     from random import randint
-    nonce = randint(0, 2**64)
-    while decode_int(hashimoto_full(
-            full_size, dataset, header, nonce)) < difficulty:
+    nonce = randint(0, 2**64 - 1)
+    target = 2**256 // (difficulty or 1)
+    while decode_int(hashimoto_full(dataset, header, encode_nonce(nonce))[
+            b'result'][::-1]) > target:
         nonce += 1
         nonce %= 2**64
     return nonce
+
+
+def encode_nonce(nonce):
+    # the 8 byte big-endian nonce of a block header
+    return zpad(encode_int(nonce), 8)[::-1]
@@ -0,0 +1,120 @@
+import numpy as np
+from ethereum.pow.ethash_utils import EPOCH_LENGTH, HASH_BYTES, WORD_BYTES, \
+    MIX_BYTES, DATASET_PARENTS, CACHE_ROUNDS, ACCESSES, FNV_PRIME, \
+    keccak_256, keccak_512, get_cache_size, get_full_size
+
+# ethash on NumPy arrays of little-endian 32 bit words: a cache or a set of
+# dataset items is an array of shape (items, 16). The results are the same
+# as those of ethash.py, whose lists of words these arrays replace.
+
+WORD = np.dtype('<u4')
+HASH_WORDS = HASH_BYTES // WORD_BYTES
+
+cache_seeds = [b'\x00' * 32]
+
+
+def fnv(v1, v2):
+    # word-wise, wrapping around at 2**32 like the reference
+    return (v1 * np.uint32(FNV_PRIME)) ^ v2
+
+
+def sha3_512_rows(rows):
+    """keccak-512 of every row of a (k, 16) word array"""
+    data = rows.astype(WORD, copy=False).tobytes()
+    out = b''.join(keccak_512(data[i:i + HASH_BYTES])
+                   for i in range(0, len(data), HASH_BYTES))
+    return np.frombuffer(out, WORD).reshape(-1, HASH_WORDS)
+
+
+def mkcache(block_number):
+    while len(cache_seeds) <= block_number // EPOCH_LENGTH:
+        cache_seeds.append(keccak_256(cache_seeds[-1]))
+
+    seed = cache_seeds[block_number // EPOCH_LENGTH]
+
+    n = get_cache_size(block_number) // HASH_BYTES
+    return _get_cache(seed, n)
+
+
+def _get_cache(seed, n):
+    # Sequentially produce the initial dataset
+    items = [keccak_512(seed)]
+    for i in range(1, n):
+        items.append(keccak_512(items[-1]))
+    o = np.frombuffer(b''.join(items), WORD).reshape(n, HASH_WORDS).copy()
+
+    # every item depends on the one before it, so only the xor of the two
+    # rows is done on arrays
+    for _ in range(CACHE_ROUNDS):
+        for i in range(n):
+            v = int(o[i, 0]) % n
+            o[i] = np.frombuffer(keccak_512(
+                (o[i - 1] ^ o[v]).tobytes()), WORD)
+
+    return o
+
+
+def calc_dataset_items(cache, indices):
+    """the dataset items at `indices`, computed together
+
+    :return: array of shape (len(indices), 16)
+    """
+    n = len(cache)
+    indices = np.asarray(indices, dtype=WORD)
+    mix = cache[indices % n]
+    mix[:, 0] ^= indices
+    mix = sha3_512_rows(mix)
+    for j in range(DATASET_PARENTS):
+        parents = fnv(indices ^ np.uint32(j), mix[:, j % HASH_WORDS]) % n
+        mix = fnv(mix, cache[parents])
+    return sha3_512_rows(mix)
+
+
+def calc_dataset_item(cache, i):
+    return calc_dataset_items(cache, [i])[0]
+
+
+def write_dataset(f, full_size, cache, batch=4096):
+    """write the full dataset to the binary file `f`, computing `batch`
+    items at a time"""
+    n = full_size // HASH_BYTES
+    for start in range(0, n, batch):
+        f.write(calc_dataset_items(
+            cache, np.arange(start, min(start + batch, n))).tobytes())
+
+
+def from_buffer(data):
+    """a cache or dataset over a buffer in the flat layout of
+    ethash_utils.serialize_cache, without copying it"""
+    return np.frombuffer(data, WORD).reshape(-1, HASH_WORDS)
+
+
+def hashimoto(header, nonce, full_size, dataset_lookup):
+    n = full_size // HASH_BYTES
+    w = MIX_BYTES // WORD_BYTES
+    mixhashes = MIX_BYTES // HASH_BYTES
+    s = np.frombuffer(keccak_512(header + nonce[::-1]), WORD)
+    mix = np.tile(s, mixhashes)
+    s0 = int(s[0])
+    offsets = np.arange(mixhashes, dtype=WORD)
+    for i in range(ACCESSES):
+        p = ((i ^ s0) * FNV_PRIME ^ int(mix[i % w])) % 2**32 % \
+            (n // mixhashes) * mixhashes
+        mix = fnv(mix, dataset_lookup(p + offsets).ravel())
+    mix = mix.reshape(-1, 4)
+    cmix = fnv(fnv(fnv(mix[:, 0], mix[:, 1]), mix[:, 2]), mix[:, 3])
+    digest = cmix.astype(WORD, copy=False).tobytes()
+    return {
+        b'mix digest': digest,
+        b'result': keccak_256(s.tobytes() + digest)
+    }
+
+
+def hashimoto_light(block_number, cache, header, nonce):
+    return hashimoto(header, nonce, get_full_size(block_number),
+                     lambda x: calc_dataset_items(cache, x))
+
+
+def hashimoto_full(dataset, header, nonce):
+    return hashimoto(header, nonce, len(dataset) * HASH_BYTES,
+                     lambda x: dataset[x])
@@ -1,15 +1,17 @@
+# keccak hash functions, taking and returning bytes; pysha3 is several
+# times faster than pycryptodome on inputs this short
 try:
-    from Crypto.Hash import keccak
+    import sha3 as _sha3
 
-    def sha3_256(x): return keccak.new(digest_bits=256, data=x).digest()
+    def keccak_256(x): return _sha3.keccak_256(x).digest()
 
-    def sha3_512(x): return keccak.new(digest_bits=512, data=x)
-except BaseException:
-    import sha3 as _sha3
+    def keccak_512(x): return _sha3.keccak_512(x).digest()
+except ImportError:
+    from Crypto.Hash import keccak
 
-    def sha3_256(x): return _sha3.sha3_256(x).digest()
+    def keccak_256(x): return keccak.new(digest_bits=256, data=x).digest()
 
-    def sha3_512(x): return _sha3.sha3_512(x).digest()
+    def keccak_512(x): return keccak.new(digest_bits=512, data=x).digest()
 from rlp.utils import decode_hex
 from ethereum.utils import encode_hex
 import sys
@@ -72,11 +74,11 @@ def to_bytes(x):
 
 # sha3 hash function, outputs 64 bytes
 def sha3_512(x):
-    return hash_words(sha3_512(to_bytes(v)).digest(), 64, x)
+    return hash_words(lambda v: keccak_512(to_bytes(v)), 64, x)
 
 
 def sha3_256(x):
-    return hash_words(sha3_256(to_bytes(v)).digest(), 32, x)
+    return hash_words(lambda v: keccak_256(to_bytes(v)), 32, x)
 
 
 def xor(a, b):
@@ -1,5 +1,9 @@
-from ethereum.pow import ethash
+from ethereum.pow import ethash, ethash_utils
 from ethereum import utils
+import mmap
+import multiprocessing
+import os
+import threading
 import time
 import sys
 import warnings
@@ -12,52 +16,190 @@ log = get_logger('eth.pow')
 
 if sys.version_info.major == 2:
     from repoze.lru import lru_cache
+    import Queue as queue
 else:
     from functools import lru_cache
+    import queue
+
+try:
+    from ethereum.pow import ethash_numpy
+except ImportError:
+    ethash_numpy = None
 
 try:
     import pyethash
     ETHASH_LIB = 'pyethash'  # the C++ based implementation
 except ImportError:
-    ETHASH_LIB = 'ethash'
+    if ethash_numpy is not None:
+        ETHASH_LIB = 'ethash_numpy'  # python, vectorized with NumPy
+    else:
+        ETHASH_LIB = 'ethash'
     warnings.warn('using pure python implementation', ImportWarning)
 
 if ETHASH_LIB == 'ethash':
     mkcache = ethash.mkcache
     EPOCH_LENGTH = 30000
     hashimoto_light = ethash.hashimoto_light
+    cache_to_bytes = ethash_utils.serialize_cache
+    cache_from_buffer = ethash.from_buffer
+elif ETHASH_LIB == 'ethash_numpy':
+    mkcache = ethash_numpy.mkcache
+    EPOCH_LENGTH = 30000
+    hashimoto_light = ethash_numpy.hashimoto_light
+
+    def cache_to_bytes(c): return c.tobytes()
+    cache_from_buffer = ethash_numpy.from_buffer
 elif ETHASH_LIB == 'pyethash':
     mkcache = pyethash.mkcache_bytes
     EPOCH_LENGTH = 30000
 
     def hashimoto_light(s, c, h, n): return \
         pyethash.hashimoto_light(s, c, h, utils.big_endian_to_int(n))
+
+    def cache_to_bytes(c): return c
+
+    # pyethash wants the cache as bytes, so it is read rather than mapped
+    def cache_from_buffer(data): return data[:]
 else:
     raise Exception("invalid ethash library set")
 
+# The full dataset is only computed and used in python
+dataset_lib = ethash_numpy or ethash
+hashimoto_full = dataset_lib.hashimoto_full
+
 TT64M1 = 2**64 - 1
 cache_seeds = [b'\x00' * 32]
 cache_by_seed = OrderedDict()
 cache_by_seed.max_items = 10
+# Directory where caches and datasets are kept across restarts, as flat
+# files of little-endian words (ethash_utils.serialize_cache) that are
+# memory-mapped when loaded; None keeps caches in memory only
+cache_dir = None
+# From this many blocks before the end of an epoch on, get_cache starts
+# generating the cache of the next epoch in a background thread
+CACHE_PREFETCH_BLOCKS = 3000
+# guards cache_seeds, cache_by_seed and _generating; the latter maps the
+# seeds of caches being generated to an Event set once they are done
+_lock = threading.Lock()
+_generating = {}
 
 
-def get_cache(block_number):
-    import sha3
-    while len(cache_seeds) <= block_number // EPOCH_LENGTH:
-        cache_seeds.append(utils.sha3(cache_seeds[-1]))
-    seed = cache_seeds[block_number // EPOCH_LENGTH]
-    if seed in cache_by_seed:
-        c = cache_by_seed.pop(seed)  # pop and append at end
-        cache_by_seed[seed] = c
-        return c
+def get_seed(block_number):
+    with _lock:
+        while len(cache_seeds) <= block_number // EPOCH_LENGTH:
+            cache_seeds.append(utils.sha3(cache_seeds[-1]))
+        return cache_seeds[block_number // EPOCH_LENGTH]
+
+
+def _file_path(kind, block_number):
+    return os.path.join(cache_dir, '%s-%d-%s' % (
+        kind, block_number // EPOCH_LENGTH,
+        utils.encode_hex(get_seed(block_number)[:8])))
+
+
+def _map_file(path, size):
+    # the contents of the file at `path`, memory-mapped, or None if there
+    # is no such file of that size
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != size:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError):
+        return None
+
+
+def _write_file(path, write):
+    # the file only appears under its name once it is complete
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.rename(tmp, path)
+
+
+def _make_cache(block_number):
+    if cache_dir is None:
+        return mkcache(block_number)
+    path = _file_path('cache', block_number)
+    data = _map_file(path, ethash_utils.get_cache_size(block_number))
+    if data is not None:
+        log.debug('loaded cache', path=path)
+        return cache_from_buffer(data)
     c = mkcache(block_number)
-    cache_by_seed[seed] = c
-    if len(cache_by_seed) > cache_by_seed.max_items:
-        # remove last recently accessed
-        cache_by_seed.pop(cache_by_seed.keys()[0])
+    _write_file(path, lambda f: f.write(cache_to_bytes(c)))
+    log.debug('stored cache', path=path)
     return c
 
 
+def _cache_for(block_number):
+    seed = get_seed(block_number)
+    while True:
+        with _lock:
+            if seed in cache_by_seed:
+                c = cache_by_seed.pop(seed)  # pop and append at end
+                cache_by_seed[seed] = c
+                return c
+            done = _generating.get(seed)
+            if done is None:
+                done = _generating[seed] = threading.Event()
+                break
+        # generated by another thread; fetch it once it is there
+        done.wait()
+    c = None
+    try:
+        c = _make_cache(block_number)
+        return c
+    finally:
+        with _lock:
+            if c is not None:
+                cache_by_seed[seed] = c
+                if len(cache_by_seed) > cache_by_seed.max_items:
+                    # remove last recently accessed
+                    cache_by_seed.pop(next(iter(cache_by_seed)))
+            del _generating[seed]
+        done.set()
+
+
+def prefetch_cache(block_number):
+    """start generating (or loading) the cache for `block_number` in a
+    background thread, unless it is already there or under way"""
+    seed = get_seed(block_number)
+    with _lock:
+        if seed in cache_by_seed or seed in _generating:
+            return
+    t = threading.Thread(target=_cache_for, args=(block_number,))
+    t.daemon = True
+    t.start()
+
+
+def get_cache(block_number):
+    c = _cache_for(block_number)
+    if block_number % EPOCH_LENGTH >= EPOCH_LENGTH - CACHE_PREFETCH_BLOCKS:
+        prefetch_cache(block_number + EPOCH_LENGTH)
+    return c
+
+
+def get_dataset(block_number):
+    """the full dataset for `block_number` from cache_dir, memory-mapped,
+    for hashimoto_full. It is computed and stored first if it is not
+    there yet, which takes a long time: it is a gigabyte or more.
+    """
+    assert cache_dir is not None, "datasets are only kept in cache_dir"
+    full_size = ethash_utils.get_full_size(block_number)
+    path = _file_path('full', block_number)
+    data = _map_file(path, full_size)
+    if data is None:
+        cache = dataset_lib.from_buffer(
+            cache_to_bytes(get_cache(block_number)))
+        log.info('generating dataset', path=path, size=full_size)
+        _write_file(path, lambda f: dataset_lib.write_dataset(
+            f, full_size, cache))
+        data = _map_file(path, full_size)
+    return dataset_lib.from_buffer(data)
+
+
 @lru_cache(maxsize=32)
 def check_pow(block_number, header_hash, mixhash, nonce, difficulty):
     """Check if the proof-of-work of the block is valid.
@@ -73,6 +215,11 @@ def check_pow(block_number, header_hash, mixhash, nonce, difficulty):
 
     # Grab current cache
     cache = get_cache(block_number)
+    return _check_pow(block_number, cache, header_hash, mixhash, nonce,
+                      difficulty)
+
+
+def _check_pow(block_number, cache, header_hash, mixhash, nonce, difficulty):
     mining_output = hashimoto_light(block_number, cache, header_hash, nonce)
     if mining_output[b'mix digest'] != mixhash:
         return False
@@ -80,6 +227,58 @@ def check_pow(block_number, header_hash, mixhash, nonce, difficulty):
         mining_output[b'result']) <= 2**256 // (difficulty or 1)
 
 
+# caches of the epochs being worked on by a check_pows pool, by epoch,
+# handed to its processes when they start
+_pool_caches = {}
+
+
+def _init_check_worker(caches):
+    global _pool_caches
+    _pool_caches = caches
+
+
+def _check_seal(seal):
+    block_number, header_hash, mixhash, nonce, difficulty = seal
+    if len(mixhash) != 32 or len(header_hash) != 32 or len(nonce) != 8:
+        return False
+    return _check_pow(block_number, _pool_caches[block_number // EPOCH_LENGTH],
+                      header_hash, mixhash, nonce, difficulty)
+
+
+def check_pows(seals, workers=0):
+    """check_pow for many seals at once, in a pool of `workers` processes
+
+    The caches of the epochs involved are made (or loaded) here first and
+    handed to the processes of the pool, so that they all share them
+    rather than each making its own. With fewer than two workers, or if
+    the pool cannot be started, the seals are checked serially.
+
+    :param seals: list of (block_number, header_hash, mixhash, nonce,
+                  difficulty) tuples, as taken by check_pow
+    :returns: list of `True` or `False`, in the order of `seals`
+    """
+    seals = [tuple(seal) for seal in seals]
+    if workers < 2 or len(seals) < 2:
+        return [check_pow(*seal) for seal in seals]
+    caches = {}
+    for seal in seals:
+        epoch = seal[0] // EPOCH_LENGTH
+        if epoch not in caches:
+            caches[epoch] = _cache_for(seal[0])
+    try:
+        pool = multiprocessing.Pool(workers, _init_check_worker, (caches,))
+    except (OSError, ImportError) as e:
+        log.warning('could not start pow workers, checking serially',
+                    error=e)
+        return [check_pow(*seal) for seal in seals]
+    try:
+        return pool.map(_check_seal, seals,
+                        max(1, len(seals) // (workers * 4)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 class Miner():
 
     """
@@ -95,9 +294,17 @@ class Miner():
     :param block: the block for which to find a valid nonce
     """
 
-    def __init__(self, block):
+    def __init__(self, block, workers=0):
+        """
+        :param workers: processes to split the nonce search between
+                        (0 or 1: search in this process)
+        """
         self.nonce = 0
         self.block = block
+        self.workers = workers
+        self.cancelled = threading.Event()
+        # 'hashes' and 'seconds' of the current or last search
+        self.stats = {}
         log.debug('mining', block_number=self.block.number,
                   block_hash=utils.encode_hex(self.block.hash),
                   block_difficulty=self.block.difficulty)
@@ -105,28 +312,139 @@ class Miner():
     def mine(self, rounds=1000, start_nonce=0):
         blk = self.block
         bin_nonce, mixhash = mine(blk.number, blk.difficulty, blk.mining_hash,
-                                  start_nonce=start_nonce, rounds=rounds)
+                                  start_nonce=start_nonce, rounds=rounds,
+                                  workers=self.workers, cancel=self.cancelled,
+                                  stats=self.stats)
         if bin_nonce:
             blk.header.mixhash = mixhash
             blk.header.nonce = bin_nonce
             # assert blk.check_pow()
             return blk
 
+    def cancel(self):
+        """stop mining, eg. because a new head arrived; safe to call from
+        another thread"""
+        self.cancelled.set()
 
-def mine(block_number, difficulty, mining_hash, start_nonce=0, rounds=1000):
-    assert utils.is_numeric(start_nonce)
-    cache = get_cache(block_number)
-    nonce = start_nonce
-    target = utils.zpad(utils.int_to_big_endian(
-        2**256 // (difficulty or 1) - 1), 32)
-    for i in range(1, rounds + 1):
+    @property
+    def hashrate(self):
+        """hashes per second of the current or last search"""
+        seconds = self.stats.get('seconds')
+        return self.stats['hashes'] / seconds if seconds else 0
+
+
+# nonces tried between two looks at the stop event and updates of the
+# hash count
+MINE_BATCH = 64
+
+
+def _search(block_number, mining_hash, target, cache, dataset, first, count,
+            stop, hashes):
+    # tries nonces first + 1 .. first + count, returning the nonce and mix
+    # digest of the first solution or (None, None). `stop` is checked
+    # and `hashes` (a callable) told of progress every MINE_BATCH nonces
+    for i in range(1, count + 1):
         bin_nonce = utils.zpad(
-            utils.int_to_big_endian(
-                (nonce + i) & TT64M1), 8)
-        o = hashimoto_light(block_number, cache, mining_hash, bin_nonce)
+            utils.int_to_big_endian((first + i) & TT64M1), 8)
+        if dataset is not None:
+            o = hashimoto_full(dataset, mining_hash, bin_nonce)
+        else:
+            o = hashimoto_light(block_number, cache, mining_hash, bin_nonce)
         if o[b'result'] <= target:
+            hashes(i % MINE_BATCH or MINE_BATCH)
             log.debug('nonce found: {}'.format(bin_nonce))
             assert len(bin_nonce) == 8
             assert len(o[b'mix digest']) == 32
             return bin_nonce, o[b'mix digest']
+        if i % MINE_BATCH == 0:
+            hashes(MINE_BATCH)
+            if stop.is_set():
+                return None, None
+    hashes(count % MINE_BATCH)
     return None, None
+
+
+def _search_worker(args, stop, found, hashes):
+    # runs in the mining processes: reports its solution, if any, and then
+    # None once it is done
+    def count(n):
+        with hashes.get_lock():
+            hashes.value += n
+    try:
+        bin_nonce, mixhash = _search(*(args + (stop, count)))
+        if bin_nonce:
+            stop.set()
+            found.put((bin_nonce, mixhash))
+    finally:
+        found.put(None)
+
+
+def mine(block_number, difficulty, mining_hash, start_nonce=0, rounds=1000,
+         workers=0, cancel=None, stats=None, full=False):
+    """search nonces start_nonce + 1 .. start_nonce + rounds for one that
+    meets `difficulty`
+
+    With more than one worker the nonces are split into equal ranges, one
+    per process. The processes share the cache (or dataset), which is
+    mapped from cache_dir if set and otherwise inherited from this one,
+    and all stop once one of them finds a solution.
+
+    :param workers: number of processes (0 or 1: search in this one)
+    :param cancel: Event that stops the search once set, eg. by another
+                   thread when a new head arrives
+    :param stats: dict that gets the number of 'hashes' computed and the
+                  'seconds' it took, as the search goes on
+    :param full: hash with the full dataset of get_dataset, which needs
+                 cache_dir, instead of the cache
+    :return: (nonce, mixhash), or (None, None) if none was found
+    """
+    assert utils.is_numeric(start_nonce)
+    cache = get_cache(block_number)
+    dataset = get_dataset(block_number) if full else None
+    target = utils.zpad(utils.int_to_big_endian(
+        2**256 // (difficulty or 1) - 1), 32)
+    stats = {} if stats is None else stats
+    stats.update(hashes=0, seconds=0)
+    begin = time.time()
+
+    if workers <= 1:
+        def count(n):
+            stats['hashes'] += n
+            stats['seconds'] = time.time() - begin
+        return _search(block_number, mining_hash, target, cache, dataset,
+                       start_nonce, rounds, cancel or threading.Event(),
+                       count)
+
+    stop = multiprocessing.Event()
+    found = multiprocessing.Queue()
+    hashes = multiprocessing.Value('L', 0)
+    share = -(-rounds // workers)
+    procs = []
+    for first in range(start_nonce, start_nonce + rounds, share):
+        args = (block_number, mining_hash, target, cache, dataset, first,
+                min(share, start_nonce + rounds - first))
+        p = multiprocessing.Process(target=_search_worker,
+                                    args=(args, stop, found, hashes))
+        p.daemon = True
+        p.start()
+        procs.append(p)
+    result = None, None
+    running = len(procs)
+    try:
+        while running:
+            if cancel is not None and cancel.is_set():
+                stop.set()
+            try:
+                msg = found.get(timeout=0.1)
+            except queue.Empty:
+                msg = False
+            if msg is None:
+                running -= 1
+            elif msg and result[0] is None:
+                result = msg
+            stats.update(hashes=hashes.value, seconds=time.time() - begin)
+    finally:
+        stop.set()
+        for p in procs:
+            p.join()
+    return result
@@ -1,4 +1,5 @@
 from ethereum import utils
+from ethereum import trie
 
 
 class SecureTrie(object):
@@ -18,17 +19,42 @@ class SecureTrie(object):
     def delete(self, k):
         self.trie.delete(utils.sha3(k))
 
+    def update_many(self, items):
+        hashed = []
+        for k, v in items:
+            h = utils.sha3(k)
+            if v is not None:
+                self.db.put(h, utils.str_to_bytes(k))
+            hashed.append((h, v))
+        self.trie.update_many(hashed)
+
+    def delete_many(self, keys):
+        self.trie.delete_many([utils.sha3(k) for k in keys])
+
+    def commit(self):
+        self.trie.commit()
+
     def to_dict(self):
-        o = {}
-        for h, v in list(self.trie.to_dict().items()):
-            k = self.db.get(h)
-            o[k] = v
-        return o
+        return dict(self.iterate())
+
+    def get_proof(self, k):
+        return self.trie.get_proof(utils.sha3(k))
+
+    def get_multi_proof(self, keys):
+        return self.trie.get_multi_proof([utils.sha3(k) for k in keys])
+
+    def iterate(self, start=b'', end=None, limit=None):
+        """Trie.iterate, yielding the original keys; `start` and `end` are
+        positions in the order of the hashed keys"""
+        for h, v in self.trie.iterate(start, end, limit):
+            yield self.db.get(h), v
+
+    def iterate_page(self, token=None, end=None, limit=1000):
+        items, token = self.trie.iterate_page(token, end, limit)
+        return [(self.db.get(h), v) for h, v in items], token
 
     def iter_branch(self):
-        for h, v in self.trie.iter_branch():
-            k = self.db.get(h)
-            yield (k, v)
+        return self.iterate()
 
     def root_hash_valid(self):
         return self.trie.root_hash_valid()
@@ -57,3 +83,22 @@ class SecureTrie(object):
 
     def revert_epoch(self, epoch):
         self.trie.revert_epoch(epoch)
+
+
+def verify_proof(root, k, proof):
+    """trie.verify_proof for a proof made by SecureTrie.get_proof"""
+    return trie.verify_proof(root, utils.sha3(k), proof)
+
+
+def build_trie(db, items, workers=0):
+    """trie.build_trie for a secure trie, storing the key preimages
+
+    :param items: iterable of (key, value) in the order of the hashed keys
+    :return: the root hash
+    """
+    def hashed():
+        for k, v in items:
+            h = utils.sha3(k)
+            db.put(h, utils.str_to_bytes(k))
+            yield h, v
+    return trie.build_trie(db, hashed(), workers)
@@ -17,9 +17,9 @@ def proc_ecrecover(ext, msg):
     if msg.gas < gas_cost:
         return 0, 0, []
 
-    message_hash_bytes = [0] * 32
+    message_hash_bytes = bytearray(32)
     msg.data.extract_copy(message_hash_bytes, 0, 0, 32)
-    message_hash = b''.join(map(ascii_chr, message_hash_bytes))
+    message_hash = bytes(message_hash_bytes)
 
     # TODO: This conversion isn't really necessary.
     # TODO: Invesitage if the check below is really needed.
@@ -30,10 +30,10 @@ def proc_ecrecover(ext, msg):
     if r >= secp256k1n or s >= secp256k1n or v < 27 or v > 28:
         return 1, msg.gas - opcodes.GECRECOVER, []
     try:
-        pub = utils.ecrecover_to_pub(message_hash, v, r, s)
+        addr = utils.ecrecover_to_address(message_hash, v, r, s)
     except Exception as e:
         return 1, msg.gas - gas_cost, []
-    o = [0] * 12 + [safe_ord(x) for x in utils.sha3(pub)[-20:]]
+    o = [0] * 12 + [safe_ord(x) for x in addr]
     return 1, msg.gas - gas_cost, o
 
 
@@ -68,9 +68,7 @@ def proc_identity(ext, msg):
     gas_cost = OP_GAS
     if msg.gas < gas_cost:
         return 0, 0, []
-    o = [0] * msg.data.size
-    msg.data.extract_copy(o, 0, 0, len(o))
-    return 1, msg.gas - gas_cost, o
+    return 1, msg.gas - gas_cost, bytearray(msg.data.extract_all())
 
 
 def mult_complexity(x):
@@ -3,15 +3,18 @@ from ethereum.utils import normalize_address, hash32, trie_root, \
     big_endian_int, address, int256, encode_hex, encode_int, \
     big_endian_to_int, int_to_addr, zpad, parse_as_bin, parse_as_int, \
     decode_hex, sha3, is_string, is_numeric
-from rlp.sedes import big_endian_int, Binary, binary, CountableList
+from rlp.sedes import big_endian_int, Binary, binary, CountableList, List
 from ethereum import utils
 from ethereum import trie
 from ethereum.trie import Trie
+from ethereum import securetrie
 from ethereum.securetrie import SecureTrie
 from ethereum.config import default_config, Env
 from ethereum.block import FakeHeader
-from ethereum.db import BaseDB, EphemDB, OverlayDB, RefcountDB
+from ethereum.db import BaseDB, EphemDB, OverlayDB, RefcountDB, \
+    RecordingDB
 from ethereum.specials import specials as default_specials
+from ethereum.slogging import get_logger
 import copy
 import sys
 if sys.version_info.major == 2:
@@ -25,6 +28,17 @@ BLANK_ROOT = utils.sha3rlp(b'')
 
 THREE = b'\x00' * 19 + b'\x03'
 
+# Keys of the flat index: account RLP by address, storage values by
+# address + 32 byte slot. The index is of the state root under
+# FLAT_ROOT and holds FLAT_SIZE entries. (Older databases may still have
+# entries under the address: prefix, which are never read.)
+FLAT_ACCOUNT = b'flat-address:'
+FLAT_STORAGE = b'flat-storage:'
+FLAT_ROOT = b'flat_root'
+FLAT_SIZE = b'flat_size'
+
+log_state = get_logger('eth.state')
+
 
 def snapshot_form(val):
     if is_numeric(val):
@@ -33,6 +47,12 @@ def snapshot_form(val):
         return '0x' + encode_hex(val)
 
 
+# Journal record types. Each record is a tuple whose first item is its
+# type; revert() replays records newest first:
+#   (JOURNAL_SET, obj, attr, preval)      setattr(obj, attr, preval)
+#   (JOURNAL_STORAGE, acct, key, preval)  acct.set_storage_data(key, preval)
+JOURNAL_SET, JOURNAL_STORAGE = 0, 1
+
 STATE_DEFAULTS = {
     "txindex": 0,
     "gas_used": 0,
@@ -50,8 +70,17 @@ STATE_DEFAULTS = {
     "refunds": 0,
 }
 
+_state_params = tuple(sorted(STATE_DEFAULTS))
+_list_params = tuple(k for k in _state_params
+                     if isinstance(STATE_DEFAULTS[k], list))
 
-class Account(rlp.Serializable):
+
+# An account as cached by State. Rather than an rlp.Serializable, this is
+# a plain slotted object that acts as its own sedes (rlp.encode(account),
+# rlp.decode(data, Account, env=env, address=address)), as thousands of
+# these get loaded per block, and its storage trie is only created on the
+# first storage access
+class Account(object):
 
     fields = [
         ('nonce', big_endian_int),
@@ -59,26 +88,60 @@ class Account(rlp.Serializable):
         ('storage', trie_root),
         ('code_hash', hash32)
     ]
+    _sedes = List([sedes for _, sedes in fields])
+
+    __slots__ = ('nonce', 'balance', 'storage', 'code_hash', 'env',
+                 'address', 'storage_cache', '_storage_trie', 'touched',
+                 'existent_at_start', 'deleted', 'flat_storage')
 
     def __init__(self, nonce, balance, storage, code_hash, env, address):
         assert isinstance(env.db, BaseDB)
         self.env = env
         self.address = address
-        super(Account, self).__init__(nonce, balance, storage, code_hash)
+        self.nonce = nonce
+        self.balance = balance
+        self.storage = storage
+        self.code_hash = code_hash
         self.storage_cache = {}
-        self.storage_trie = SecureTrie(Trie(RefcountDB(self.env.db)))
-        self.storage_trie.root_hash = self.storage
+        self._storage_trie = None
         self.touched = False
         self.existent_at_start = True
-        self._mutable = True
         self.deleted = False
+        # set by State when the account was read from the flat index
+        self.flat_storage = None
+
+    @classmethod
+    def serialize(cls, obj):
+        return cls._sedes.serialize(
+            [obj.nonce, obj.balance, obj.storage, obj.code_hash])
+
+    @classmethod
+    def deserialize(cls, serial, env, address):
+        nonce, balance, storage, code_hash = cls._sedes.deserialize(serial)
+        return cls(nonce, balance, storage, code_hash, env, address)
+
+    @property
+    def storage_trie(self):
+        if self._storage_trie is None:
+            self._storage_trie = SecureTrie(
+                Trie(RefcountDB(self.env.db), self.storage))
+        return self._storage_trie
+
+    @property
+    def storage_trie_loaded(self):
+        return self._storage_trie is not None
+
+    def storage_updates(self):
+        """the pending storage writes, as (32 byte key, rlp value) pairs
+        with a value of None for cleared slots"""
+        return [(utils.encode_int32(k), rlp.encode(v) if v else None)
+                for k, v in self.storage_cache.items()]
 
     def commit(self):
-        for k, v in self.storage_cache.items():
-            if v:
-                self.storage_trie.update(utils.encode_int32(k), rlp.encode(v))
-            else:
-                self.storage_trie.delete(utils.encode_int32(k))
+        # nothing to write, and the root can't have been reset either
+        if not self.storage_cache and self._storage_trie is None:
+            return
+        self.storage_trie.update_many(self.storage_updates())
         self.storage_cache = {}
         self.storage = self.storage_trie.root_hash
 
@@ -96,7 +159,10 @@ class Account(rlp.Serializable):
 
     def get_storage_data(self, key):
         if key not in self.storage_cache:
-            v = self.storage_trie.get(utils.encode_int32(key))
+            if self.flat_storage is not None:
+                v = self.flat_storage(self.address, key)
+            else:
+                v = self.storage_trie.get(utils.encode_int32(key))
             self.storage_cache[key] = utils.big_endian_to_int(
                 rlp.decode(v) if v else b'')
         return self.storage_cache[key]
@@ -130,6 +196,22 @@ class Account(rlp.Serializable):
                             '0x' + encode_hex(rlp.decode(val)) for key, val in odict.items()}}
 
 
+def _storage_root(job):
+    # runs in the worker processes: applies updates (with hashed keys) to
+    # the storage trie with the given root, using only the nodes that
+    # Trie.path_nodes collected for them. Returns the new root, the nodes
+    # written and the nodes deleted, or None if a node was missing after
+    # all, in which case the parent falls back to Account.commit
+    root, nodes, updates = job
+    db = RecordingDB(nodes)
+    try:
+        t = Trie(db, root)
+        t.update_many(updates)
+        return t.root_hash, db.puts, t.deletes
+    except KeyError:
+        return None
+
+
 # from ethereum.state import State
 class State():
 
@@ -143,6 +225,10 @@ class State():
         self.log_listeners = []
         self.deletes = []
         self.changed = {}
+        # addr + slot -> True for storage written since the last block
+        self.changed_storage = {}
+        # addr -> storage root before it was wiped
+        self.wiped_storage = {}
         self.executing_on_head = executing_on_head
 
     @property
@@ -161,26 +247,31 @@ class State():
         return o
 
     def add_block_header(self, block_header):
-        self.prev_headers = [block_header] + self.prev_headers
+        # the head keeps its full header (a chain may be started from this
+        # state); those before it only need the compact form
+        older = self.prev_headers[:1]
+        if older and older[0]:
+            older = [FakeHeader.from_header(older[0])]
+        self.prev_headers = [block_header] + older + self.prev_headers[1:]
 
     def get_and_cache_account(self, address):
         if address in self.cache:
             return self.cache[address]
-        if self.executing_on_head and False:
-            try:
-                rlpdata = self.db.get(b'address:' + address)
-            except KeyError:
-                rlpdata = b''
+        # The flat index reflects the state as of the head block, so it
+        # can only be used for accounts not yet committed since then
+        use_flat = self.executing_on_head and address not in self.changed
+        if use_flat:
+            rlpdata = self._get_flat_account(address)
         else:
             rlpdata = self.trie.get(address)
         if rlpdata != trie.BLANK_NODE:
             o = rlp.decode(rlpdata, Account, env=self.env, address=address)
+            if use_flat:
+                o.flat_storage = self._get_flat_storage
         else:
             o = Account.blank_account(
                 self.env, address, self.config['ACCOUNT_INITIAL_NONCE'])
         self.cache[address] = o
-        o._mutable = True
-        o._cached_rlp = None
         return o
 
     def get_balance(self, address):
@@ -196,9 +287,7 @@ class State():
             utils.normalize_address(address)).nonce
 
     def set_and_journal(self, acct, param, val):
-        # self.journal.append((acct, param, getattr(acct, param)))
-        preval = getattr(acct, param)
-        self.journal.append(lambda: setattr(acct, param, preval))
+        self.journal.append((JOURNAL_SET, acct, param, getattr(acct, param)))
         setattr(acct, param, val)
 
     def set_balance(self, address, value):
@@ -237,56 +326,61 @@ class State():
 
     def set_storage_data(self, address, key, value):
         acct = self.get_and_cache_account(utils.normalize_address(address))
-        preval = acct.get_storage_data(key)
+        self.journal.append(
+            (JOURNAL_STORAGE, acct, key, acct.get_storage_data(key)))
         acct.set_storage_data(key, value)
-        self.journal.append(lambda: acct.set_storage_data(key, preval))
         self.set_and_journal(acct, 'touched', True)
 
     def add_suicide(self, address):
         self.suicides.append(address)
-        self.journal.append(lambda: self.suicides.pop())
 
     def add_log(self, log):
         for listener in self.log_listeners:
             listener(log)
         self.logs.append(log)
-        self.journal.append(lambda: self.logs.pop())
 
     def add_receipt(self, receipt):
         self.receipts.append(receipt)
-        self.journal.append(lambda: self.receipts.pop())
 
     def add_refund(self, value):
-        preval = self.refunds
-        self.refunds += value
-        self.journal.append(lambda: setattr(self.refunds, preval))
+        self.set_param('refunds', self.refunds + value)
 
     def snapshot(self):
-        return (self.trie.root_hash, len(self.journal), {
-                k: copy.copy(getattr(self, k)) for k in STATE_DEFAULTS})
+        # The lists among the STATE_DEFAULTS are only ever appended to or
+        # replaced (revert shortens them by replacing them with a copy, as
+        # other snapshots may hold them), and recent_uncles is only ever
+        # replaced, so rather than copying them the snapshot keeps
+        # references plus list lengths
+        return (self.trie.root_hash, len(self.journal),
+                tuple(getattr(self, k) for k in _state_params),
+                tuple(len(getattr(self, k)) for k in _list_params))
 
     def revert(self, snapshot):
-        h, L, auxvars = snapshot
+        h, L, auxvars, lengths = snapshot
         # Compatibility with weird geth+parity bug
         three_touched = self.cache[THREE].touched if THREE in self.cache else False
-        while len(self.journal) > L:
-            try:
-                lastitem = self.journal.pop()
-                lastitem()
-            except Exception as e:
-                print(e)
+        journal = self.journal
+        while len(journal) > L:
+            record = journal.pop()
+            kind = record[0]
+            if kind == JOURNAL_SET:
+                setattr(record[1], record[2], record[3])
+            else:
+                record[1].set_storage_data(record[2], record[3])
         if h != self.trie.root_hash:
             assert L == 0
             self.trie.root_hash = h
             self.cache = {}
-        for k in STATE_DEFAULTS:
-            setattr(self, k, copy.copy(auxvars[k]))
+        for k, v in zip(_state_params, auxvars):
+            setattr(self, k, v)
+        for k, n in zip(_list_params, lengths):
+            if len(getattr(self, k)) > n:
+                setattr(self, k, getattr(self, k)[:n])
         if three_touched and 2675000 < self.block_number < 2675200:  # Compatibility with weird geth+parity bug
             self.delta_balance(THREE, 0)
 
     def set_param(self, k, v):
-        preval = getattr(self, k)
-        self.journal.append(lambda: setattr(self, k, preval))
+        self.journal.append((JOURNAL_SET, self, k, getattr(self, k)))
         setattr(self, k, v)
 
     def is_SERENITY(self, at_fork_height=False):
@@ -357,30 +451,83 @@ class State():
         return self.get_and_cache_account(
             utils.normalize_address(address)).to_dict()
 
+    def commit_storage_roots(self, accounts, workers):
+        """compute the new storage roots of `accounts` in a pool of
+        `workers` processes
+
+        Each job gets the account's pending writes together with the
+        existing trie nodes they touch, and sends back the nodes to store,
+        which are then written here exactly as Account.commit would have
+        written them, so roots and database contents are the same as when
+        committing serially. Accounts whose job could not be run are left
+        with their pending writes for Account.commit.
+
+        :param accounts: list of accounts
+        :param workers: number of worker processes
+        """
+        pending, jobs = [], []
+        for acct in accounts:
+            if not acct.storage_cache:
+                continue
+            updates = acct.storage_updates()
+            hashed = [(utils.sha3(k), v) for k, v in updates]
+            t = acct.storage_trie
+            jobs.append((t.root_hash, t.trie.path_nodes(
+                [h for h, _ in hashed]), hashed))
+            pending.append((acct, updates))
+        if len(jobs) < 2:
+            return
+        try:
+            results = utils.get_process_pool(workers).map(_storage_root, jobs)
+        except (OSError, ImportError) as e:
+            log_state.warning('parallel storage commit failed, committing '
+                              'serially', error=e)
+            return
+        for (acct, updates), result in zip(pending, results):
+            if result is None:
+                continue
+            root, puts, deletes = result
+            t = acct.storage_trie
+            # the key preimages SecureTrie.update_many would have stored
+            for k, v in updates:
+                if v is not None:
+                    t.db.put(utils.sha3(k), k)
+            for k, v in puts:
+                t.db.put(k, v)
+            t.root_hash = root
+            t.deletes.extend(deletes)
+            acct.storage_cache = {}
+            acct.storage = root
+
     def commit(self, allow_empties=False):
-        for addr, acct in self.cache.items():
-            if acct.touched or acct.deleted:
-                acct.commit()
+        updates = []
+        committing = [(addr, acct) for addr, acct in self.cache.items()
+                      if acct.touched or acct.deleted]
+        for addr, acct in committing:
+            for k in acct.storage_cache:
+                self.changed_storage[addr + utils.encode_int32(k)] = True
+        workers = self.config.get('STORAGE_COMMIT_WORKERS', 0)
+        if workers > 1:
+            self.commit_storage_roots(
+                [acct for addr, acct in committing], workers)
+        for addr, acct in committing:
+            acct.commit()
+            if acct.storage_trie_loaded:
                 self.deletes.extend(acct.storage_trie.deletes)
-                self.changed[addr] = True
-                if self.account_exists(addr) or allow_empties:
-                    self.trie.update(addr, rlp.encode(acct))
-                    if self.executing_on_head:
-                        self.db.put(b'address:' + addr, rlp.encode(acct))
-                else:
-                    self.trie.delete(addr)
-                    if self.executing_on_head:
-                        try:
-                            self.db.delete(b'address:' + addr)
-                        except KeyError:
-                            pass
+            self.changed[addr] = True
+            if self.account_exists(addr) or allow_empties:
+                updates.append((addr, rlp.encode(acct)))
+            else:
+                updates.append((addr, None))
+                self.wiped_storage.setdefault(addr, acct.storage)
+        self.trie.update_many(updates)
         self.deletes.extend(self.trie.deletes)
         self.trie.deletes = []
         self.cache = {}
         self.journal = []
 
     def to_dict(self):
-        for addr in self.trie.to_dict().keys():
+        for addr, _ in self.trie.iterate():
             self.get_and_cache_account(addr)
         return {encode_hex(addr): acct.to_dict()
                 for addr, acct in self.cache.items()}
@@ -404,16 +551,147 @@ class State():
 
     def reset_storage(self, address):
         acct = self.get_and_cache_account(address)
-        pre_cache = acct.storage_cache
-        acct.storage_cache = {}
-        self.journal.append(lambda: setattr(acct, 'storage_cache', pre_cache))
-        pre_root = acct.storage_trie.root_hash
-        self.journal.append(
-            lambda: setattr(
-                acct.storage_trie,
-                'root_hash',
-                pre_root))
-        acct.storage_trie.root_hash = BLANK_ROOT
+        self.set_and_journal(acct, 'storage_cache', {})
+        # the flat index still has the slots that are being wiped
+        self.set_and_journal(acct, 'flat_storage', None)
+        self.wiped_storage.setdefault(address, acct.storage_trie.root_hash)
+        self.set_and_journal(acct.storage_trie, 'root_hash', BLANK_ROOT)
+
+    def _get_flat_account(self, address):
+        try:
+            return self.db.get(FLAT_ACCOUNT + address)
+        except KeyError:
+            return b''
+
+    def _get_flat_storage(self, address, key):
+        try:
+            return self.db.get(
+                FLAT_STORAGE + address + utils.encode_int32(key))
+        except KeyError:
+            return b''
+
+    def _mk_storage_trie(self, root):
+        return SecureTrie(Trie(RefcountDB(self.db), root))
+
+    def get_proof(self, address, storage_keys=()):
+        """Merkle proofs of an account and of some of its storage slots,
+        against the state root of the last commit; see verify_state_proof
+
+        :param storage_keys: storage slots (ints) to prove
+        :return: (account proof, storage proof), where the storage proof
+                 is a single proof of all the slots against the account's
+                 storage root
+        """
+        address = utils.normalize_address(address)
+        account_proof = self.trie.get_proof(address)
+        rlpdata = self.trie.get(address)
+        if rlpdata == trie.BLANK_NODE or not storage_keys:
+            return account_proof, []
+        root = rlp.decode(rlpdata, Account, env=self.env,
+                          address=address).storage
+        storage_proof = self._mk_storage_trie(root).get_multi_proof(
+            [utils.encode_int32(k) for k in storage_keys])
+        return account_proof, storage_proof
+
+    def flat_storage_changes(self):
+        """storage keys (address + 32 byte slot) whose flat index entries
+        may be stale after the changes made since the last block; slots of
+        wiped storage tries are included"""
+        o = dict(self.changed_storage)
+        for addr, root in self.wiped_storage.items():
+            for k, _ in self._mk_storage_trie(root).iterate():
+                o[addr + k] = True
+        return list(o.keys())
+
+    def _put_flat(self, key, value):
+        # returns the change in the number of index entries
+        existed = key in self.db
+        if value:
+            self.db.put(key, value)
+            return 0 if existed else 1
+        if existed:
+            self.db.delete(key)
+            return -1
+        return 0
+
+    def _flat_size(self):
+        return big_endian_to_int(self.db.get(FLAT_SIZE))
+
+    def write_flat_index(self, addresses, storage_keys):
+        """rewrite the flat index entries of the given accounts and
+        storage slots from the (committed) trie"""
+        size = self._flat_size()
+        accounts = {}
+        for addr in addresses:
+            accounts[addr] = self.trie.get(addr)
+            size += self._put_flat(FLAT_ACCOUNT + addr, accounts[addr])
+        for key in storage_keys:
+            addr = key[:20]
+            if addr not in accounts:
+                accounts[addr] = self.trie.get(addr)
+            if accounts[addr]:
+                root = rlp.decode(accounts[addr], Account,
+                                  env=self.env, address=addr).storage
+                value = self._mk_storage_trie(root).get(key[20:])
+            else:
+                value = b''
+            size += self._put_flat(FLAT_STORAGE + key, value)
+        self.db.put(FLAT_SIZE, utils.encode_int(size))
+        self.db.put(FLAT_ROOT, self.trie.root_hash)
+
+    def _flat_entries(self, root):
+        # the (key, value) flat index entries of the state at `root`
+        for addr, rlpdata in SecureTrie(
+                Trie(RefcountDB(self.db), root)).iterate():
+            yield FLAT_ACCOUNT + addr, rlpdata
+            storage_root = rlp.decode(rlpdata)[2]
+            if storage_root != BLANK_ROOT:
+                for k, v in self._mk_storage_trie(storage_root).iterate():
+                    yield FLAT_STORAGE + addr + k, v
+
+    def rebuild_flat_index(self):
+        """write flat index entries for every account and storage slot,
+        after removing those of the index being replaced"""
+        try:
+            old_root = self.db.get(FLAT_ROOT)
+        except KeyError:
+            old_root = None
+        if old_root not in (None, self.trie.root_hash):
+            try:
+                for key, _ in self._flat_entries(old_root):
+                    if key in self.db:
+                        self.db.delete(key)
+            except KeyError:
+                log_state.warning('flat index state is gone, stale '
+                                  'entries are left', root=old_root)
+        size = 0
+        for key, value in self._flat_entries(self.trie.root_hash):
+            self.db.put(key, value)
+            size += 1
+        self.db.put(FLAT_SIZE, utils.encode_int(size))
+        self.db.put(FLAT_ROOT, self.trie.root_hash)
+
+    def has_flat_index(self):
+        try:
+            return self.db.get(FLAT_ROOT) == self.trie.root_hash and \
+                FLAT_SIZE in self.db
+        except KeyError:
+            return False
+
+    def verify_flat_index(self):
+        """check that every account and storage slot in the trie has a
+        matching flat index entry, and that the index has no others"""
+        if not self.has_flat_index():
+            return False
+        size = 0
+        for key, value in self._flat_entries(self.trie.root_hash):
+            try:
+                if self.db.get(key) != value:
+                    return False
+            except KeyError:
+                return False
+            size += 1
+        return size == self._flat_size()
 
     # Creates a snapshot from a state
     def to_snapshot(self, root_only=False, no_prevblocks=False):
@@ -515,6 +793,30 @@ class State():
         return s
 
 
+def verify_state_proof(state_root, address, account_proof, storage_keys=(),
+                       storage_proof=()):
+    """check proofs made by State.get_proof
+
+    :return: (account, storage): the account as a dict of nonce, balance,
+             storage (root) and code_hash, or None if it does not exist,
+             and a dict mapping each of `storage_keys` to its value
+    :raises trie.InvalidProof: if a proof lacks a node
+    """
+    address = utils.normalize_address(address)
+    rlpdata = securetrie.verify_proof(state_root, address, account_proof)
+    if rlpdata == trie.BLANK_NODE:
+        return None, {k: 0 for k in storage_keys}
+    nonce, balance, root, code_hash = Account._sedes.deserialize(
+        rlp.decode(rlpdata))
+    storage = {}
+    for k in storage_keys:
+        v = securetrie.verify_proof(root, utils.encode_int32(k),
+                                    storage_proof)
+        storage[k] = big_endian_to_int(rlp.decode(v) if v else b'')
+    return dict(nonce=nonce, balance=balance, storage=root,
+                code_hash=code_hash), storage
+
+
 def prev_header_to_dict(h):
     return {
         "hash": '0x' + encode_hex(h.hash),
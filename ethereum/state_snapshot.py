@@ -0,0 +1,297 @@
+import itertools
+import struct
+import rlp
+from rlp.sedes import big_endian_int
+from ethereum import utils
+from ethereum.state import State, Account, BLANK_HASH
+from ethereum import trie
+from ethereum import securetrie
+from ethereum.trie import BLANK_ROOT
+from ethereum.db import RefcountDB, OverlayDB
+from ethereum.slogging import get_logger
+
+log = get_logger('eth.snapshot')
+
+# A state snapshot is a stream of chunks, each a 4 byte big-endian length
+# followed by an RLP list whose first item is the chunk type:
+#   [HEADER, version, state_root]
+#   [CODE, [code, ...]]
+#   [STORAGE, address, [[key, value], ...]]
+#   [ACCOUNTS, [[address, nonce, balance, storage_root, code_hash], ...]]
+#   [END, number_of_accounts]
+# Accounts come in the order of the (hashed) account trie. The storage of
+# an account and any code it introduces come before the ACCOUNTS chunk
+# that holds it; keys and values are those of the storage trie (32 byte
+# slots, RLP encoded values). Every code is written once.
+HEADER, CODE, STORAGE, ACCOUNTS, END = 0, 1, 2, 3, 4
+VERSION = 1
+
+_length = struct.Struct('>I')
+
+
+class InvalidSnapshot(Exception):
+    pass
+
+
+def _write_chunk(f, chunk):
+    data = rlp.encode(chunk)
+    f.write(_length.pack(len(data)))
+    f.write(data)
+
+
+def _read_chunk(f, decode=True):
+    # returns None at the end of the stream; with decode=False the chunk is
+    # skipped and True returned
+    head = f.read(_length.size)
+    if not head:
+        return None
+    if len(head) < _length.size:
+        raise InvalidSnapshot("Truncated chunk length")
+    length, = _length.unpack(head)
+    if not decode:
+        f.seek(length, 1)
+        return True
+    data = f.read(length)
+    if len(data) < length:
+        raise InvalidSnapshot("Truncated chunk")
+    try:
+        return rlp.decode(data)
+    except rlp.DecodingError as e:
+        raise InvalidSnapshot("Malformed chunk: %s" % e)
+
+
+def export_state(state, f, chunk_size=1000):
+    """stream the committed state of `state` (accounts, storage and code)
+    to the binary file object `f`, without holding more than a chunk of
+    it in memory
+
+    :param chunk_size: accounts, or storage slots, per chunk
+    :return: the number of chunks written
+    """
+    root = state.trie.root_hash
+    _write_chunk(f, [HEADER, VERSION, root])
+    chunks = 1
+    accounts, codes, seen_codes = [], [], set()
+    count = 0
+    subtree = None
+    for address, rlpdata in state.trie.iterate():
+        # an ACCOUNTS chunk never spans two subtrees under the root of the
+        # account trie, so that an import can save its progress between
+        # them
+        nibble = _first_nibble(utils.sha3(address))
+        if accounts and nibble != subtree:
+            chunks += _write_accounts(f, accounts, codes)
+            accounts, codes = [], []
+        subtree = nibble
+        nonce, balance, storage_root, code_hash = \
+            Account._sedes.deserialize(rlp.decode(rlpdata))
+        if code_hash != BLANK_HASH and code_hash not in seen_codes:
+            seen_codes.add(code_hash)
+            codes.append(state.db.get(code_hash))
+        if storage_root != BLANK_ROOT:
+            slots = []
+            for slot in state._mk_storage_trie(storage_root).iterate():
+                slots.append(list(slot))
+                if len(slots) == chunk_size:
+                    _write_chunk(f, [STORAGE, address, slots])
+                    chunks += 1
+                    slots = []
+            if slots:
+                _write_chunk(f, [STORAGE, address, slots])
+                chunks += 1
+        accounts.append([address, nonce, balance, storage_root, code_hash])
+        count += 1
+        if len(accounts) == chunk_size:
+            chunks += _write_accounts(f, accounts, codes)
+            accounts, codes = [], []
+    if accounts:
+        chunks += _write_accounts(f, accounts, codes)
+    _write_chunk(f, [END, count])
+    return chunks + 1
+
+
+def _write_accounts(f, accounts, codes):
+    if codes:
+        _write_chunk(f, [CODE, codes])
+    _write_chunk(f, [ACCOUNTS, accounts])
+    return 2 if codes else 1
+
+
+def _first_nibble(key):
+    return bytearray(key[:1])[0] >> 4
+
+
+def _progress_key(root):
+    return b'snapshot-import:' + root
+
+
+# Reads the chunks of a snapshot that follow its header, storing code and
+# building storage tries on the way, and yields (hashed address, account
+# RLP) in the order of the account trie. While an ACCOUNTS chunk is being
+# read, `resume` holds what is needed to read the snapshot again from the
+# start of that chunk: its position and the number of accounts and
+# pending storage roots before it.
+class _AccountReader(object):
+
+    def __init__(self, f, db, position=0, count=0, storage_roots=None):
+        self.f = f
+        self.db = db
+        self.rdb = RefcountDB(db)
+        self.position = position
+        self.count = count
+        # roots of the storage tries whose account has not been seen yet
+        self.storage_roots = storage_roots or {}
+        self.resume = None
+        self.account_chunks = 0
+        # whether the last account yielded is the first of its chunk
+        self.chunk_start = False
+
+    def _chunks(self):
+        while True:
+            chunk = _read_chunk(self.f)
+            if chunk is None:
+                raise InvalidSnapshot("Snapshot ends without an END chunk")
+            self.position += 1
+            yield big_endian_int.deserialize(chunk[0]), chunk
+
+    def _slots(self, chunk, chunks, ahead):
+        # the slots of consecutive STORAGE chunks for the same account; the
+        # chunk after them is left in `ahead`
+        address = chunk[1]
+        while True:
+            for k, v in chunk[2]:
+                if not v:
+                    raise InvalidSnapshot("Empty storage value")
+                yield k, v
+            kind, chunk = next(chunks)
+            if kind != STORAGE or chunk[1] != address:
+                ahead.append((kind, chunk))
+                return
+
+    def __iter__(self):
+        chunks = self._chunks()
+        kind, chunk = next(chunks)
+        while True:
+            if kind == CODE:
+                for code in chunk[1]:
+                    self.db.put(utils.sha3(code), code)
+                kind, chunk = next(chunks)
+            elif kind == STORAGE:
+                ahead = []
+                self.storage_roots[chunk[1]] = securetrie.build_trie(
+                    self.rdb, self._slots(chunk, chunks, ahead))
+                kind, chunk = ahead[0]
+            elif kind == ACCOUNTS:
+                self.account_chunks += 1
+                self.resume = (self.position - 1, self.count,
+                               dict(self.storage_roots))
+                for i, account in enumerate(chunk[1]):
+                    address, nonce, balance, storage_root, code_hash = account
+                    if self.storage_roots.pop(address, BLANK_ROOT) != \
+                            storage_root:
+                        raise InvalidSnapshot(
+                            "Storage root mismatch for %s" % utils.encode_hex(
+                                address))
+                    if code_hash != BLANK_HASH and code_hash not in self.db:
+                        raise InvalidSnapshot(
+                            "Missing code for %s" % utils.encode_hex(address))
+                    h = utils.sha3(address)
+                    self.count += 1
+                    self.chunk_start = i == 0
+                    yield h, rlp.encode(
+                        [nonce, balance, storage_root, code_hash])
+                    # only once the account is taken, as a checkpoint may
+                    # be saved while the first one of a chunk is held
+                    self.rdb.put(h, address)
+                if self.storage_roots:
+                    raise InvalidSnapshot("Storage without an account")
+                kind, chunk = next(chunks)
+            elif kind == END:
+                if big_endian_int.deserialize(chunk[1]) != self.count:
+                    raise InvalidSnapshot("Account count mismatch")
+                return
+            else:
+                raise InvalidSnapshot("Unknown chunk type %d" % kind)
+
+
+def _flush(staged):
+    # write what was staged in the OverlayDB `staged` to its database
+    for key, value in staged.overlay.items():
+        if value is None:
+            staged.db.delete(key)
+        else:
+            staged.db.put(key, value)
+    staged.overlay = {}
+
+
+def import_state(env, f, commit_every=16, resume=True):
+    """rebuild a state written by export_state into env.db
+
+    Tries are built bottom-up (see trie.TrieBuilder), the subtrees under
+    the root of the account trie in TRIE_BUILD_WORKERS processes. The
+    storage root of every account and the final state root are checked
+    against the snapshot. Progress is saved, and the database committed,
+    between two of those subtrees once `commit_every` ACCOUNTS chunks were
+    read since the last time, so that an interrupted import of the same
+    snapshot picks up from there. Everything written in between is staged
+    in memory and only reaches env.db together with the progress, so that
+    an import that is resumed leaves the same database as one that is not.
+
+    :param f: binary file object positioned at the start of the snapshot
+    :param resume: continue a previous import of this snapshot, if any
+    :return: the imported State
+    :raises InvalidSnapshot: if the snapshot is malformed or a root or
+                             the account count does not match
+    """
+    db = env.db
+    header = _read_chunk(f)
+    if header is None or big_endian_int.deserialize(header[0]) != HEADER:
+        raise InvalidSnapshot("Missing snapshot header")
+    if big_endian_int.deserialize(header[1]) != VERSION:
+        raise InvalidSnapshot("Unsupported snapshot version")
+    state_root = header[2]
+    try:
+        progress = db.get(_progress_key(state_root)) if resume else None
+    except KeyError:
+        progress = None
+    if progress:
+        done, count, built, storage_roots = rlp.decode(progress)
+        done, count = big_endian_int.deserialize(done), \
+            big_endian_int.deserialize(count)
+        for _ in range(done):
+            if _read_chunk(f, decode=False) is None:
+                raise InvalidSnapshot("Snapshot shorter than the progress")
+        log.info('resuming snapshot import', chunks=done, accounts=count)
+    else:
+        done, count, built, storage_roots = 0, 0, None, ()
+    staged = OverlayDB(db)
+    reader = _AccountReader(f, staged, done, count, dict(storage_roots))
+    builder = trie.TrieBuilder(
+        RefcountDB(staged), env.config.get('TRIE_BUILD_WORKERS', 0), built)
+    saved = 0
+    first = True
+    for _, group in itertools.groupby(
+            reader, lambda item: _first_nibble(item[0])):
+        # the first account of a new subtree was just read; at the start
+        # of a chunk, all the chunks before it are done with
+        if not first and reader.chunk_start and \
+                reader.account_chunks - 1 - saved >= commit_every:
+            position, count, storage_roots = reader.resume
+            checkpoint = builder.checkpoint()
+            _flush(staged)
+            db.put(_progress_key(state_root), rlp.encode(
+                [position, count, checkpoint, sorted(storage_roots.items())]))
+            db.commit()
+            saved = reader.account_chunks - 1
+        first = False
+        builder.add(group)
+    if builder.root_hash() != state_root:
+        raise InvalidSnapshot("State root mismatch")
+    _flush(staged)
+    db.put(BLANK_HASH, b'')
+    try:
+        db.delete(_progress_key(state_root))
+    except KeyError:
+        pass
+    db.commit()
+    return State(state_root, env)
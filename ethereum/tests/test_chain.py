@@ -10,9 +10,11 @@ import ethereum.pow.ethpow as ethpow
 import ethereum.utils as utils
 from ethereum.pow.chain import Chain
 from ethereum.db import EphemDB
+from ethereum.config import Env, config_metropolis
 from ethereum.tests.utils import new_db
-from ethereum.state import State
-from ethereum.block import Block
+from ethereum.state import State, Account, FLAT_ACCOUNT, FLAT_STORAGE, \
+    FLAT_SIZE
+from ethereum.block import Block, BlockHeader
 from ethereum.consensus_strategy import get_consensus_strategy
 from ethereum.genesis_helpers import mk_basic_state
 from ethereum.tools import tester
@@ -426,6 +428,237 @@ def test_get_blockhash_by_number():
     test_chain.chain.get_blockhash_by_number(2) == test_chain.chain.head.hash
 
 
+def test_recover_senders():
+    k, v, k2, v2 = accounts()
+    txs = [get_transaction(nonce=i) for i in range(4)]
+    txs.append(transactions.Transaction(0, 0, 21000, v, 0, b'').sign(k2))
+    for workers in (0, 2):
+        decoded = [rlp.decode(rlp.encode(tx), transactions.Transaction)
+                   for tx in txs]
+        transactions.recover_senders(decoded, workers)
+        assert [tx._sender for tx in decoded] == [v] * 4 + [v2]
+
+
+def test_mine_block_parallel_sender_recovery(db):
+    k, v, k2, v2 = accounts()
+    chain = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    chain.env.config['SENDER_RECOVERY_WORKERS'] = 2
+    blk = mine_next_block(chain, transactions=[
+        get_transaction(nonce=i) for i in range(3)])
+    assert len(blk.transactions) == 3
+    assert chain.state.get_balance(v2) == utils.denoms.finney * 30
+
+
+def get_storing_contract(nonce=0):
+    # init code: sstore(1, 42)
+    k, v, k2, v2 = accounts()
+    tx = transactions.Transaction(
+        nonce, 0, startgas=100000, to=b'', value=0,
+        data=decode_hex('602a600155')).sign(k)
+    return tx, utils.mk_contract_address(v, nonce)
+
+
+def test_flat_index(db):
+    k, v, k2, v2 = accounts()
+    chain = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    assert chain.state.verify_flat_index()
+    tx, contract = get_storing_contract()
+    mine_next_block(chain, transactions=[tx])
+    mine_next_block(chain, transactions=[get_transaction(nonce=1)])
+    assert chain.state.verify_flat_index()
+    assert chain.db.get(b'changed_storage:' + chain.head_hash) == b''
+    # head reads are served from the flat index
+    acct = chain.state.get_and_cache_account(contract)
+    assert acct.flat_storage is not None
+    assert chain.state.get_storage_data(contract, 1) == 42
+    assert chain.state.get_balance(v2) == utils.denoms.finney * 10
+    # wiped storage is no longer read from the index, also once deleted
+    snapshot = chain.state.snapshot()
+    chain.state.reset_storage(contract)
+    assert chain.state.get_storage_data(contract, 1) == 0
+    chain.state.revert(snapshot)
+    assert chain.state.get_storage_data(contract, 1) == 42
+    chain.state.del_account(contract)
+    assert chain.state.get_storage_data(contract, 1) == 0
+
+
+def test_flat_index_rebuild(db):
+    k, v, k2, v2 = accounts()
+    chain = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    tx, contract = get_storing_contract()
+    mine_next_block(chain, transactions=[tx])
+    # an indexed entry the trie does not have fails verification
+    size = chain.db.get(FLAT_SIZE)
+    chain.db.put(FLAT_ACCOUNT + b'\x11' * 20, chain.db.get(FLAT_ACCOUNT + v))
+    chain.db.put(FLAT_SIZE, utils.encode_int(chain.state._flat_size() + 1))
+    assert not chain.state.verify_flat_index()
+    chain.db.delete(FLAT_ACCOUNT + b'\x11' * 20)
+    chain.db.put(FLAT_SIZE, size)
+    assert chain.state.verify_flat_index()
+    # rebuilding for another state removes the entries of the old one
+    state = chain.mk_poststate_of_blockhash(chain.get_block_by_number(0).hash)
+    assert not state.has_flat_index()
+    state.rebuild_flat_index()
+    assert state.verify_flat_index()
+    assert FLAT_ACCOUNT + contract not in chain.db
+    assert FLAT_STORAGE + contract + utils.encode_int32(1) not in chain.db
+    assert state.get_balance(v) == utils.denoms.ether * 1
+
+
+def test_flat_index_reorg(db):
+    k, v, k2, v2 = accounts()
+    chainR = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    remote_blocks = [mine_next_block(chainR, transactions=[
+        get_transaction(nonce=i)]) for i in range(3)]
+    chainL = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    tx, contract = get_storing_contract()
+    mine_next_block(chainL, transactions=[tx])
+    assert chainL.state.get_storage_data(contract, 1) == 42
+    for blk in remote_blocks:
+        chainL.add_block(rlp.decode(rlp.encode(blk), Block))
+    assert chainL.head == remote_blocks[-1]
+    assert chainL.state.verify_flat_index()
+    # entries written by the abandoned block are gone
+    assert FLAT_ACCOUNT + contract not in chainL.db
+    assert FLAT_STORAGE + contract + utils.encode_int32(1) not in chainL.db
+    assert chainL.state.get_balance(v2) == utils.denoms.finney * 30
+
+
+def test_verify_seals(db, monkeypatch):
+    k, v, k2, v2 = accounts()
+    chainR = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    remote_blocks = [mine_next_block(chainR) for i in range(3)]
+    fields = dict((name, getattr(remote_blocks[0].header, name))
+                  for name, _ in BlockHeader.fields)
+    fields['mixhash'] = b'\x00' * 32
+    bad = BlockHeader(**fields)
+    chain = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    chain.env.config['SEAL_VERIFY_WORKERS'] = 2
+    headers = [blk.header for blk in remote_blocks] + [bad]
+    assert chain.verify_seals(headers) == [True, True, True, False]
+    assert ethpow.check_pows(
+        [(h.number, h.mining_hash, h.mixhash, h.nonce, h.difficulty)
+         for h in headers]) == [True, True, True, False]
+    # verified seals are not checked again, by verify_seals nor add_block
+    monkeypatch.setattr(ethpow, 'check_pow', None)
+    assert chain.verify_seals(headers[:3]) == [True, True, True]
+    for blk in remote_blocks:
+        assert chain.add_block(rlp.decode(rlp.encode(blk), Block))
+    assert chain.head == remote_blocks[-1]
+
+
+def test_state_revert():
+    k, v, k2, v2 = accounts()
+    state = State()
+    state.set_balance(v, 100)
+    state.set_storage_data(v, 1, 2)
+    state.add_log('a')
+    state.commit()
+    snap = state.snapshot()
+    state.set_balance(v, 50)
+    state.set_storage_data(v, 1, 3)
+    state.add_log('b')
+    state.add_refund(7)
+    state.add_suicide(v2)
+    inner = state.snapshot()
+    state.delta_balance(v2, 5)
+    state.add_log('c')
+    state.reset_storage(v)
+    assert state.get_storage_data(v, 1) == 0
+    state.revert(inner)
+    assert state.get_balance(v2) == 0
+    assert state.get_storage_data(v, 1) == 3
+    assert state.logs == ['a', 'b']
+    # replacing a list does not disturb the snapshot taken before
+    state.logs = []
+    state.revert(snap)
+    assert state.get_balance(v) == 100
+    assert state.get_storage_data(v, 1) == 2
+    assert state.logs == ['a']
+    assert state.refunds == 0
+    assert state.suicides == []
+
+
+def test_tester_revert_out_of_order():
+    c = tester.Chain()
+    s1 = c.snapshot()
+    c.tx(to=tester.a1, value=1)
+    receipts = list(c.head_state.receipts)
+    s2 = c.snapshot()
+    c.revert(s1)
+    c.tx(to=tester.a2, value=2, data=b'\x01' * 10)
+    c.revert(s2)
+    assert c.head_state.receipts == receipts
+    assert c.head_state.gas_used == receipts[0].gas_used
+    assert c.head_state.get_balance(tester.a2) == \
+        tester.Chain().head_state.get_balance(tester.a2)
+    c.revert(s1)
+    assert c.head_state.receipts == []
+
+
+def test_compact_accounts_and_headers(db):
+    k, v, k2, v2 = accounts()
+    chain = Chain({v: {"balance": utils.denoms.ether * 1}}, difficulty=1)
+    tx, contract = get_storing_contract()
+    blk = mine_next_block(chain, transactions=[tx])
+    state = chain.state
+    state.cache = {}
+    # balance reads leave the storage trie alone
+    assert state.get_balance(v) > 0
+    assert not state.get_and_cache_account(v).storage_trie_loaded
+    acct = state.get_and_cache_account(contract)
+    assert acct.storage_trie_loaded is False
+    acct.flat_storage = None
+    assert acct.get_storage_data(1) == 42
+    assert acct.storage_trie_loaded
+    assert rlp.decode(rlp.encode(acct), Account, env=state.env,
+                      address=contract).storage == acct.storage
+    # previous headers but the head's are kept in compact form
+    assert state.prev_headers[0] == blk.header
+    assert state.prev_headers[1].hash == chain.genesis.hash
+    assert state.prev_headers[1].number == 0
+    assert not hasattr(state.prev_headers[1], '__dict__')
+    # so a chain started from this state has the right genesis
+    env = Env(EphemDB(), chain.env.config)
+    env.db.db.update((key, value) for key, value in chain.db.db.items()
+                     if key != b'head_hash')
+    state = chain.state.ephemeral_clone()
+    state.env = env
+    chain2 = Chain(state, reset_genesis=True)
+    assert chain2.genesis.hash == chain2.head_hash == blk.hash
+    assert chain2.genesis.header.state_root == blk.header.state_root
+
+
+def test_parallel_storage_commit():
+    results = []
+    for workers in (0, 2):
+        state = State(env=Env(EphemDB(), dict(
+            config_metropolis, STORAGE_COMMIT_WORKERS=workers)))
+        roots = []
+        for r in range(3):
+            for i in range(4):
+                addr = utils.int_to_addr(i + 1)
+                state.set_balance(addr, 1)
+                for k in range(r * 20, r * 20 + 40):
+                    state.set_storage_data(addr, k, (k * (i + r)) % 3)
+            if r == 1:
+                state.reset_storage(utils.int_to_addr(2))
+            state.commit()
+            roots.append(state.trie.root_hash)
+        results.append((roots, dict(state.db.kv), state.deletes))
+    # same roots, same refcounted nodes, same deletes
+    assert results[0] == results[1]
+
+
+def test_process_pools():
+    # asking for another size does not take down a pool in use
+    pool = utils.get_process_pool(2)
+    result = pool.map_async(abs, [-1, -2])
+    assert utils.get_process_pool(3) is not pool
+    assert utils.get_process_pool(2) is pool
+    assert result.get(30) == [1, 2]
+
+
 # TODO ##########################################
 #
 # test for remote block with invalid transaction
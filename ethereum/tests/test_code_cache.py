@@ -0,0 +1,37 @@
+from rlp.utils import decode_hex
+from ethereum import utils
+from ethereum.code_cache import CodeCache, analyze
+from ethereum.db import EphemDB
+
+
+# PUSH2 0x5b5b JUMPDEST PUSH1 0x03 JUMP
+CODE = decode_hex('615b5b5b600356')
+
+
+def test_analyze():
+    a = analyze(CODE)
+    assert [pc for pc in range(len(CODE)) if a.is_jumpdest(pc)] == [3]
+    assert not a.is_jumpdest(2 ** 256)
+    assert a.pushcache == {0: 0x5b5b, 4: 3}
+
+
+def test_lru():
+    cache = CodeCache(max_bytes=2 * len(CODE))
+    codes = [CODE + bytes(bytearray([i])) for i in range(3)]
+    a0 = cache.get(codes[0])
+    assert cache.get(codes[0]) is a0
+    cache.get(codes[1])
+    cache.get(codes[2])
+    assert len(cache.cache) == 1
+    assert cache.get(codes[0]) is not a0
+    assert cache.hits == 1 and cache.misses == 4
+
+
+def test_persist():
+    db = EphemDB()
+    CodeCache(db=db).get(CODE)
+    assert b'analysis:' + utils.sha3(CODE) in db
+    a = CodeCache(db=db)._load(utils.sha3(CODE))
+    b = analyze(CODE)
+    assert (a.codelen, a.jumpdests, a.pushcache) == \
+        (b.codelen, b.jumpdests, b.pushcache)
@@ -1,7 +1,8 @@
 import itertools
 import random
 import pytest
-from ethereum.db import _EphemDB
+from ethereum.db import _EphemDB, SQLiteDB, CachingDB, RefcountDB
+from ethereum.trie import Trie
 from rlp.utils import ascii_chr
 
 random.seed(0)
@@ -35,3 +36,76 @@ def test_ephem():
         assert key not in db
         with pytest.raises(KeyError):
             db.get(key)
+
+
+def test_sqlite(tmpdir):
+    path = str(tmpdir.join('state.db'))
+    db = SQLiteDB(path)
+    for key, value in content.items():
+        db.put(key, value)
+        assert key in db
+        assert db.get(key) == value
+    db.commit()
+    for key in content:
+        db.put(key, alt_content[key])
+    # staged writes are visible locally but not yet on disk
+    assert SQLiteDB(path).get(key) == content[key]
+    db.commit()
+    for key, value in content.items():
+        db.delete(key)
+        assert key not in db
+        with pytest.raises(KeyError):
+            db.get(key)
+    db.revert()
+    db.close()
+    db = SQLiteDB(path)
+    for key in content:
+        assert db.get(key) == alt_content[key]
+    for key in content:
+        db.delete(key)
+    db.commit()
+    db.close()
+    db = SQLiteDB(path)
+    for key in content:
+        assert key not in db
+
+
+def test_caching():
+    backend = _EphemDB()
+    db = CachingDB(backend, max_bytes=4096)
+    for key, value in content.items():
+        db.put(key, value)
+        assert db.get(key) == value
+    assert db.cache_bytes <= 4096
+    for key in content:
+        db.put(key, alt_content[key])
+        assert db.get(key) == alt_content[key]
+    for key in content:
+        db.delete(key)
+        assert key not in db
+
+
+def test_caching_trie_nodes():
+    plain = Trie(RefcountDB(_EphemDB()))
+    cdb = CachingDB(_EphemDB())
+    cached = Trie(RefcountDB(cdb))
+    for key, value in content.items():
+        plain.update(key, value)
+        cached.update(key, value)
+    assert plain.root_hash == cached.root_hash
+    for key, value in content.items():
+        assert cached.get(key) == value
+    assert cdb.hits > 0
+    cached = Trie(RefcountDB(cdb), plain.root_hash)
+    assert cached.to_dict() == plain.to_dict()
+    misses = cdb.misses
+    assert cached.to_dict() == plain.to_dict()
+    assert cdb.misses == misses
+    # dropping the last reference must also drop the cached node
+    rdb = RefcountDB(cdb)
+    node = plain.root_hash
+    while rdb.get_refcount(node) > 0:
+        rdb.delete(node)
+    assert node not in cdb.cache
+    with pytest.raises(KeyError):
+        cdb.get_node(node)
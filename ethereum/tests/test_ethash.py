@@ -0,0 +1,115 @@
+import io
+import threading
+import pytest
+from ethereum import utils
+from ethereum.pow import ethash, ethash_utils
+
+HEADER = utils.sha3(b'header')
+NONCES = [b'\x00' * 8, b'\x01\x02\x03\x04\x05\x06\x07\x08']
+
+
+def test_numpy_small():
+    ethash_numpy = pytest.importorskip('ethereum.pow.ethash_numpy')
+    # caches and datasets far smaller than the real ones, to compare with
+    # the list based implementation in reasonable time
+    for n in (1, 7, 101):
+        cache = ethash._get_cache(b'\x05' * 32, n)
+        array = ethash_numpy._get_cache(b'\x05' * 32, n)
+        assert array.tolist() == cache
+        for i in (0, 5, 1000, 2**31 + 7):
+            assert ethash_numpy.calc_dataset_item(array, i).tolist() == \
+                ethash.calc_dataset_item(cache, i)
+        for nonce in NONCES:
+            expected = ethash.hashimoto(
+                HEADER, nonce, 128 * 1009,
+                lambda x: ethash.calc_dataset_item(cache, x))
+            assert ethash_numpy.hashimoto(
+                HEADER, nonce, 128 * 1009,
+                lambda x: ethash_numpy.calc_dataset_items(array, x)) == \
+                expected
+
+
+def test_against_pyethash():
+    pyethash = pytest.importorskip('pyethash')
+    cache = pyethash.mkcache_bytes(0)
+    expected = [pyethash.hashimoto_light(0, cache, HEADER,
+                                         utils.big_endian_to_int(nonce))
+                for nonce in NONCES]
+    assert ethash.hashimoto_light(
+        0, ethash_utils.ListWrapper(cache), HEADER, NONCES[0]) == expected[0]
+    try:
+        import numpy
+        from ethereum.pow import ethash_numpy
+    except ImportError:
+        return
+    array = numpy.frombuffer(cache, ethash_numpy.WORD).reshape(-1, 16)
+    assert [ethash_numpy.hashimoto_light(0, array, HEADER, nonce)
+            for nonce in NONCES] == expected
+
+
+def test_cache_files(tmpdir, monkeypatch):
+    from collections import OrderedDict
+    from ethereum.pow import ethpow
+    made = []
+
+    def mkcache(block_number):
+        made.append(block_number)
+        size = ethash_utils.get_cache_size(block_number)
+        return ethpow.cache_from_buffer(
+            utils.zpad(utils.encode_int(block_number), 8) +
+            b'\x2a' * (size - 8))
+
+    cache_by_seed = OrderedDict()
+    cache_by_seed.max_items = 2
+    monkeypatch.setattr(ethpow, 'mkcache', mkcache)
+    monkeypatch.setattr(ethpow, 'cache_by_seed', cache_by_seed)
+    monkeypatch.setattr(ethpow, 'cache_dir', str(tmpdir))
+    data = ethpow.cache_to_bytes(ethpow.get_cache(0))
+    assert made == [0] and len(tmpdir.listdir()) == 1
+    # a restart finds the cache on disk
+    cache_by_seed.clear()
+    assert ethpow.cache_to_bytes(ethpow.get_cache(5)) == data
+    assert made == [0]
+    for epoch in range(1, 4):
+        ethpow.get_cache(epoch * ethpow.EPOCH_LENGTH)
+    assert len(cache_by_seed) == 2
+    # close to the end of an epoch, the next cache is made in the
+    # background
+    ethpow.get_cache(5 * ethpow.EPOCH_LENGTH - 1)
+    seed = ethpow.get_seed(5 * ethpow.EPOCH_LENGTH)
+    with ethpow._lock:
+        done = ethpow._generating.get(seed)
+    if done is not None:
+        done.wait()
+    assert seed in cache_by_seed
+    assert made == [0, 30000, 60000, 90000, 149999, 179999]
+
+
+def test_mine():
+    from ethereum.pow import ethpow
+    stats = {}
+    nonce, mixhash = ethpow.mine(1, 100, HEADER, rounds=1000, workers=2,
+                                 stats=stats)
+    assert ethpow.check_pow(1, HEADER, mixhash, nonce, 100)
+    assert 0 < stats['hashes'] <= 1000
+    # the same search in this process finds the solution with the lowest
+    # nonce, which no worker can have skipped
+    first, _ = ethpow.mine(1, 100, HEADER, rounds=1000)
+    assert first <= nonce
+    # a cancelled search gives up
+    cancel = threading.Event()
+    cancel.set()
+    assert ethpow.mine(1, 2**40, HEADER, rounds=10**6, workers=2,
+                       cancel=cancel) == (None, None)
+    assert ethpow.mine(1, 2**40, HEADER, rounds=10**6,
+                       cancel=cancel) == (None, None)
+
+
+def test_mine_full():
+    cache = ethash._get_cache(b'\x05' * 32, 7)
+    f = io.BytesIO()
+    ethash.write_dataset(f, 64 * 64, cache)
+    dataset = ethash.from_buffer(f.getvalue())
+    nonce = ethash.mine(64 * 64, dataset, HEADER, 4)
+    result = ethash.hashimoto_full(dataset, HEADER, ethash.encode_nonce(nonce))
+    assert utils.big_endian_to_int(result[b'result']) <= 2**256 // 4
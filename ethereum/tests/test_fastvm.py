@@ -0,0 +1,112 @@
+import random
+from rlp.utils import decode_hex
+from ethereum import messages, opcodes, utils, vm
+from ethereum.block import FakeHeader
+from ethereum.config import Env, config_metropolis, config_spurious
+from ethereum.fastvm import preprocess_code
+from ethereum.code_cache import analyze
+from ethereum.state import State
+from ethereum.transactions import Transaction
+
+ADDRS = [utils.int_to_addr(0x1000 + i) for i in range(3)]
+
+
+# Runs codes[0] at ADDRS[0], with codes[1:] deployed at ADDRS[1:]
+def run(implementation, config, codes, static=False):
+    config = dict(config, VM_IMPLEMENTATION=implementation)
+    state = State(env=Env(config=config))
+    state.block_number = 5
+    state.prev_headers = [FakeHeader(utils.sha3(utils.to_string(i)))
+                          for i in range(5)]
+    for addr, code in zip(ADDRS, codes):
+        state.set_code(addr, code)
+        state.set_balance(addr, 10 ** 18)
+        state.set_storage_data(addr, 1, 7)
+    state.set_balance(b'\x00' * 20, 10 ** 18)
+    state.commit()
+    ext = messages.VMExt(state, Transaction(0, 1, 10 ** 6, ADDRS[0], 0, b''))
+    msg = vm.Message(b'\x00' * 20, ADDRS[0], 5, 10 ** 6,
+                     vm.CallData(list(range(40))), code_address=ADDRS[0],
+                     static=static)
+    res, gas, data = messages._apply_msg(ext, msg, codes[0])
+    state.commit()
+    return (res, gas, bytes(bytearray(data))), state.to_dict(), \
+        [(l.address, l.topics, l.data) for l in state.logs], state.refunds
+
+
+# mstore(0, 42); revert(0, 32)
+REVERTER = decode_hex('602a60005260206000fd')
+# sstore(0, 1)
+STORER = decode_hex('600160005500')
+# sstore(4, call(0xffff, ADDRS[1], 0, 0, 0, 0, 0))
+# sstore(0, returndatasize); returndatacopy(0, 0, 32); sstore(1, mload(0))
+# sstore(2, staticcall(0xffff, ADDRS[2], 0, 0, 0, 0)); sstore(3, pc)
+CALLER = decode_hex(
+    '60006000600060006000' + '73' + utils.encode_hex(ADDRS[1]) + '61fffff1' +
+    '600455' + '3d600055' + '6020600060003e' + '600051600155' +
+    '6000600060006000' + '73' + utils.encode_hex(ADDRS[2]) + '61fffffa' +
+    '600255' + '58600355' + '00')
+
+
+def test_byzantium_opcodes():
+    out, post, _, _ = run('fastvm', config_metropolis,
+                          [CALLER, REVERTER, STORER])
+    assert out[0] == 1
+    assert out == run('vm', config_metropolis,
+                      [CALLER, REVERTER, STORER])[0]
+    # the reverted call returned 0 with 32 bytes of data, and the static
+    # call failed, leaving slots 2 and 4 empty
+    assert post[utils.encode_hex(ADDRS[0])]['storage'] == {
+        '0x00': '0x20', '0x01': '0x2a', '0x03': '0x5b'}
+    # before byzantium RETURNDATASIZE is an invalid opcode
+    assert run('fastvm', config_spurious, [CALLER, REVERTER, STORER]) == \
+        run('vm', config_spurious, [CALLER, REVERTER, STORER])
+    assert run('fastvm', config_spurious,
+               [CALLER, REVERTER, STORER])[0][0] == 0
+
+
+def test_blocks():
+    # PUSH1 1 PC JUMPDEST PC PUSH1 7 JUMP INVALID JUMPDEST STOP
+    code = decode_hex('6001585b5860075600fe5b00')
+    table = vm.mk_opcode_table(True, True, True, True)
+    blocks = preprocess_code(code, table, analyze(code).pushcache)
+    assert sorted(blocks) == [0, 3, 8, 9, 10]
+    ops, minstack, maxstack, gascost, nextpos = blocks[3]
+    # PC pushes its own offset rather than the block's
+    assert [(op, arg) for op, handler, arg in ops if handler is None] == \
+        [(0x58, 4), (0x60, 7)]
+    assert (minstack, maxstack, gascost, nextpos) == (0, 1022, 14, 8)
+    # the INVALID after JUMP is a block of its own
+    assert blocks[9][0][0][0] == 0xfe
+
+
+def random_program(rng, n):
+    code = bytearray()
+    for _ in range(8):
+        code += bytearray([0x60, rng.randrange(70)])
+    ops = [op for op in opcodes.opcodes if not 0x60 <= op <= 0x7f]
+    for _ in range(n):
+        r = rng.random()
+        if r < 0.35:
+            code += bytearray([0x60, rng.randrange(70)])
+        elif r < 0.4:
+            code.append(0x5b)
+        else:
+            op = rng.choice(ops)
+            for _ in range(opcodes.opcodes[op][1]):
+                code += bytearray([0x60, rng.choice([0, 1, 2, 32, 100])])
+            code.append(op)
+    # sstore(100, x); return(0, 32)
+    code += decode_hex('60645560206000f3')
+    return bytes(code)
+
+
+def test_random_programs():
+    rng = random.Random(42)
+    for i in range(150):
+        codes = [random_program(rng, rng.randrange(1, 40)) for _ in ADDRS]
+        config = rng.choice([config_spurious, config_metropolis])
+        static = rng.random() < 0.1
+        assert run('vm', config, codes, static) == \
+            run('fastvm', config, codes, static), \
+            [utils.encode_hex(c) for c in codes]
@@ -21,3 +21,31 @@ def test_eip150_opcode_gascost():
     assert opcode_gas['CALLCODE'] + opcodes.CALL_SUPPLEMENTAL_GAS == 700
 
     assert opcode_gas['SUICIDE'] + opcodes.SUICIDE_SUPPLEMENTAL_GAS == 5000
+
+
+def test_opcode_tables():
+    from ethereum.vm import mk_opcode_table
+    pre = mk_opcode_table(True, True, True, False)
+    post = mk_opcode_table(True, True, True, True)
+    for opcode in range(256):
+        if opcode not in opcodes.opcodes:
+            assert pre[opcode] is None and post[opcode] is None
+        elif opcode in opcodes.opcodesMetropolis:
+            assert pre[opcode] is None
+            assert post[opcode][0] == opcodes.opcodes[opcode][0]
+        else:
+            assert pre[opcode][:4] == tuple(opcodes.opcodes[opcode])
+
+
+def test_calldata():
+    from ethereum.vm import CallData
+    memory = bytearray(b'\x00\x01\x02\x03\x04\x05')
+    for cd in (CallData(b'\x01\x02\x03'), CallData(memory, 1, 3)):
+        assert cd.extract_all() == b'\x01\x02\x03'
+        assert cd.extract32(1) == 0x0203 << 240
+        assert cd.extract32(3) == 0
+        mem = bytearray(b'\xff' * 6)
+        cd.extract_copy(mem, 1, 2, 4)
+        assert mem == bytearray(b'\xff\x03\x00\x00\x00\xff')
+    # a slice of the caller's memory past its end reads as zeros
+    assert CallData(memory, 4, 4).extract_all() == b'\x04\x05\x00\x00'
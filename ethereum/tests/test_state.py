@@ -12,6 +12,10 @@ if '--trace' in sys.argv:  # not default
     sys.argv.remove('--trace')
 
 checker = new_statetest_utils.verify_state_test
+# run each test under both vm and fastvm and compare them
+if '--compare-vms' in sys.argv:  # not default
+    checker = new_statetest_utils.verify_state_test_implementations
+    sys.argv.remove('--compare-vms')
 place_to_check = 'GeneralStateTests'
 
 
@@ -0,0 +1,113 @@
+import io
+from rlp.utils import decode_hex
+from ethereum import utils
+from ethereum.config import Env, config_metropolis
+from ethereum.messages import apply_transaction
+from ethereum.state import State
+from ethereum.tracer import Tracer, CallTreeTracer, BinaryTraceWriter, \
+    read_binary_trace, STEP, SSTORE, CALL, RETURN
+from ethereum.transactions import Transaction
+
+KEY = utils.sha3(b'cow')
+CALLER = utils.int_to_addr(0x1000)
+CALLEE = utils.int_to_addr(0x1001)
+# sstore(1, call(gas, CALLEE, 0, 0, 0, 0, 0))
+CALLER_CODE = decode_hex(
+    '60006000600060006000' + '73' + utils.encode_hex(CALLEE) + '5af1' +
+    '600155')
+# sstore(2, 3)
+CALLEE_CODE = decode_hex('6003600255')
+
+
+def run(tracer, implementation='vm'):
+    config = dict(config_metropolis, VM_IMPLEMENTATION=implementation)
+    state = State(env=Env(config=config))
+    state.set_balance(utils.privtoaddr(KEY), 10 ** 18)
+    state.set_code(CALLER, CALLER_CODE)
+    state.set_code(CALLEE, CALLEE_CODE)
+    state.commit()
+    tx = Transaction(0, 1, 100000, CALLER, 0, b'').sign(KEY)
+    success, output = apply_transaction(state, tx, tracer)
+    assert success
+
+
+class StepTracer(Tracer):
+
+    def __init__(self):
+        self.steps = []
+
+    def on_step(self, pc, opcode, gas, stack):
+        self.steps.append((pc, opcode, gas, list(stack)))
+
+
+def test_call_tree():
+    tracer = CallTreeTracer()
+    run(tracer)
+    assert len(tracer.calls) == 1
+    top = tracer.calls[0]
+    assert top['to'] == CALLER and top['result'] == 1
+    assert [(c['to'], c['depth'], c['result']) for c in top['calls']] == \
+        [(CALLEE, 1, 1)]
+
+
+def test_steps():
+    tracer = StepTracer()
+    run(tracer)
+    assert [opcode for pc, opcode, gas, stack in tracer.steps][:3] == \
+        [0x60, 0x60, 0x60]
+    assert tracer.steps[-1][3] == [1, 1]
+    # fastvm hands step tracing over to vm, so the trace is identical
+    fast = StepTracer()
+    run(fast, 'fastvm')
+    assert fast.steps == tracer.steps
+
+
+def test_binary_trace():
+    f = io.BytesIO()
+    writer = BinaryTraceWriter(f, stack_items=2)
+    run(writer)
+    f.seek(0)
+    records = list(read_binary_trace(f, stack_items=2))
+    assert len(records) == writer.records
+    kinds = [r[0] for r in records]
+    assert kinds[0] == CALL and kinds[-1] == RETURN
+    assert [r for r in records if r[0] == SSTORE] == \
+        [(SSTORE, CALLEE, 2, 3), (SSTORE, CALLER, 1, 1)]
+    # the last step is the caller's SSTORE with its two arguments
+    steps = [r for r in records if r[0] == STEP]
+    assert steps[-1][2] == 0x55 and steps[-1][5] == [1, 1]
+    # without steps, only calls and storage writes are recorded
+    f = io.BytesIO()
+    run(BinaryTraceWriter(f, steps=False))
+    f.seek(0)
+    assert [r[0] for r in read_binary_trace(f)] == \
+        [CALL, CALL, SSTORE, RETURN, SSTORE, RETURN]
+
+
+def test_create_code_deposit():
+    # init code returning 100 bytes of code, whose deposit costs 20000 gas
+    init = decode_hex('60646000f3')
+    for startgas, result in ((54000, 0), (80000, 1)):
+        state = State(env=Env(config=config_metropolis))
+        state.set_balance(utils.privtoaddr(KEY), 10 ** 18)
+        tracer = CallTreeTracer()
+        tx = Transaction(0, 1, startgas, b'', 0, init).sign(KEY)
+        apply_transaction(state, tx, tracer)
+        top, = tracer.calls
+        assert top['create'] and top['result'] == result
+        assert len(top['output']) == 100 * result
+
+
+def test_binary_trace_large_gas():
+    class Msg(object):
+        depth, is_create, static = 0, False, False
+        sender, to, value, gas = CALLER, CALLEE, 0, 2**70
+
+    f = io.BytesIO()
+    writer = BinaryTraceWriter(f)
+    writer.on_call(Msg)
+    writer.on_step(0, 0x60, 2**64, [])
+    writer.on_return(Msg, 1, 2**80, b'')
+    f.seek(0)
+    assert [r[-1 if r[0] == CALL else 3] for r in read_binary_trace(f)] == \
+        [2**64 - 1] * 3
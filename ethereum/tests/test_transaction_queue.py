@@ -0,0 +1,155 @@
+import random
+import rlp
+from ethereum import utils
+from ethereum.transactions import Transaction
+from ethereum.transaction_queue import TransactionQueue
+
+KEYS = [utils.sha3(name) for name in (b'cow', b'horse', b'pig', b'dog')]
+ADDRS = [utils.privtoaddr(k) for k in KEYS]
+
+
+def mk_tx(key, nonce, gasprice, startgas=21000):
+    return Transaction(nonce, gasprice, startgas, b'\x35' * 20, 0,
+                       b'').sign(key)
+
+
+def pop_all(q, **kwargs):
+    popped = []
+    while True:
+        tx = q.pop_transaction(**kwargs)
+        if tx is None:
+            return popped
+        popped.append((ADDRS.index(tx.sender), tx.nonce))
+
+
+def test_nonce_order():
+    a, b = KEYS[:2]
+    txs = [mk_tx(a, 0, 10), mk_tx(a, 1, 20), mk_tx(a, 2, 30),
+           mk_tx(b, 0, 15)]
+    random.Random(3).shuffle(txs)
+    q = TransactionQueue()
+    for tx in txs:
+        assert q.add_transaction(tx)
+    assert not q.add_transaction(txs[0])
+    assert len(q) == 4
+    assert len(q.peek()) == 2
+    # a sender's later transactions wait for the first, even if dearer
+    assert pop_all(q) == [(1, 0), (0, 0), (0, 1), (0, 2)]
+    assert len(q) == 0
+
+
+def test_nonce_gap():
+    a, b = KEYS[:2]
+    q = TransactionQueue()
+    for tx in (mk_tx(a, 0, 10), mk_tx(a, 2, 30), mk_tx(b, 0, 5)):
+        q.add_transaction(tx)
+    assert pop_all(q) == [(0, 0), (1, 0)]
+    assert len(q) == 1
+    # filling the gap lets it through
+    q.add_transaction(mk_tx(a, 1, 1))
+    assert pop_all(q) == [(0, 1), (0, 2)]
+
+
+def test_account_nonce():
+    a, b = KEYS[:2]
+    nonces = {ADDRS[0]: 3, ADDRS[1]: 0}
+    q = TransactionQueue()
+    for tx in (mk_tx(a, 1, 50), mk_tx(a, 5, 40), mk_tx(a, 6, 40),
+               mk_tx(b, 0, 10), mk_tx(b, 1, 10)):
+        q.add_transaction(tx)
+    # a is at nonce 3: its first transaction is used up, and the others
+    # wait; b's second waits too, as its first did not go through
+    assert pop_all(q, get_nonce=nonces.get) == [(1, 0)]
+    assert len(q) == 3
+    # until the missing ones come
+    q.add_transaction(mk_tx(a, 4, 1))
+    q.add_transaction(mk_tx(a, 3, 1))
+    popped = []
+    while True:
+        tx = q.pop_transaction(get_nonce=nonces.get)
+        if tx is None:
+            break
+        nonces[tx.sender] += 1
+        popped.append((ADDRS.index(tx.sender), tx.nonce))
+    assert popped == [(0, 3), (0, 4), (0, 5), (0, 6)]
+    # the nonces of senders that are gone are not kept
+    assert list(q.next_nonce) == [ADDRS[1]]
+    q.remove_transaction(mk_tx(b, 1, 10).hash)
+    assert len(q) == 0
+    assert q.next_nonce == {}
+
+
+def test_max_gas():
+    a, b = KEYS[:2]
+    q = TransactionQueue()
+    for tx in (mk_tx(a, 0, 30, startgas=50000), mk_tx(a, 1, 40),
+               mk_tx(b, 0, 10)):
+        q.add_transaction(tx)
+    assert pop_all(q, max_gas=30000) == [(1, 0)]
+    assert pop_all(q, max_gas=50000) == [(0, 0), (0, 1)]
+
+
+def test_min_gasprice():
+    a, b = KEYS[:2]
+    q = TransactionQueue()
+    for tx in (mk_tx(a, 0, 30), mk_tx(b, 0, 10)):
+        q.add_transaction(tx)
+    assert pop_all(q, min_gasprice=20) == [(0, 0)]
+    assert len(q) == 1
+
+
+def test_replace_by_fee():
+    a = KEYS[0]
+    q = TransactionQueue()
+    first = mk_tx(a, 0, 100)
+    assert q.add_transaction(first)
+    assert not q.add_transaction(mk_tx(a, 0, 109))
+    replacement = mk_tx(a, 0, 110)
+    assert q.add_transaction(replacement)
+    assert len(q) == 1
+    assert q.get(first.hash) is None
+    assert q.get(replacement.hash) is replacement
+    assert replacement in q
+    assert q.pop_transaction() is replacement
+
+
+def test_eviction():
+    a, b, c, d = KEYS
+    q = TransactionQueue(max_txs=3)
+    for tx in (mk_tx(a, 0, 10), mk_tx(a, 1, 50), mk_tx(b, 0, 20)):
+        assert q.add_transaction(tx)
+    # the cheapest transaction is not taken in
+    assert not q.add_transaction(mk_tx(c, 0, 5))
+    # the cheapest one goes, and with it the one that depends on it
+    assert q.add_transaction(mk_tx(d, 0, 30))
+    assert len(q) == 2
+    assert pop_all(q) == [(3, 0), (1, 0)]
+    # forced transactions stay
+    tx = mk_tx(a, 0, 1)
+    q = TransactionQueue(max_bytes=len(rlp.encode(tx)))
+    assert q.add_transaction(tx, force=True)
+    assert q.add_transaction(mk_tx(b, 0, 1000)) is False
+    assert q.pop_transaction() is tx
+
+
+def test_diff():
+    a, b = KEYS[:2]
+    txs = [mk_tx(a, i, 10) for i in range(4)] + [mk_tx(b, 0, 20)]
+    q = TransactionQueue()
+    for tx in txs:
+        q.add_transaction(tx)
+    # a block with a replacement for a's second transaction
+    q2 = q.diff([txs[0], mk_tx(a, 1, 11)])
+    assert len(q) == 5
+    assert len(q2) == 3
+    assert txs[1] not in q2
+    assert pop_all(q2) == [(1, 0), (0, 2), (0, 3)]
+    # unsigned transactions do not have nonces taken into account
+    votes = [Transaction(0, 0, 21000, b'\x35' * 20, 0, data)
+             for data in (b'a', b'b', b'c')]
+    q = TransactionQueue()
+    for tx in votes:
+        assert q.add_transaction(tx)
+    q2 = q.diff(votes[1:2])
+    assert [tx.data for tx in (q2.pop_transaction(), q2.pop_transaction())] \
+        == [b'a', b'c']
@@ -66,6 +66,31 @@ def test_transaction(filename, testname, testdata):
                 ''))
 
 
+def test_recovery_cache():
+    from ethereum.specials import proc_ecrecover
+    from ethereum.vm import Message, CallData
+    k = utils.sha3(b'cow')
+    tx = transactions.Transaction(0, 0, 21000, b'\x00' * 20, 0, b'').sign(k)
+    rlpdata = rlp.encode(tx)
+    utils.recovery_cache.clear()
+    assert rlp.decode(rlpdata, transactions.Transaction).sender == \
+        utils.privtoaddr(k)
+    assert utils.recovery_cache.misses == 1
+    assert rlp.decode(rlpdata, transactions.Transaction).sender == \
+        utils.privtoaddr(k)
+    assert utils.recovery_cache.hits == 1
+    # the ecrecover precompile shares the cache
+    sighash = utils.sha3(rlp.encode(tx, transactions.UnsignedTransaction))
+    data = sighash + utils.encode_int32(tx.v) + utils.encode_int32(tx.r) + \
+        utils.encode_int32(tx.s)
+    msg = Message(None, None, 0, 10000, CallData(
+        [utils.safe_ord(x) for x in data]))
+    success, gas, out = proc_ecrecover(None, msg)
+    assert success and bytes(bytearray(out[12:])) == utils.privtoaddr(k)
+    assert utils.recovery_cache.hits == 2
+    assert utils.recovery_cache.hit_rate == 2 / 3.
+
+
 def pytest_generate_tests(metafunc):
     testutils.generate_test_params('TransactionTests', metafunc)
 
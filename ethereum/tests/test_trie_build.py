@@ -0,0 +1,111 @@
+import random
+from ethereum import trie
+from ethereum.db import EphemDB, RefcountDB
+
+rng = random.Random(4)
+
+
+def random_bytes(length):
+    return bytes(bytearray(rng.randint(0, 255) for _ in range(length)))
+
+
+def random_items():
+    keys = [random_bytes(rng.choice([0, 1, 2, 32]))
+            for _ in range(rng.choice([1, 2, 60]))]
+    # keys that are prefixes of others end up as branch values
+    keys += [k[:rng.randint(0, len(k))] for k in keys[:5]]
+    items = dict((k, random_bytes(rng.randint(1, 40))) for k in keys)
+    return sorted(items.items())
+
+
+def test_build_trie():
+    assert trie.build_trie(EphemDB(), []) == trie.BLANK_ROOT
+    for i in range(60):
+        items = random_items()
+        db = EphemDB()
+        t = trie.Trie(RefcountDB(db))
+        t.update_many(items)
+        built = EphemDB()
+        workers = 2 if i % 10 == 0 else 0
+        assert trie.build_trie(RefcountDB(built), items, workers) == \
+            t.root_hash
+        # the same nodes, with the same reference counts
+        assert built.db == db.db
+
+
+def test_builder_checkpoint():
+    items = sorted((random_bytes(32), random_bytes(5)) for _ in range(200))
+    expected = trie.build_trie(EphemDB(), items)
+    groups = [[kv for kv in items if bytearray(kv[0])[0] >> 4 == n]
+              for n in range(16)]
+    db = EphemDB()
+    builder = trie.TrieBuilder(db)
+    for group in groups[:7]:
+        builder.add(group)
+    # a new builder carries on from the subtrees done so far
+    builder = trie.TrieBuilder(db, checkpoint=builder.checkpoint())
+    for group in groups[7:]:
+        builder.add(group)
+    assert builder.root_hash() == expected
+    assert trie.Trie(db, expected).to_dict() == dict(items)
+
+
+def genesis_via_state(genesis_data, env, block, allow_empties):
+    # what state_from_genesis_declaration did before building tries
+    # bottom-up: set every account on a State and commit it
+    from ethereum.consensus_strategy import get_consensus_strategy
+    from ethereum.state import State
+    from ethereum.utils import normalize_address, parse_as_int, \
+        parse_as_bin, big_endian_to_int
+    state = State(env=env)
+    for addr, data in genesis_data['alloc'].items():
+        addr = normalize_address(addr)
+        if 'wei' in data:
+            state.set_balance(addr, parse_as_int(data['wei']))
+        if 'balance' in data:
+            state.set_balance(addr, parse_as_int(data['balance']))
+        if 'code' in data:
+            state.set_code(addr, parse_as_bin(data['code']))
+        if 'nonce' in data:
+            state.set_nonce(addr, parse_as_int(data['nonce']))
+        for k, v in data.get('storage', {}).items():
+            state.set_storage_data(addr, big_endian_to_int(parse_as_bin(k)),
+                                   big_endian_to_int(parse_as_bin(v)))
+    get_consensus_strategy(state.config).initialize(state, block)
+    state.commit(allow_empties=allow_empties)
+    return state
+
+
+def test_genesis_alloc():
+    from ethereum.config import Env, default_config
+    from ethereum.genesis_helpers import mk_genesis_data, \
+        block_from_genesis_declaration, state_from_genesis_declaration
+    alloc = {}
+    for i in range(40):
+        data = {}
+        for field in rng.sample(['wei', 'balance', 'code', 'nonce',
+                                 'storage'], rng.randint(0, 3)):
+            if field == 'code':
+                data[field] = '0x' + '60' * rng.randint(0, 2)
+            elif field == 'storage':
+                data[field] = dict(('0x%02x' % rng.randint(0, 5),
+                                    '0x%02x' % rng.randint(0, 2))
+                                   for _ in range(rng.randint(0, 3)))
+            else:
+                data[field] = str(rng.choice([0, 1, 10 ** 20]))
+        alloc['%040x' % (i + 1)] = data
+    alloc['%040x' % 100] = {'balance': '0'}
+    config = dict(default_config, SPURIOUS_DRAGON_FORK_BLKNUM=3)
+    genesis_data = mk_genesis_data(Env(EphemDB(), config), start_alloc=alloc)
+    # on both sides of the fork, which decides whether empty accounts stay
+    for number in (0, 2, 3, 5):
+        for allow_empties in (False, True):
+            roots = []
+            for make in (genesis_via_state, state_from_genesis_declaration):
+                block = block_from_genesis_declaration(
+                    genesis_data, Env(EphemDB(), config))
+                block.header.number = number
+                roots.append(make(genesis_data, Env(EphemDB(), config),
+                                  block=block, allow_empties=allow_empties
+                                  ).trie.root_hash)
+            assert roots[0] == roots[1]
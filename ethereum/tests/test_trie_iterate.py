@@ -0,0 +1,59 @@
+import random
+from ethereum import trie
+from ethereum.db import EphemDB
+from ethereum.securetrie import SecureTrie
+
+rng = random.Random(2)
+
+
+def random_bytes(length):
+    return bytes(bytearray(rng.randint(0, 255) for _ in range(length)))
+
+
+def random_trie():
+    keys = [random_bytes(rng.choice([1, 2, 32]))
+            for _ in range(rng.randint(0, 60))]
+    # keys that are prefixes of others end up as branch values
+    keys += [k[:rng.randint(1, len(k))] for k in keys[:5]]
+    items = dict((k, random_bytes(rng.randint(1, 40))) for k in keys)
+    t = trie.Trie(EphemDB())
+    t.update_many(items.items())
+    return t, sorted(items.items())
+
+
+def test_iterate_range():
+    for _ in range(50):
+        t, items = random_trie()
+        assert list(t.iterate()) == items
+        assert t.to_dict() == dict(items)
+        for _ in range(5):
+            start = random_bytes(rng.randint(0, 2))
+            end = rng.choice([None, random_bytes(rng.randint(1, 2))])
+            limit = rng.choice([None, 1, 10])
+            expected = [(k, v) for k, v in items
+                        if k >= start and (end is None or k < end)]
+            assert list(t.iterate(start, end, limit)) == expected[:limit]
+
+
+def test_iterate_pages():
+    for _ in range(20):
+        t, items = random_trie()
+        token, seen = None, []
+        while True:
+            page, token = t.iterate_page(token, limit=4)
+            assert len(page) <= 4
+            seen += page
+            if token is None:
+                break
+        assert seen == items
+
+
+def test_secure_trie_pages():
+    t = SecureTrie(trie.Trie(EphemDB()))
+    for i in range(30):
+        t.update(b'key %d' % i, b'value %d' % i)
+    page, token = t.iterate_page(limit=20)
+    rest, token2 = t.iterate_page(token, limit=20)
+    assert token2 is None
+    assert dict(page + rest) == t.to_dict()
+    assert len(t.to_dict()) == 30
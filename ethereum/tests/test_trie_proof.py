@@ -0,0 +1,76 @@
+import random
+import pytest
+from ethereum import trie, utils
+from ethereum.config import Env
+from ethereum.db import EphemDB, RefcountDB
+from ethereum.securetrie import SecureTrie, verify_proof
+from ethereum.state import State, verify_state_proof
+
+rng = random.Random(1)
+
+
+def random_bytes(length):
+    return bytes(bytearray(rng.randint(0, 255) for _ in range(length)))
+
+
+def test_proofs():
+    for _ in range(30):
+        t = trie.Trie(RefcountDB(EphemDB()))
+        items = dict((random_bytes(rng.choice([1, 2, 32])),
+                      random_bytes(rng.randint(1, 40)))
+                     for _ in range(rng.randint(0, 60)))
+        t.update_many(items.items())
+        absent = [random_bytes(32) for _ in range(5)]
+        for k in list(items)[:10] + absent:
+            proof = t.get_proof(k)
+            assert trie.verify_proof(t.root_hash, k, proof) == \
+                items.get(k, b'')
+            # every node of the proof is needed
+            if proof:
+                with pytest.raises(trie.InvalidProof):
+                    trie.verify_proof(t.root_hash, k, proof[:-1])
+        # a multi-key proof shares the nodes near the root
+        keys = list(items)[:10] + absent
+        proof = t.get_multi_proof(keys)
+        assert len(proof) == len(set(proof))
+        assert len(proof) <= sum(len(t.get_proof(k)) for k in keys)
+        for k in keys:
+            assert trie.verify_proof(t.root_hash, k, proof) == \
+                items.get(k, b'')
+
+
+def test_tampered_proof():
+    t = SecureTrie(trie.Trie(EphemDB()))
+    for i in range(20):
+        t.update(utils.encode_int32(i), b'value %d' % i)
+    proof = t.get_proof(utils.encode_int32(3))
+    assert verify_proof(t.root_hash, utils.encode_int32(3), proof) == \
+        b'value 3'
+    leaf = proof[-1].replace(b'value 3', b'value 4')
+    with pytest.raises(trie.InvalidProof):
+        verify_proof(t.root_hash, utils.encode_int32(3), proof[:-1] + [leaf])
+
+
+def test_state_proof():
+    state = State(env=Env(EphemDB()))
+    addr = utils.int_to_addr(0x1234)
+    state.set_balance(addr, 10 ** 18)
+    state.set_nonce(addr, 3)
+    for k in range(50):
+        state.set_storage_data(addr, k, k * 7)
+    for i in range(30):
+        state.set_balance(utils.int_to_addr(i), i)
+    state.commit()
+    root = state.trie.root_hash
+    account_proof, storage_proof = state.get_proof(addr, [1, 2, 49, 1000])
+    account, storage = verify_state_proof(
+        root, addr, account_proof, [1, 2, 49, 1000], storage_proof)
+    assert account['balance'] == 10 ** 18 and account['nonce'] == 3
+    assert storage == {1: 7, 2: 14, 49: 343, 1000: 0}
+    # and of an account that does not exist
+    missing = utils.int_to_addr(0x9999)
+    account, storage = verify_state_proof(
+        root, missing, state.get_proof(missing)[0])
+    assert account is None
+    with pytest.raises(trie.InvalidProof):
+        verify_state_proof(root, addr, account_proof[:1])
@@ -0,0 +1,95 @@
+import random
+from ethereum import trie
+from ethereum.db import EphemDB, RefcountDB
+from ethereum.securetrie import SecureTrie
+from ethereum.utils import decode_hex
+
+random.seed(0)
+
+
+def random_bytes(length):
+    return bytes(bytearray(random.randint(0, 255) for _ in range(length)))
+
+
+def test_known_root():
+    t = trie.Trie(EphemDB())
+    t.update_many([(b'doe', b'reindeer'), (b'dog', b'puppy'),
+                   (b'dogglesworth', b'cat')])
+    assert t.root_hash == decode_hex(
+        '8aad789dff2f538bca5d8ea56e8abe10f4c7ba3a5dea95fea4cd6e7c3a1168d3')
+
+
+def test_matches_sequential():
+    for _ in range(50):
+        keys = [random_bytes(random.choice([1, 2, 32]))
+                for _ in range(random.randint(1, 40))]
+        base = [(k, random_bytes(random.randint(1, 40))) for k in keys]
+        ops = [(random.choice(keys + [b'\x00']),
+                None if random.random() < 0.3 else random_bytes(20))
+               for _ in range(random.randint(0, 30))]
+        t1 = trie.Trie(RefcountDB(EphemDB()))
+        t2 = trie.Trie(RefcountDB(EphemDB()))
+        for k, v in base:
+            t1.update(k, v)
+        t2.update_many(base)
+        assert t1.root_hash == t2.root_hash
+        for k, v in ops:
+            if v is None:
+                t1.delete(k)
+            else:
+                t1.update(k, v)
+        t2.update_many(ops)
+        assert t1.root_hash == t2.root_hash
+        assert t1.to_dict() == t2.to_dict()
+        # only final nodes were written, and scheduled deletes all exist
+        assert len(t2.db.db.db) <= len(t1.db.db.db)
+        for h in t2.deletes:
+            assert h in t2.db
+
+
+def test_delete_many():
+    t = trie.Trie(EphemDB())
+    items = [(random_bytes(32), random_bytes(32)) for _ in range(20)]
+    t.update_many(items)
+    t.delete_many([k for k, v in items])
+    assert t.root_hash == trie.BLANK_ROOT
+
+
+def test_secure_trie():
+    t1 = SecureTrie(trie.Trie(EphemDB()))
+    t2 = SecureTrie(trie.Trie(EphemDB()))
+    items = [(random_bytes(20), random_bytes(10)) for _ in range(20)]
+    for k, v in items:
+        t1.update(k, v)
+    t2.update_many(items)
+    assert t1.root_hash == t2.root_hash
+    assert t2.to_dict() == dict(items)
+    t2.delete_many([k for k, v in items[:10]])
+    assert t2.to_dict() == dict(items[10:])
+
+
+def test_write_back():
+    keys = [random_bytes(32) for _ in range(50)]
+    t1 = trie.Trie(RefcountDB(EphemDB()))
+    t2 = trie.Trie(RefcountDB(EphemDB()), write_back=True)
+    for i, k in enumerate(keys):
+        v = random_bytes(8) if i % 2 else k
+        t1.update(k, v)
+        t2.update(k, v)
+        if i % 3 == 0:
+            t1.delete(keys[i // 2])
+            t2.delete(keys[i // 2])
+    # nothing but the initial blank root hits the db before commit
+    assert len(t2.db.db.db) <= 1
+    assert t2.get(keys[-1]) == t1.get(keys[-1])
+    assert t1.root_hash == t2.root_hash
+    assert len(t2.db.db.db) < len(t1.db.db.db)
+    assert not t2.deletes
+    t3 = trie.Trie(t2.db, t2.root_hash)
+    assert t3.to_dict() == t1.to_dict()
+    # after a commit, replaced nodes are scheduled for deletion again
+    t2.update(keys[0], b'x')
+    t2.commit()
+    assert t2.deletes
+    for h in t2.deletes:
+        assert h in t2.db
@@ -190,3 +190,41 @@ def verify_state_test(test):
                     print(k, computed["diff"][k])
                 print("Hash matched!: %s" % computed["hash"])
     return True
+
+
+# Differential check: run every unit of a state test under each of the
+# given VM implementations, and verify that they agree with each other as
+# well as with the expected post state
+
+
+def verify_state_test_implementations(test, implementations=('vm', 'fastvm')):
+    print("Comparing VM implementations on state test")
+    if "env" not in test:
+        raise EnvNotFoundException("Env not found")
+    _state = init_state(test["env"], test["pre"])
+    for config_name, results in test["post"].items():
+        # Old protocol versions may not be supported
+        if config_name not in configs:
+            continue
+        for result in results:
+            computed = []
+            for implementation in implementations:
+                konfig = copy.copy(configs[config_name])
+                konfig['VM_IMPLEMENTATION'] = implementation
+                computed.append(compute_state_test_unit(
+                    _state, test["transaction"], result["indexes"], konfig))
+            for implementation, c in zip(implementations[1:], computed[1:]):
+                if c["hash"] != computed[0]["hash"]:
+                    for k in c["diff"]:
+                        print(implementation, k, c["diff"][k])
+                    for k in computed[0]["diff"]:
+                        print(implementations[0], k, computed[0]["diff"][k])
+                    raise Exception(
+                        "VM implementations disagree (indexes %r): %s %s, %s %s" %
+                        (result["indexes"], implementations[0],
+                         computed[0]["hash"], implementation, c["hash"]))
+            if computed[0]["hash"][-64:] != result["hash"][-64:]:
+                raise Exception(
+                    "Hash mismatch, computed: %s, supplied: %s" %
+                    (computed[0]["hash"], result["hash"]))
+    return True
@@ -0,0 +1,137 @@
+import struct
+from ethereum import utils
+
+
+# Base class for VM tracers. Pass an instance to apply_transaction (or
+# VMExt) to observe execution; every hook that is left as None is never
+# called, so a tracer only pays for what it asks for, and execution
+# without a tracer pays nothing.
+class Tracer(object):
+
+    # on_step(pc, opcode, gas, stack) is called before each opcode runs,
+    # with the gas left before its fee. `stack` is the live stack (top
+    # last); copy it if you need to keep it. Tracing steps makes fastvm
+    # fall back to vm, so that gas is reported per opcode.
+    on_step = None
+
+    # on_sstore(address, key, value) is called for every SSTORE that is
+    # about to be written
+    on_sstore = None
+
+    # on_call(msg) is called when a message (a transaction, a call of any
+    # kind or a contract creation) starts executing
+    on_call = None
+
+    # on_return(msg, result, gas, data) is called when it finishes, with
+    # result 0 if it failed or reverted
+    on_return = None
+
+
+# Records the tree of messages and nothing else
+class CallTreeTracer(Tracer):
+
+    def __init__(self):
+        # top-level messages, as dicts with their sub-calls under 'calls'
+        self.calls = []
+        self._stack = []
+
+    def on_call(self, msg):
+        call = dict(sender=msg.sender, to=msg.to, value=msg.value,
+                    gas=msg.gas, depth=msg.depth, create=msg.is_create,
+                    static=msg.static, calls=[])
+        if self._stack:
+            self._stack[-1]['calls'].append(call)
+        else:
+            self.calls.append(call)
+        self._stack.append(call)
+
+    def on_return(self, msg, result, gas, data):
+        call = self._stack.pop()
+        call['result'] = result
+        call['gas_used'] = call['gas'] - gas
+        call['output'] = bytes(bytearray(data))
+
+
+STEP, SSTORE, CALL, RETURN = b'S', b'W', b'C', b'R'
+
+_step = struct.Struct('>IBQH')
+_call = struct.Struct('>HB20s20s32sQ')
+_return = struct.Struct('>HBQI')
+TT64M1 = 2**64 - 1
+
+
+# Writes a compact binary trace to a file-like object. Each record is a
+# one-byte type followed by fixed-width big-endian fields; gas amounts of
+# 2**64 or more are written as 2**64 - 1:
+#   STEP   pc:u32 opcode:u8 gas:u64 stack_height:u16, then the top
+#          `stack_items` stack words, 32 bytes each, topmost first
+#   SSTORE address:20 key:32 value:32
+#   CALL   depth:u16 flags:u8 (1: create, 2: static) sender:20 to:20
+#          value:32 gas:u64
+#   RETURN depth:u16 result:u8 gas:u64 output_length:u32
+class BinaryTraceWriter(Tracer):
+
+    def __init__(self, f, steps=True, stack_items=0):
+        """
+        :param f: file-like object opened for binary writing
+        :param steps: also record every opcode, not just calls and SSTOREs
+        :param stack_items: number of top stack words to record per step
+        """
+        self.f = f
+        self.stack_items = stack_items
+        self.records = 0
+        if steps:
+            self.on_step = self._on_step
+
+    def _on_step(self, pc, opcode, gas, stack):
+        self.f.write(STEP + _step.pack(pc, opcode, min(gas, TT64M1),
+                                       len(stack)))
+        for i in range(1, min(self.stack_items, len(stack)) + 1):
+            self.f.write(utils.encode_int32(stack[-i]))
+        self.records += 1
+
+    def on_sstore(self, address, key, value):
+        self.f.write(SSTORE + address + utils.encode_int32(key) +
+                     utils.encode_int32(value))
+        self.records += 1
+
+    def on_call(self, msg):
+        flags = (1 if msg.is_create else 0) | (2 if msg.static else 0)
+        self.f.write(CALL + _call.pack(
+            msg.depth, flags, msg.sender, msg.to or b'\x00' * 20,
+            utils.encode_int32(msg.value), min(msg.gas, TT64M1)))
+        self.records += 1
+
+    def on_return(self, msg, result, gas, data):
+        self.f.write(RETURN + _return.pack(
+            msg.depth, 1 if result else 0, min(gas, TT64M1), len(data)))
+        self.records += 1
+
+
+def read_binary_trace(f, stack_items=0):
+    """yields the records written by a BinaryTraceWriter as tuples whose
+    first element is the record type
+
+    :param stack_items: the value the writer was created with
+    """
+    while True:
+        kind = f.read(1)
+        if not kind:
+            return
+        if kind == STEP:
+            pc, opcode, gas, height = _step.unpack(f.read(_step.size))
+            stack = [utils.big_endian_to_int(f.read(32))
+                     for _ in range(min(stack_items, height))]
+            yield (STEP, pc, opcode, gas, height, stack)
+        elif kind == SSTORE:
+            yield (SSTORE, f.read(20), utils.big_endian_to_int(f.read(32)),
+                   utils.big_endian_to_int(f.read(32)))
+        elif kind == CALL:
+            depth, flags, sender, to, value, gas = \
+                _call.unpack(f.read(_call.size))
+            yield (CALL, depth, flags, sender, to,
+                   utils.big_endian_to_int(value), gas)
+        elif kind == RETURN:
+            yield (RETURN,) + _return.unpack(f.read(_return.size))
+        else:
+            raise ValueError("Unknown trace record type %r" % kind)
@@ -1,6 +1,17 @@
 import heapq
+import rlp
+from ethereum import utils
+from ethereum.exceptions import InvalidTransaction
+from ethereum.transactions import null_address
 heapq.heaptop = lambda x: x[0]
 PRIO_INFINITY = -2**100
+# Default limits of a TransactionQueue: the number of transactions, and
+# the total size of their RLP encodings
+MAX_TXS = 65536
+MAX_BYTES = 64 * 1024 * 1024
+# Percentage by which a transaction must outbid the one it replaces, from
+# the same sender with the same nonce
+PRICE_BUMP = 10
 
 
 class OrderableTx(object):
@@ -19,51 +30,286 @@ class OrderableTx(object):
             return False
 
 
+# A transaction in a TransactionQueue. Transactions are queued by `key`:
+# their sender or, for unsigned ones (such as Casper votes, which all come
+# from the null sender with nonce 0), their own hash, so that those are
+# neither ordered by nonce nor replace each other.
+class _PooledTx(OrderableTx):
+
+    def __init__(self, prio, counter, tx, txhash, key, size):
+        super(_PooledTx, self).__init__(prio, counter, tx)
+        self.hash = txhash
+        self.key = key
+        self.size = size
+        # whether this is the next transaction of its sender, and whether
+        # it is in the heap of those, where it may stay once it no longer
+        # is, until it comes up
+        self.head = False
+        self.in_heap = False
+
+
+# Holds transactions in nonce order per sender. Only the next transaction
+# of each sender is in `txs`, the heap by gasprice that blocks are filled
+# from, so that the transactions of a sender come out in nonce order; once
+# one is popped, the one with the following nonce takes its place.
+# `by_hash` indexes all the transactions held. Beyond max_txs
+# transactions or max_bytes bytes, the cheapest ones are evicted, with
+# the ones after them from the same sender.
 class TransactionQueue():
 
-    def __init__(self):
+    def __init__(self, max_txs=MAX_TXS, max_bytes=MAX_BYTES,
+                 price_bump=PRICE_BUMP):
         self.counter = 0
         self.txs = []
+        # (startgas, counter, tx) of the next transactions of senders that
+        # were too big for the gas left when popping
         self.aside = []
+        self.by_hash = {}
+        # key -> {nonce: tx}
+        self.queues = {}
+        # key -> next transaction
+        self.heads = {}
+        # key -> nonce following the last transaction popped, or the
+        # account nonce last seen, for senders with queued transactions
+        self.next_nonce = {}
+        # (gasprice, -counter, tx) of all the transactions not forced in,
+        # including some that are no longer held
+        self.cheapest = []
+        self.size = 0
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.price_bump = price_bump
 
     def __len__(self):
-        return len(self.txs)
+        return len(self.by_hash)
+
+    def __contains__(self, tx):
+        return tx.hash in self.by_hash
+
+    def get(self, txhash):
+        pooled = self.by_hash.get(txhash)
+        return pooled.tx if pooled is not None else None
 
     def add_transaction(self, tx, force=False):
-        prio = PRIO_INFINITY if force else -tx.gasprice
-        heapq.heappush(self.txs, OrderableTx(prio, self.counter, tx))
+        """add `tx` to the queue
+
+        A transaction with the same sender and nonce as one already there
+        replaces it if its gasprice is at least price_bump percent higher.
+
+        :param force: let the transaction come before all others, and
+                      never evict it
+        :returns: whether the transaction was added; not if it is already
+                  there, has an invalid signature, does not outbid the one
+                  it would replace or is the first to be evicted
+        """
+        data = rlp.encode(tx)
+        txhash = utils.sha3(data)
+        if txhash in self.by_hash:
+            return False
+        try:
+            sender = tx.sender
+        except (InvalidTransaction, AssertionError):
+            return False
+        key = txhash if sender == null_address else sender
+        queue = self.queues.get(key)
+        old = queue.get(tx.nonce) if queue else None
+        if old is not None:
+            if old.prio == PRIO_INFINITY and not force or \
+                    tx.gasprice * 100 < old.tx.gasprice * \
+                    (100 + self.price_bump):
+                return False
+            self._remove(old)
+        pooled = _PooledTx(PRIO_INFINITY if force else -tx.gasprice,
+                           self.counter, tx, txhash, key, len(data))
         self.counter += 1
+        self._insert(pooled)
+        self._evict()
+        return self.by_hash.get(txhash) is pooled
+
+    def remove_transaction(self, txhash):
+        """remove the transaction with hash `txhash`, if it is there; the
+        transactions after it from the same sender stay queued
+
+        :returns: whether it was there
+        """
+        pooled = self.by_hash.get(txhash)
+        if pooled is None:
+            return False
+        self._remove(pooled)
+        return True
+
+    def _insert(self, pooled):
+        self.by_hash[pooled.hash] = pooled
+        self.size += pooled.size
+        queue = self.queues.setdefault(pooled.key, {})
+        queue[pooled.tx.nonce] = pooled
+        if pooled.prio != PRIO_INFINITY:
+            heapq.heappush(self.cheapest,
+                           (pooled.tx.gasprice, -pooled.counter, pooled))
+            if len(self.cheapest) > 2 * len(self.by_hash) + 64:
+                self.cheapest = [item for item in self.cheapest
+                                 if self.by_hash.get(item[2].hash) is
+                                 item[2]]
+                heapq.heapify(self.cheapest)
+        head = self.heads.get(pooled.key)
+        if head is None or pooled.tx.nonce < head.tx.nonce:
+            self._update_head(pooled.key)
+
+    def _remove(self, pooled):
+        del self.by_hash[pooled.hash]
+        self.size -= pooled.size
+        queue = self.queues[pooled.key]
+        del queue[pooled.tx.nonce]
+        if not queue:
+            del self.queues[pooled.key]
+            self.next_nonce.pop(pooled.key, None)
+        if pooled.head:
+            self._update_head(pooled.key)
+
+    def _update_head(self, key):
+        # the next transaction of a sender is the one following the last
+        # popped, if any was, else the one with the lowest nonce
+        queue = self.queues.get(key)
+        head = None
+        if queue:
+            nonce = self.next_nonce.get(key)
+            head = queue.get(min(queue) if nonce is None else nonce)
+        current = self.heads.get(key)
+        if current is head:
+            return
+        if current is not None:
+            current.head = False
+            del self.heads[key]
+        if head is None:
+            return
+        self.heads[key] = head
+        head.head = True
+        if not head.in_heap:
+            head.in_heap = True
+            heapq.heappush(self.txs, head)
+            if len(self.txs) > 2 * len(self.heads) + 64:
+                for pooled in self.txs:
+                    pooled.in_heap = pooled.head
+                self.txs = [pooled for pooled in self.txs if pooled.head]
+                heapq.heapify(self.txs)
+
+    def _skip_to(self, key, nonce):
+        # the account of `key` is at `nonce`: drop the transactions that
+        # nonce used up and wait for the one with that nonce
+        self.next_nonce[key] = nonce
+        queue = self.queues[key]
+        for n in sorted(n for n in queue if n < nonce):
+            self._remove(queue[n])
+        if key in self.queues:
+            self._update_head(key)
+
+    def _evict(self):
+        while len(self.by_hash) > self.max_txs or \
+                self.size > self.max_bytes:
+            while self.cheapest and self.by_hash.get(
+                    self.cheapest[0][2].hash) is not self.cheapest[0][2]:
+                heapq.heappop(self.cheapest)
+            if not self.cheapest:
+                return
+            pooled = heapq.heappop(self.cheapest)[2]
+            # the transactions after it could not be executed any more
+            queue = self.queues[pooled.key]
+            for nonce in sorted((n for n in queue if n >= pooled.tx.nonce),
+                                reverse=True):
+                self._remove(queue[nonce])
 
     def pop_transaction(self, max_gas=9999999999,
-                        max_seek_depth=16, min_gasprice=0):
-        while len(self.aside) and max_gas >= heapq.heaptop(self.aside).prio:
-            item = heapq.heappop(self.aside)
-            item.prio = -item.tx.gasprice
-            heapq.heappush(self.txs, item)
-        for i in range(min(len(self.txs), max_seek_depth)):
-            item = heapq.heaptop(self.txs)
-            if item.tx.startgas > max_gas:
+                        max_seek_depth=16, min_gasprice=0, get_nonce=None):
+        """take the highest priced transaction that is next for its sender
+        and fits in `max_gas` out of the queue; the next transaction of
+        that sender is then considered in its place
+
+        Senders whose next transaction needs more than `max_gas` are set
+        aside until a call with enough gas. `max_seek_depth` is no longer
+        used, as all of them are looked at.
+
+        :param get_nonce: function returning the nonce of an account, eg.
+                          State.get_nonce; if given, a sender's next
+                          transaction only comes out if its nonce is the
+                          account's. Those with lower nonces are dropped;
+                          if the account's is missing, the sender is held
+                          back until it is added
+
+        :returns: the transaction, or None if there is none (at
+                  `min_gasprice` or more, unless forced in)
+        """
+        while len(self.aside) and max_gas >= heapq.heaptop(self.aside)[0]:
+            pooled = heapq.heappop(self.aside)[2]
+            if pooled.head and not pooled.in_heap:
+                pooled.in_heap = True
+                heapq.heappush(self.txs, pooled)
+        while self.txs:
+            pooled = heapq.heaptop(self.txs)
+            if not pooled.head:
                 heapq.heappop(self.txs)
-                item.prio = item.tx.startgas
-                heapq.heappush(self.aside, item)
-            elif item.tx.gasprice >= min_gasprice or item.prio == PRIO_INFINITY:
+                pooled.in_heap = False
+                continue
+            if get_nonce is not None and pooled.key != pooled.hash:
+                nonce = get_nonce(pooled.key)
+                if nonce != pooled.tx.nonce:
+                    heapq.heappop(self.txs)
+                    pooled.in_heap = False
+                    self._skip_to(pooled.key, nonce)
+                    continue
+            if pooled.tx.startgas > max_gas:
                 heapq.heappop(self.txs)
-                return item.tx
+                pooled.in_heap = False
+                heapq.heappush(self.aside, (pooled.tx.startgas,
+                                            pooled.counter, pooled))
+            elif pooled.tx.gasprice >= min_gasprice or \
+                    pooled.prio == PRIO_INFINITY:
+                heapq.heappop(self.txs)
+                pooled.in_heap = False
+                if pooled.key != pooled.hash:
+                    self.next_nonce[pooled.key] = pooled.tx.nonce + 1
+                self._remove(pooled)
+                return pooled.tx
             else:
                 return None
         return None
 
     def peek(self, num=None):
+        """the next transactions of all senders, or the `num` best of
+        them in the order they would be popped"""
+        txs = [pooled for pooled in self.txs if pooled.head] + \
+            [item[2] for item in self.aside if item[2].head and
+             not item[2].in_heap]
         if num:
-            return self.txs[0:num]
-        else:
-            return self.txs
+            return heapq.nsmallest(num, txs)
+        return txs
 
     def diff(self, txs):
-        remove_hashes = [tx.hash for tx in txs]
-        keep = [item for item in self.txs if item.tx.hash not in remove_hashes]
-        q = TransactionQueue()
-        q.txs = keep
+        """a copy of the queue without `txs`, eg. the transactions of a
+        new block, nor the transactions of their senders with nonces they
+        have used up"""
+        remove_hashes = set()
+        mined = {}
+        for tx in txs:
+            remove_hashes.add(tx.hash)
+            if tx.r or tx.s:
+                try:
+                    mined[tx.sender] = max(mined.get(tx.sender, -1),
+                                           tx.nonce)
+                except (InvalidTransaction, AssertionError):
+                    pass
+        q = TransactionQueue(self.max_txs, self.max_bytes, self.price_bump)
+        q.counter = self.counter
+        q.next_nonce = dict(self.next_nonce)
+        for key, nonce in mined.items():
+            if key in self.queues:
+                q.next_nonce[key] = max(q.next_nonce.get(key, 0), nonce + 1)
+        for pooled in sorted(self.by_hash.values(),
+                             key=lambda pooled: pooled.counter):
+            if pooled.hash in remove_hashes or \
+                    pooled.tx.nonce < q.next_nonce.get(pooled.key, 0):
+                continue
+            q._insert(_PooledTx(pooled.prio, pooled.counter, pooled.tx,
+                                pooled.hash, pooled.key, pooled.size))
         return q
 
 
@@ -88,8 +334,8 @@ def test():
                   (30000, None, None),
                   (999999, 50000, 74)]
     # Add transactions to queue
-    for param in params:
-        q.add_transaction(make_test_tx(s=param[0], g=param[1]))
+    for i, param in enumerate(params):
+        q.add_transaction(make_test_tx(s=param[0], g=param[1], data=str(i)))
     # Attempt pops from queue
     for (maxgas, expected_s, expected_g) in operations:
         tx = q.pop_transaction(max_gas=maxgas)
@@ -8,6 +8,7 @@ from ethereum.exceptions import InvalidTransaction
 from ethereum import bloom
 from ethereum import opcodes
 from ethereum import utils
+from ethereum.specials import ZERO_PRIVKEY_ADDR
 from ethereum.slogging import get_logger
 from ethereum.utils import TT256, mk_contract_address, zpad, int_to_32bytearray, big_endian_to_int, ecsign, ecrecover_to_pub, normalize_key
 
@@ -77,6 +78,24 @@ class Transaction(rlp.Serializable):
                 self.value >= TT256 or self.nonce >= TT256:
             raise InvalidTransaction("Values way too high!")
 
+    def signing_data(self):
+        """returns (sighash, v) as needed to recover the sender, with v
+        normalized to 27 or 28"""
+        if self.v in (27, 28):
+            vee = self.v
+            sighash = utils.sha3(rlp.encode(self, UnsignedTransaction))
+        elif self.v >= 37:
+            vee = self.v - self.network_id * 2 - 8
+            assert vee in (27, 28)
+            rlpdata = rlp.encode(rlp.infer_sedes(self).serialize(self)[
+                                 :-3] + [self.network_id, '', ''])
+            sighash = utils.sha3(rlpdata)
+        else:
+            raise InvalidTransaction("Invalid V value")
+        if self.r >= secpk1n or self.s >= secpk1n or self.r == 0 or self.s == 0:
+            raise InvalidTransaction("Invalid signature values!")
+        return sighash, vee
+
     @property
     def sender(self):
         if not self._sender:
@@ -84,24 +103,13 @@ class Transaction(rlp.Serializable):
             if self.r == 0 and self.s == 0:
                 self._sender = null_address
             else:
-                if self.v in (27, 28):
-                    vee = self.v
-                    sighash = utils.sha3(rlp.encode(self, UnsignedTransaction))
-                elif self.v >= 37:
-                    vee = self.v - self.network_id * 2 - 8
-                    assert vee in (27, 28)
-                    rlpdata = rlp.encode(rlp.infer_sedes(self).serialize(self)[
-                                         :-3] + [self.network_id, '', ''])
-                    sighash = utils.sha3(rlpdata)
-                else:
-                    raise InvalidTransaction("Invalid V value")
-                if self.r >= secpk1n or self.s >= secpk1n or self.r == 0 or self.s == 0:
-                    raise InvalidTransaction("Invalid signature values!")
-                pub = ecrecover_to_pub(sighash, vee, self.r, self.s)
-                if pub == b'\x00' * 64:
+                sighash, vee = self.signing_data()
+                sender = utils.ecrecover_to_address(
+                    sighash, vee, self.r, self.s)
+                if sender == ZERO_PRIVKEY_ADDR:
                     raise InvalidTransaction(
                         "Invalid signature (zero privkey cannot sign)")
-                self._sender = utils.sha3(pub)[-20:]
+                self._sender = sender
         return self._sender
 
     @property
@@ -133,10 +141,11 @@ class Transaction(rlp.Serializable):
         key = normalize_key(key)
 
         self.v, self.r, self.s = ecsign(rawhash, key)
+        self._sender = utils.privtoaddr(key)
+        utils.recovery_cache.put((rawhash, self.v, self.r, self.s), self._sender)
         if network_id is not None:
             self.v += 8 + network_id * 2
 
-        self._sender = utils.privtoaddr(key)
         return self
 
     @property
@@ -199,3 +208,60 @@ class Transaction(rlp.Serializable):
 
 
 UnsignedTransaction = Transaction.exclude(['v', 'r', 's'])
+
+
+def _recover_address(args):
+    # runs in the worker processes, so it only deals in plain values
+    sighash, v, r, s = args
+    try:
+        pub = ecrecover_to_pub(sighash, v, r, s)
+    except Exception:
+        return None
+    if pub == b'\x00' * 64:
+        return None
+    return utils.sha3(pub)[-20:]
+
+
+def recover_senders(txs, workers=0):
+    """recover and set the sender of every transaction in `txs`
+
+    Signatures are checked in a pool of `workers` processes; with fewer
+    than two workers, or if the pool cannot be used, they are checked
+    serially. Transactions whose signature is invalid are left untouched,
+    so that accessing `sender` raises the usual error later on.
+
+    :param txs: list of transactions
+    :param workers: number of worker processes
+    """
+    pending, jobs = [], []
+    for tx in txs:
+        if tx._sender or (tx.r == 0 and tx.s == 0):
+            continue
+        try:
+            sighash, vee = tx.signing_data()
+        except (InvalidTransaction, AssertionError):
+            continue
+        job = (sighash, vee, tx.r, tx.s)
+        sender = utils.recovery_cache.get(job)
+        if sender is None:
+            pending.append(tx)
+            jobs.append(job)
+        elif sender != ZERO_PRIVKEY_ADDR:
+            tx._sender = sender
+    if not jobs:
+        return
+    results = None
+    if workers > 1 and len(jobs) > 1:
+        try:
+            results = utils.get_process_pool(workers).map(
+                _recover_address, jobs,
+                chunksize=max(1, len(jobs) // (workers * 4)))
+        except (OSError, ImportError) as e:
+            log.warning('parallel sender recovery failed, recovering serially',
+                     error=e)
+    if results is None:
+        results = [_recover_address(job) for job in jobs]
+    for tx, job, sender in zip(pending, jobs, results):
+        if sender is not None:
+            utils.recovery_cache.put(job, sender)
+            tx._sender = sender
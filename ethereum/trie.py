@@ -5,19 +5,22 @@ from ethereum import utils
 from ethereum.utils import to_string
 from ethereum.abi import is_string
 import copy
+import itertools
 from rlp.utils import decode_hex, ascii_chr, str_to_bytes
 from ethereum.utils import encode_hex
+from ethereum.db import EphemDB, RecordingDB
 from ethereum.fast_rlp import encode_optimized
 rlp_encode = encode_optimized
 
-bin_to_nibbles_cache = {}
-
 hti = {}
 for i, c in enumerate(b'0123456789abcdef'):
     hti[c] = i
 for i, c in enumerate('0123456789abcdef'):
     hti[c] = i
 
+# byte value -> its two nibbles
+byte_to_nibbles = [(b >> 4, b & 15) for b in range(256)]
+
 
 def bin_to_nibbles(s):
     """convert string s to nibbles (half-bytes)
@@ -31,7 +34,7 @@ def bin_to_nibbles(s):
     >>> bin_to_nibbles("hello")
     [6, 8, 6, 5, 6, 12, 6, 12, 6, 15]
     """
-    return [hti[c] for c in encode_hex(s)]
+    return [n for b in bytearray(str_to_bytes(s)) for n in byte_to_nibbles[b]]
 
 
 def nibbles_to_bin(nibbles):
@@ -89,10 +92,8 @@ def pack_nibbles(nibbles):
         nibbles = [flags] + nibbles
     else:
         nibbles = [flags, 0] + nibbles
-    o = b''
-    for i in range(0, len(nibbles), 2):
-        o += ascii_chr(16 * nibbles[i] + nibbles[i + 1])
-    return o
+    return bytes(bytearray(
+        16 * hi + lo for hi, lo in zip(nibbles[::2], nibbles[1::2])))
 
 
 def unpack_to_nibbles(bindata):
@@ -106,12 +107,32 @@ def unpack_to_nibbles(bindata):
     if flags & 2:
         o.append(NIBBLE_TERMINATOR)
     if flags & 1 == 1:
-        o = o[1:]
+        del o[0]
     else:
-        o = o[2:]
+        del o[:2]
     return o
 
 
+def unpack_key(bindata):
+    """unpack the path of a key value node
+
+    :return: (nibbles without terminator, whether it is a leaf)
+    """
+    o = bin_to_nibbles(bindata)
+    flags = o[0]
+    if flags & 1 == 1:
+        del o[0]
+    else:
+        del o[:2]
+    return o, bool(flags & 2)
+
+
+def matches_at(full, pos, part):
+    """ test whether part occurs in full at offset pos
+    """
+    return full[pos:pos + len(part)] == part
+
+
 def starts_with(full, part):
     """ test whether the items in the part is
     the leading items of the full
@@ -140,13 +161,21 @@ BLANK_ROOT = utils.sha3rlp(b'')
 
 class Trie(object):
 
-    def __init__(self, db, root_hash=BLANK_ROOT):
+    def __init__(self, db, root_hash=BLANK_ROOT, write_back=False):
         """it also present a dictionary like interface
 
         :param db key value database
         :root: blank or trie node in form of [key, value] or [v0,v1..v15,v]
+        :param write_back: keep modified nodes in memory until the root
+            hash is read or `commit` is called, instead of storing every
+            intermediate node
         """
         self.db = db  # Pass in a database object directly
+        self.write_back = write_back
+        # id -> node for nodes created during a batch (or at any time in
+        # write-back mode); they are kept in memory and only hashed and
+        # stored once the batch completes
+        self._dirty = None
         self.set_root_hash(root_hash)
         self.deletes = []
 
@@ -167,10 +196,12 @@ class Trie(object):
     def root_hash(self):
         """always empty or a 32 bytes string
         """
+        if self._root_hash is None:
+            self.commit()
         return self._root_hash
 
     def get_root_hash(self):
-        return self._root_hash
+        return self.root_hash
 
     def _update_root_hash(self):
         val = rlp_encode(self.root_node)
@@ -185,6 +216,8 @@ class Trie(object):
     def set_root_hash(self, root_hash):
         assert is_string(root_hash)
         assert len(root_hash) in [0, 32]
+        # pending in-memory nodes are dropped
+        self._dirty = {} if self.write_back else None
         if root_hash == BLANK_ROOT:
             self.root_node = BLANK_NODE
             self._root_hash = BLANK_ROOT
@@ -195,6 +228,7 @@ class Trie(object):
     def clear(self):
         """ clear all tree data
         """
+        self.commit()
         self._delete_child_storage(self.root_node)
         self._delete_node_storage(self.root_node)
         self.root_node = BLANK_NODE
@@ -211,6 +245,9 @@ class Trie(object):
     def _encode_node(self, node, put_in_db=True):
         if node == BLANK_NODE:
             return BLANK_NODE
+        if put_in_db and self._dirty is not None:
+            self._dirty[id(node)] = node
+            return node
         # assert isinstance(node, list)
         rlpnode = rlp_encode(node)
         if len(rlpnode) < 32:
@@ -226,8 +263,7 @@ class Trie(object):
             return BLANK_NODE
         if isinstance(encoded, list):
             return encoded
-        o = rlp.decode(self.db.get(encoded))
-        return o
+        return self.db.get_node(encoded)
 
     def _get_node_type(self, node):
         """ get node type and content
@@ -239,8 +275,8 @@ class Trie(object):
             return NODE_TYPE_BLANK
 
         if len(node) == 2:
-            nibbles = unpack_to_nibbles(node[0])
-            has_terminator = (nibbles and nibbles[-1] == NIBBLE_TERMINATOR)
+            # the terminator flag lives in the first nibble of the path
+            has_terminator = bytearray(node[0][:1])[0] & 32
             return NODE_TYPE_LEAF if has_terminator\
                 else NODE_TYPE_EXTENSION
         if len(node) == 17:
@@ -254,38 +290,134 @@ class Trie(object):
         :return:
             BLANK_NODE if does not exist, otherwise value or hash
         """
-        node_type = self._get_node_type(node)
+        # walk down by index instead of slicing the key at every level
+        pos = 0
+        while True:
+            node_type = self._get_node_type(node)
 
-        if node_type == NODE_TYPE_BLANK:
-            return BLANK_NODE
+            if node_type == NODE_TYPE_BLANK:
+                return BLANK_NODE
 
-        if node_type == NODE_TYPE_BRANCH:
-            # already reach the expected node
-            if not key:
-                return node[-1]
-            sub_node = self._decode_to_node(node[key[0]])
-            return self._get(sub_node, key[1:])
-
-        # key value node
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
-        if node_type == NODE_TYPE_LEAF:
-            return node[1] if key == curr_key else BLANK_NODE
+            if node_type == NODE_TYPE_BRANCH:
+                # already reach the expected node
+                if pos == len(key):
+                    return node[-1]
+                node = self._decode_to_node(node[key[pos]])
+                pos += 1
+                continue
+
+            # key value node
+            curr_key, _ = unpack_key(node[0])
+            if node_type == NODE_TYPE_LEAF:
+                if len(key) - pos == len(curr_key) and \
+                        matches_at(key, pos, curr_key):
+                    return node[1]
+                return BLANK_NODE
 
-        if node_type == NODE_TYPE_EXTENSION:
-            # traverse child nodes
-            if starts_with(key, curr_key):
-                sub_node = self._decode_to_node(node[1])
-                return self._get(sub_node, key[len(curr_key):])
-            else:
+            # extension node, traverse child nodes
+            if not matches_at(key, pos, curr_key):
                 return BLANK_NODE
+            node = self._decode_to_node(node[1])
+            pos += len(curr_key)
+
+    def path_nodes(self, keys):
+        """the stored nodes, as a dict from hash to rlp, that updating or
+        deleting `keys` reads: the root, the nodes on the path to each key
+        and the children of the branch nodes on those paths (which a
+        deletion may merge with)
+
+        A trie built on just these nodes can apply those updates without
+        any other database access.
+
+        :param keys: list of keys (not nibbles)
+        """
+        nodes = {}
+
+        def add(ref):
+            if isinstance(ref, bytes) and len(ref) == 32 and \
+                    ref not in nodes:
+                nodes[ref] = self.db.get(ref)
+
+        if self.root_hash != BLANK_ROOT:
+            add(self.root_hash)
+        for key in keys:
+            key = bin_to_nibbles(to_string(key))
+            node = self.root_node
+            pos = 0
+            while True:
+                node_type = self._get_node_type(node)
+                if node_type == NODE_TYPE_BRANCH:
+                    for ref in node[:16]:
+                        add(ref)
+                    if pos == len(key):
+                        break
+                    node = self._decode_to_node(node[key[pos]])
+                    pos += 1
+                elif node_type == NODE_TYPE_EXTENSION:
+                    curr_key, _ = unpack_key(node[0])
+                    if not matches_at(key, pos, curr_key):
+                        break
+                    add(node[1])
+                    node = self._decode_to_node(node[1])
+                    pos += len(curr_key)
+                else:
+                    break
+        return nodes
+
+    def get_proof(self, key):
+        """the encoded nodes on the path from the root to `key`, root
+        first, which prove either the value stored under `key` or that
+        there is none; see verify_proof
+        """
+        return self.get_multi_proof([key])
+
+    def get_multi_proof(self, keys):
+        """one proof for all of `keys`: the encoded nodes on their paths,
+        each node once, in the order they are met walking from the root
+        """
+        proof = []
+        seen = set()
+
+        def add(ref):
+            if isinstance(ref, bytes) and len(ref) == 32 and \
+                    ref not in seen:
+                seen.add(ref)
+                proof.append(self.db.get(ref))
 
-    def _update(self, node, key, value):
+        if self.root_hash == BLANK_ROOT:
+            return proof
+        add(self.root_hash)
+        for key in keys:
+            key = bin_to_nibbles(to_string(key))
+            node = self.root_node
+            pos = 0
+            while True:
+                node_type = self._get_node_type(node)
+                if node_type == NODE_TYPE_BRANCH:
+                    if pos == len(key):
+                        break
+                    add(node[key[pos]])
+                    node = self._decode_to_node(node[key[pos]])
+                    pos += 1
+                elif node_type == NODE_TYPE_EXTENSION:
+                    curr_key, _ = unpack_key(node[0])
+                    if not matches_at(key, pos, curr_key):
+                        break
+                    add(node[1])
+                    node = self._decode_to_node(node[1])
+                    pos += len(curr_key)
+                else:
+                    break
+        return proof
+
+    def _update(self, node, key, value, pos=0):
         """ update item inside a node
 
         :param node: node in form of list, or BLANK_NODE
         :param key: nibble list without terminator
             .. note:: key may be []
         :param value: value string
+        :param pos: offset in key at which this node sits
         :return: new node
 
         if this node is changed to a new node, it's parent will take the
@@ -295,32 +427,34 @@ class Trie(object):
         node_type = self._get_node_type(node)
 
         if node_type == NODE_TYPE_BLANK:
-            return [pack_nibbles(with_terminator(key)), value]
+            return [pack_nibbles(with_terminator(key[pos:])), value]
 
         elif node_type == NODE_TYPE_BRANCH:
-            if not key:
+            if pos == len(key):
                 node[-1] = value
             else:
                 new_node = self._update_and_delete_storage(
-                    self._decode_to_node(node[key[0]]),
-                    key[1:], value)
-                node[key[0]] = self._encode_node(new_node)
+                    self._decode_to_node(node[key[pos]]),
+                    key, value, pos + 1)
+                node[key[pos]] = self._encode_node(new_node)
             return node
 
         elif is_key_value_type(node_type):
-            return self._update_kv_node(node, key, value)
+            return self._update_kv_node(node, key[pos:], value)
 
-    def _update_and_delete_storage(self, node, key, value):
+    def _update_and_delete_storage(self, node, key, value, pos=0):
         old_node = node[:]
-        new_node = self._update(node, key, value)
-        if old_node != new_node:
+        new_node = self._update(node, key, value, pos)
+        if old_node != new_node and not self._is_dirty(node):
             self._delete_node_storage(old_node)
         return new_node
 
+    def _is_dirty(self, node):
+        return self._dirty is not None and id(node) in self._dirty
+
     def _update_kv_node(self, node, key, value):
-        node_type = self._get_node_type(node)
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
-        is_inner = node_type == NODE_TYPE_EXTENSION
+        curr_key, is_leaf = unpack_key(node[0])
+        is_inner = not is_leaf
 
         # find longest common prefix
         prefix_length = 0
@@ -375,41 +509,28 @@ class Trie(object):
         else:
             return new_node
 
-    def _getany(self, node, reverse=False, path=[]):
-        # print('getany', node, 'reverse=', reverse, path)
+    def _getany(self, node, reverse=False):
         node_type = self._get_node_type(node)
         if node_type == NODE_TYPE_BLANK:
             return None
         if node_type == NODE_TYPE_BRANCH:
             if node[16] and not reverse:
-                # print('found!', [16], path)
                 return [16]
-            scan_range = list(range(16))
-            if reverse:
-                scan_range.reverse()
+            scan_range = range(15, -1, -1) if reverse else range(16)
             for i in scan_range:
-                o = self._getany(
-                    self._decode_to_node(
-                        node[i]),
-                    reverse=reverse,
-                    path=path + [i])
+                o = self._getany(self._decode_to_node(node[i]), reverse)
                 if o is not None:
-                    # print('found@', [i] + o, path)
-                    return [i] + o
+                    o.insert(0, i)
+                    return o
             if node[16] and reverse:
-                # print('found!', [16], path)
                 return [16]
             return None
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
-        if node_type == NODE_TYPE_LEAF:
-            # print('found#', curr_key, path)
+        curr_key, is_leaf = unpack_key(node[0])
+        if is_leaf:
             return curr_key
 
-        if node_type == NODE_TYPE_EXTENSION:
-            curr_key = without_terminator(unpack_to_nibbles(node[0]))
-            sub_node = self._decode_to_node(node[1])
-            return curr_key + \
-                self._getany(sub_node, reverse=reverse, path=path + curr_key)
+        sub_node = self._decode_to_node(node[1])
+        return curr_key + self._getany(sub_node, reverse)
 
     def _split(self, node, key):
         node_type = self._get_node_type(node)
@@ -537,78 +658,63 @@ class Trie(object):
         t.root_node = t._merge(trie1.root_node, trie2.root_node)
         return t
 
-    def _iter(self, node, key, reverse=False, path=[]):
-        # print('iter', node, key, 'reverse =', reverse, 'path =', path)
+    def _iter(self, node, key, reverse=False, pos=0):
         node_type = self._get_node_type(node)
 
         if node_type == NODE_TYPE_BLANK:
             return None
 
         elif node_type == NODE_TYPE_BRANCH:
-            # print('b')
-            if len(key):
-                sub_node = self._decode_to_node(node[key[0]])
-                o = self._iter(sub_node, key[1:], reverse, path + [key[0]])
+            has_key = pos < len(key)
+            if has_key:
+                sub_node = self._decode_to_node(node[key[pos]])
+                o = self._iter(sub_node, key, reverse, pos + 1)
                 if o is not None:
-                    # print('returning', [key[0]] + o, path)
-                    return [key[0]] + o
+                    o.insert(0, key[pos])
+                    return o
             if reverse:
-                scan_range = reversed(list(range(key[0] if len(key) else 0)))
+                scan_range = range(key[pos] - 1 if has_key else -1, -1, -1)
             else:
-                scan_range = list(range(key[0] + 1 if len(key) else 0, 16))
+                scan_range = range(key[pos] + 1 if has_key else 0, 16)
             for i in scan_range:
                 sub_node = self._decode_to_node(node[i])
-                # print('prelim getany', path+[i])
-                o = self._getany(sub_node, reverse, path + [i])
+                o = self._getany(sub_node, reverse)
                 if o is not None:
-                    # print('returning', [i] + o, path)
-                    return [i] + o
-            if reverse and key and node[16]:
-                # print('o')
+                    o.insert(0, i)
+                    return o
+            if reverse and has_key and node[16]:
                 return [16]
             return None
 
-        descend_key = without_terminator(unpack_to_nibbles(node[0]))
-        if node_type == NODE_TYPE_LEAF:
+        descend_key, is_leaf = unpack_key(node[0])
+        if is_leaf:
+            rest = key[pos:]
             if reverse:
-                # print('L', descend_key, key, descend_key if descend_key < key else None, path)
-                return descend_key if descend_key < key else None
-            else:
-                # print('L', descend_key, key, descend_key if descend_key > key else None, path)
-                return descend_key if descend_key > key else None
-
-        if node_type == NODE_TYPE_EXTENSION:
-            # traverse child nodes
-            sub_node = self._decode_to_node(node[1])
-            sub_key = key[len(descend_key):]
-            # print('amhere', key, descend_key, descend_key > key[:len(descend_key)])
-            if starts_with(key, descend_key):
-                o = self._iter(sub_node, sub_key, reverse, path + descend_key)
-            elif descend_key > key[:len(descend_key)] and not reverse:
-                # print(1)
-                # print('prelim getany', path+descend_key)
-                o = self._getany(sub_node, False, path + descend_key)
-            elif descend_key < key[:len(descend_key)] and reverse:
-                # print(2)
-                # print('prelim getany', path+descend_key)
-                o = self._getany(sub_node, True, path + descend_key)
+                return descend_key if descend_key < rest else None
             else:
-                o = None
-            # print('returning@', descend_key + o if o else None, path)
-            return descend_key + o if o else None
+                return descend_key if descend_key > rest else None
+
+        # extension node, traverse child nodes
+        sub_node = self._decode_to_node(node[1])
+        key_part = key[pos:pos + len(descend_key)]
+        if descend_key == key_part:
+            o = self._iter(sub_node, key, reverse, pos + len(descend_key))
+        elif descend_key > key_part and not reverse:
+            o = self._getany(sub_node, False)
+        elif descend_key < key_part and reverse:
+            o = self._getany(sub_node, True)
+        else:
+            o = None
+        return descend_key + o if o else None
 
     def next(self, key):
-        # print('nextting')
         key = bin_to_nibbles(key)
         o = self._iter(self.root_node, key)
-        # print('answer', o)
         return nibbles_to_bin(without_terminator(o)) if o else None
 
     def prev(self, key):
-        # print('prevving')
         key = bin_to_nibbles(key)
         o = self._iter(self.root_node, key, reverse=True)
-        # print('answer', o)
         return nibbles_to_bin(without_terminator(o)) if o else None
 
     def _delete_node_storage(self, node):
@@ -629,12 +735,13 @@ class Trie(object):
         self.deletes.append(encoded)
         # print('del', encoded, self.db.get_refcount(encoded))
 
-    def _delete(self, node, key):
+    def _delete(self, node, key, pos=0):
         """ update item inside a node
 
         :param node: node in form of list, or BLANK_NODE
         :param key: nibble list without terminator
             .. note:: key may be []
+        :param pos: offset in key at which this node sits
         :return: new node
 
         if this node is changed to a new node, it's parent will take the
@@ -646,10 +753,10 @@ class Trie(object):
             return BLANK_NODE
 
         if node_type == NODE_TYPE_BRANCH:
-            return self._delete_branch_node(node, key)
+            return self._delete_branch_node(node, key, pos)
 
         if is_key_value_type(node_type):
-            return self._delete_kv_node(node, key)
+            return self._delete_kv_node(node, key, pos)
 
     def _normalize_branch_node(self, node):
         """node should have only one item changed
@@ -682,48 +789,47 @@ class Trie(object):
                     self._encode_node(sub_node)]
         assert False
 
-    def _delete_and_delete_storage(self, node, key):
+    def _delete_and_delete_storage(self, node, key, pos=0):
         old_node = node[:]
-        new_node = self._delete(node, key)
-        if old_node != new_node:
+        new_node = self._delete(node, key, pos)
+        if old_node != new_node and not self._is_dirty(node):
             self._delete_node_storage(old_node)
         return new_node
 
-    def _delete_branch_node(self, node, key):
+    def _delete_branch_node(self, node, key, pos):
         # already reach the expected node
-        if not key:
+        if pos == len(key):
             node[-1] = BLANK_NODE
             return self._normalize_branch_node(node)
 
+        index = key[pos]
         encoded_new_sub_node = self._encode_node(
             self._delete_and_delete_storage(
-                self._decode_to_node(node[key[0]]), key[1:])
+                self._decode_to_node(node[index]), key, pos + 1)
         )
 
-        if encoded_new_sub_node == node[key[0]]:
+        if encoded_new_sub_node == node[index]:
             return node
 
-        node[key[0]] = encoded_new_sub_node
+        node[index] = encoded_new_sub_node
         if encoded_new_sub_node == BLANK_NODE:
             return self._normalize_branch_node(node)
 
         return node
 
-    def _delete_kv_node(self, node, key):
-        node_type = self._get_node_type(node)
-        assert is_key_value_type(node_type)
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
+    def _delete_kv_node(self, node, key, pos):
+        curr_key, is_leaf = unpack_key(node[0])
 
-        if not starts_with(key, curr_key):
+        if not matches_at(key, pos, curr_key):
             # key not found
             return node
 
-        if node_type == NODE_TYPE_LEAF:
-            return BLANK_NODE if key == curr_key else node
+        if is_leaf:
+            return BLANK_NODE if len(key) - pos == len(curr_key) else node
 
         # for inner key value type
         new_sub_node = self._delete_and_delete_storage(
-            self._decode_to_node(node[1]), key[len(curr_key):])
+            self._decode_to_node(node[1]), key, pos + len(curr_key))
 
         if self._encode_node(new_sub_node) == node[1]:
             return node
@@ -762,7 +868,7 @@ class Trie(object):
         self.root_node = self._delete_and_delete_storage(
             self.root_node,
             bin_to_nibbles(to_string(key)))
-        self._update_root_hash()
+        self._root_changed()
 
     def _get_size(self, node):
         """Get counts of (key, value) stored in this and the descendant nodes
@@ -786,111 +892,68 @@ class Trie(object):
             sizes = sizes + [1 if node[-1] else 0]
             return sum(sizes)
 
-    def _iter_branch(self, node):
-        """yield (key, value) stored in this and the descendant nodes
-        :param node: node in form of list, or BLANK_NODE
+    def iterate(self, start=b'', end=None, limit=None):
+        """yield the (key, value) pairs with start <= key < end in key
+        order, at most `limit` of them
 
-        .. note::
-            Here key is in full form, rather than key of the individual node
+        The trie is walked with an explicit stack of not yet decoded
+        nodes, so memory stays proportional to its depth, and subtrees
+        before `start` are skipped without being read. See iterate_page
+        for resuming a scan.
         """
-        if node == BLANK_NODE:
-            raise StopIteration
-
-        node_type = self._get_node_type(node)
-
-        if is_key_value_type(node_type):
-            nibbles = without_terminator(unpack_to_nibbles(node[0]))
-            key = b'+'.join([to_string(x) for x in nibbles])
-            if node_type == NODE_TYPE_EXTENSION:
-                sub_tree = self._iter_branch(self._decode_to_node(node[1]))
+        start = bin_to_nibbles(to_string(start))
+        stack = [(self.root_node, [])]
+        count = 0
+        while stack and (limit is None or count < limit):
+            node, path = stack.pop()
+            node = self._decode_to_node(node)
+            node_type = self._get_node_type(node)
+            if node_type == NODE_TYPE_BLANK:
+                continue
+            if node_type == NODE_TYPE_BRANCH:
+                # pushed last to first, so that they are visited in order
+                for i in range(15, -1, -1):
+                    if node[i] != BLANK_NODE:
+                        child = path + [i]
+                        if child >= start[:len(child)]:
+                            stack.append((node[i], child))
+                value = node[16]
             else:
-                sub_tree = [(to_string(NIBBLE_TERMINATOR), node[1])]
-
-            # prepend key of this node to the keys of children
-            for sub_key, sub_value in sub_tree:
-                full_key = (key + b'+' + sub_key).strip(b'+')
-                yield (full_key, sub_value)
-
-        elif node_type == NODE_TYPE_BRANCH:
-            for i in range(16):
-                sub_tree = self._iter_branch(self._decode_to_node(node[i]))
-                for sub_key, sub_value in sub_tree:
-                    full_key = (
-                        str_to_bytes(
-                            str(i)) +
-                        b'+' +
-                        sub_key).strip(b'+')
-                    yield (full_key, sub_value)
-            if node[16]:
-                yield (to_string(NIBBLE_TERMINATOR), node[-1])
-
-    def iter_branch(self):
-        for key_str, value in self._iter_branch(self.root_node):
-            if key_str:
-                nibbles = [int(x) for x in key_str.split(b'+')]
-            else:
-                nibbles = []
-            key = nibbles_to_bin(without_terminator(nibbles))
+                curr_key, is_leaf = unpack_key(node[0])
+                path = path + curr_key
+                if path < start[:len(path)]:
+                    continue
+                if not is_leaf:
+                    stack.append((node[1], path))
+                    continue
+                value = node[1]
+            if not value or path < start:
+                continue
+            key = bytes(bytearray(16 * path[i] + path[i + 1]
+                                  for i in range(0, len(path), 2)))
+            if end is not None and key >= end:
+                return
             yield key, value
+            count += 1
 
-    def _to_dict(self, node):
-        """convert (key, value) stored in this and the descendant nodes
-        to dict items.
-
-        :param node: node in form of list, or BLANK_NODE
-
-        .. note::
+    def iterate_page(self, token=None, end=None, limit=1000):
+        """one page of a scan over the keys before `end`
 
-            Here key is in full form, rather than key of the individual node
+        :param token: None to start from the first key, or the token
+            returned with the previous page
+        :return: (items, token): up to `limit` (key, value) pairs, and the
+            token for the next page, or None if this was the last one
         """
-        if node == BLANK_NODE:
-            return {}
-
-        node_type = self._get_node_type(node)
+        items = list(self.iterate(token or b'', end, limit + 1))
+        if len(items) > limit:
+            return items[:limit], items[limit][0]
+        return items, None
 
-        if is_key_value_type(node_type):
-            nibbles = without_terminator(unpack_to_nibbles(node[0]))
-            key = b'+'.join([to_string(x) for x in nibbles])
-            if node_type == NODE_TYPE_EXTENSION:
-                sub_dict = self._to_dict(self._decode_to_node(node[1]))
-            else:
-                sub_dict = {to_string(NIBBLE_TERMINATOR): node[1]}
-
-            # prepend key of this node to the keys of children
-            res = {}
-            for sub_key, sub_value in sub_dict.items():
-                full_key = (key + b'+' + sub_key).strip(b'+')
-                res[full_key] = sub_value
-            return res
-
-        elif node_type == NODE_TYPE_BRANCH:
-            res = {}
-            for i in range(16):
-                sub_dict = self._to_dict(self._decode_to_node(node[i]))
-
-                for sub_key, sub_value in sub_dict.items():
-                    full_key = (
-                        str_to_bytes(
-                            str(i)) +
-                        b'+' +
-                        sub_key).strip(b'+')
-                    res[full_key] = sub_value
-
-            if node[16]:
-                res[to_string(NIBBLE_TERMINATOR)] = node[-1]
-            return res
+    def iter_branch(self):
+        return self.iterate()
 
     def to_dict(self):
-        d = self._to_dict(self.root_node)
-        res = {}
-        for key_str, value in d.items():
-            if key_str:
-                nibbles = [int(x) for x in key_str.split(b'+')]
-            else:
-                nibbles = []
-            key = nibbles_to_bin(without_terminator(nibbles))
-            res[key] = value
-        return res
+        return dict(self.iterate())
 
     def get(self, key):
         return self._get(self.root_node, bin_to_nibbles(to_string(key)))
@@ -933,7 +996,84 @@ class Trie(object):
             self.root_node,
             bin_to_nibbles(to_string(key)),
             to_string(value))
+        self._root_changed()
+
+    def _root_changed(self):
+        if self._dirty is None:
+            self._update_root_hash()
+        else:
+            self._dirty[id(self.root_node)] = self.root_node
+            self._root_hash = None
+
+    def update_many(self, items):
+        """apply many updates and compute the new root once
+
+        Keys are applied in sorted order; nodes modified along the way
+        stay in memory, so shared upper levels are hashed and stored only
+        once, in their final form.
+
+        :param items: iterable of (key, value); a value of None deletes
+        """
+        items = list(items)
+        for key, value in items:
+            if not is_string(key):
+                raise Exception("Key must be string")
+            if value is not None and not is_string(value):
+                raise Exception("Value must be string")
+        # stable, so a repeated key still ends up with its last value
+        items.sort(key=lambda kv: to_string(kv[0]))
+        if not items:
+            return
+        batch = self._dirty is None
+        if batch:
+            self._dirty = {}
+        try:
+            for key, value in items:
+                nibbles = bin_to_nibbles(to_string(key))
+                if value is None:
+                    self.root_node = self._delete_and_delete_storage(
+                        self.root_node, nibbles)
+                else:
+                    self.root_node = self._update_and_delete_storage(
+                        self.root_node, nibbles, to_string(value))
+                self._root_changed()
+        except Exception:
+            if batch:
+                self._dirty = None
+            raise
+        if batch:
+            self.commit()
+
+    def delete_many(self, keys):
+        self.update_many((key, None) for key in keys)
+
+    def commit(self):
+        """hash and store the in-memory nodes still reachable from the
+        root; nodes that were replaced in the meantime are never written
+        """
+        if self._root_hash is not None:
+            return
+        self._dirty = None
+        self._flush_children(self.root_node)
         self._update_root_hash()
+        if self.write_back:
+            self._dirty = {}
+
+    def _flush_children(self, node):
+        """replace in-memory children of node with their encodings,
+        storing them bottom-up
+        """
+        node_type = self._get_node_type(node)
+        if node_type == NODE_TYPE_BRANCH:
+            positions = range(16)
+        elif node_type == NODE_TYPE_EXTENSION:
+            positions = [1]
+        else:
+            return
+        for i in positions:
+            if isinstance(node[i], list):
+                self._flush_children(node[i])
+                node[i] = self._encode_node(node[i])
 
     def root_hash_valid(self):
         if self.root_hash == BLANK_ROOT:
@@ -941,6 +1081,203 @@ class Trie(object):
         return self.root_hash in self.db
 
 
+class InvalidProof(Exception):
+    pass
+
+
+def verify_proof(root, key, proof):
+    """check a proof made by Trie.get_proof (or get_multi_proof) against
+    the trie root `root`
+
+    :return: the value stored under `key`, or b'' if there is none
+    :raises InvalidProof: if the proof lacks a node on the path to `key`
+    """
+    nodes = EphemDB()
+    for node in proof:
+        nodes.put(utils.sha3(node), node)
+    try:
+        return Trie(nodes, root).get(key)
+    except KeyError:
+        raise InvalidProof("Proof lacks a node for key %s" % encode_hex(key))
+
+
+# Bottom-up construction from sorted items. A finished subtree is kept as
+# (path, node) relative to where it hangs: `node` is a leaf's value, an
+# extension's encoded child or a branch, and `path` the nibbles leading
+# to it (ending with the terminator for a leaf, empty for a branch). The
+# path is only packed once the parent is known, because a branch with a
+# single child and no value is folded into the path of that child.
+def _nibble_items(items):
+    prev = None
+    for key, value in items:
+        if not is_string(key):
+            raise Exception("Key must be string")
+        if not is_string(value) or value == BLANK_NODE:
+            raise Exception("Value must be a non-empty string")
+        key = to_string(key)
+        if prev is not None and key < prev:
+            raise Exception("Keys must be sorted")
+        prev = key
+        yield bin_to_nibbles(key), to_string(value)
+
+
+def _subtree_node(path, node):
+    return [pack_nibbles(path), node] if path else node
+
+
+def _build_subtree(encode, items, pos):
+    # items: iterator of (nibbles, value), sorted, all sharing the first
+    # `pos` nibbles
+    first = next(items)
+    second = next(items, None)
+    if second is None:
+        return with_terminator(first[0][pos:]), first[1]
+    subtrees, value = [], BLANK_NODE
+    for nibble, group in itertools.groupby(
+            itertools.chain((first, second), items),
+            lambda kv: kv[0][pos] if len(kv[0]) > pos else NIBBLE_TERMINATOR):
+        if nibble == NIBBLE_TERMINATOR:
+            # a repeated key keeps its last value
+            for _, value in group:
+                pass
+        else:
+            subtrees.append((nibble, _build_subtree(encode, group, pos + 1)))
+    return _join_subtrees(encode, subtrees, value)
+
+
+def _join_subtrees(encode, subtrees, value):
+    if not subtrees:
+        return [NIBBLE_TERMINATOR], value
+    if len(subtrees) == 1 and value == BLANK_NODE:
+        nibble, (path, node) = subtrees[0]
+        if path:
+            return [nibble] + path, node
+        return [nibble], encode(node)
+    branch = [BLANK_NODE] * 17
+    branch[16] = value
+    for nibble, (path, node) in subtrees:
+        branch[nibble] = encode(_subtree_node(path, node))
+    return [], branch
+
+
+def _build_top_subtree(job):
+    # runs in the worker processes: builds the subtree under one nibble of
+    # the root, returning it with the nodes written, in order
+    nibble, items = job
+    db = RecordingDB()
+    return nibble, _build_subtree(Trie(db)._encode_node, iter(items), 1), \
+        db.puts
+
+
+# Builds a trie bottom-up from its items in key order, one subtree under
+# the root at a time; with more than one worker the subtrees are built in
+# a process pool while the caller goes on reading the next ones. The
+# subtrees finished so far can be saved with `checkpoint` and handed to a
+# new builder to continue an interrupted build.
+class TrieBuilder(object):
+
+    def __init__(self, db, workers=0, checkpoint=None):
+        self.db = db
+        self.workers = workers
+        self._trie = Trie(db)
+        self._value = BLANK_NODE
+        self._subtrees = []
+        self._jobs = []
+        self._last = -1
+        if checkpoint:
+            for nibble, path, node in rlp.decode(checkpoint):
+                nibble = utils.big_endian_to_int(nibble)
+                if nibble == NIBBLE_TERMINATOR:
+                    self._value = node
+                else:
+                    self._subtrees.append(
+                        (nibble, (list(bytearray(path)), node)))
+                    self._last = nibble
+
+    def add(self, items):
+        """build the subtree holding `items`
+
+        :param items: iterable of (key, value) sorted by key, with
+                      non-empty values; the keys share their first nibble
+                      and sort after the keys of earlier subtrees
+        """
+        items = _nibble_items(items)
+        first = next(items, None)
+        if first is None:
+            return
+        if not first[0]:
+            # the empty key, which is the root's own value
+            for _, self._value in itertools.chain((first,), items):
+                pass
+            return
+        nibble = first[0][0]
+        if nibble <= self._last:
+            raise Exception("Keys must be sorted")
+        self._last = nibble
+        items = itertools.chain((first,), items)
+        if self.workers > 1:
+            self._jobs.append(utils.get_process_pool(self.workers).apply_async(
+                _build_top_subtree, ((nibble, list(items)),)))
+        else:
+            self._subtrees.append(
+                (nibble, _build_subtree(self._trie._encode_node, items, 1)))
+
+    def _wait(self):
+        # store the nodes of the subtrees built in the workers
+        for job in self._jobs:
+            nibble, subtree, puts = job.get()
+            for k, v in puts:
+                self.db.put(k, v)
+            self._subtrees.append((nibble, subtree))
+        self._jobs = []
+
+    def checkpoint(self):
+        """the subtrees built so far, once their nodes are all stored"""
+        self._wait()
+        out = [[nibble, bytes(bytearray(path)), node]
+               for nibble, (path, node) in self._subtrees]
+        if self._value != BLANK_NODE:
+            out.append([NIBBLE_TERMINATOR, b'', self._value])
+        return rlp.encode(out)
+
+    def root_hash(self):
+        """store the root and return its hash"""
+        self._wait()
+        if not self._subtrees and self._value == BLANK_NODE:
+            return BLANK_ROOT
+        t = self._trie
+        t.root_node = _subtree_node(*_join_subtrees(
+            t._encode_node, self._subtrees, self._value))
+        t._update_root_hash()
+        return t.root_hash
+
+
+def build_trie(db, items, workers=0):
+    """store the trie holding `items` in `db`, building it bottom-up in a
+    single pass: every node is hashed and written once, in its final form,
+    and only the nodes along the path of the current key are kept in
+    memory. The nodes written are those Trie.update_many writes for the
+    same items on an empty trie.
+
+    With more than one worker, the 16 subtrees under the root are built in
+    a process pool, each from a list of its items.
+
+    :param items: iterable of (key, value) sorted by key, values non-empty
+    :param workers: number of worker processes (0 or 1: build serially)
+    :return: the root hash
+    """
+    builder = TrieBuilder(db, workers)
+    for _, group in itertools.groupby(items, _root_nibble):
+        builder.add(group)
+    return builder.root_hash()
+
+
+def _root_nibble(item):
+    key = item[0]
+    return bytearray(str_to_bytes(key[:1]))[0] >> 4 if key else \
+        NIBBLE_TERMINATOR
+
+
 if __name__ == "__main__":
     import sys
     from . import db
@@ -9,9 +9,11 @@ except ImportError:
 from py_ecc.secp256k1 import privtopub, ecdsa_raw_sign, ecdsa_raw_recover
 import sys
 import rlp
+from collections import OrderedDict
 from rlp.sedes import big_endian_int, BigEndianInt, Binary
 from rlp.utils import decode_hex, encode_hex, ascii_chr, str_to_bytes
 import random
+import multiprocessing
 
 
 try:
@@ -115,6 +117,73 @@ def ecrecover_to_pub(rawhash, v, r, s):
     return pub
 
 
+class RecoveryCache(object):
+
+    def __init__(self, max_entries):
+        """bounded LRU map from (msghash, v, r, s) to the recovered address
+
+        :param max_entries: number of signatures to remember
+        """
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def get(self, key):
+        addr = self.cache.pop(key, None)
+        if addr is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache[key] = addr
+        return addr
+
+    def put(self, key, addr):
+        self.cache.pop(key, None)
+        self.cache[key] = addr
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Shared by transaction sender recovery and the ecrecover precompile
+recovery_cache = RecoveryCache(65536)
+
+
+# multiprocessing pools by number of processes
+_pools = {}
+
+
+def get_process_pool(workers):
+    """a multiprocessing pool of `workers` processes, shared by everything
+    that farms work out with that many (sender recovery, storage root
+    hashing, trie building); pools of other sizes are left running, as
+    their users may still be waiting on them"""
+    pool = _pools.get(workers)
+    if pool is None:
+        pool = _pools[workers] = multiprocessing.Pool(workers)
+    return pool
+
+
+def ecrecover_to_address(rawhash, v, r, s):
+    """like `ecrecover_to_pub`, but returns the address and remembers it"""
+    key = (rawhash, v, r, s)
+    addr = recovery_cache.get(key)
+    if addr is None:
+        addr = sha3(ecrecover_to_pub(rawhash, v, r, s))[-20:]
+        recovery_cache.put(key, addr)
+    return addr
+
+
 def ecsign(rawhash, key):
     if coincurve and hasattr(coincurve, 'PrivateKey') and False:
         pk = coincurve.PrivateKey(key)
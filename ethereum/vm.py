@@ -12,14 +12,10 @@ from rlp.utils import encode_hex, ascii_chr
 from ethereum import utils
 from ethereum.abi import is_numeric
 from ethereum import opcodes
+from ethereum.code_cache import code_cache
 from ethereum.slogging import get_logger
 from ethereum.utils import to_string, encode_int, zpad, bytearray_to_bytestr, safe_ord
 
-if sys.version_info.major == 2:
-    from repoze.lru import lru_cache
-else:
-    from functools import lru_cache
-
 log_log = get_logger('eth.vm.log')
 log_msg = get_logger('eth.pb.msg')
 log_vm_exit = get_logger('eth.vm.exit')
@@ -39,7 +35,7 @@ MAX_DEPTH = 1024
 # call a contract N times with N bytes of data with a gas cost of O(N);
 # if implemented naively this would require O(N**2) bytes of data
 # copying. Instead we just copy the reference to the parent memory
-# slice plus the start and end of the slice
+# (or the transaction data bytes) plus the start and end of the slice
 class CallData(object):
 
     def __init__(self, parent_memory, offset=0, size=None):
@@ -50,25 +46,36 @@ class CallData(object):
 
     # Convert calldata to bytes
     def extract_all(self):
-        d = self.data[self.offset: self.offset + self.size]
-        d.extend(bytearray(self.size - len(d)))
-        return bytes(bytearray(d))
+        d = bytes(self.data[self.offset: self.rlimit])
+        return d + b'\x00' * (self.size - len(d))
 
     # Extract 32 bytes as integer
     def extract32(self, i):
         if i >= self.size:
             return 0
         o = self.data[self.offset + i: min(self.offset + i + 32, self.rlimit)]
-        o.extend(bytearray(32 - len(o)))
-        return utils.bytearray_to_int(o)
+        # bytes past the end read as zero
+        return utils.bytes_to_int(o) << (8 * (32 - len(o)))
 
     # Extract a slice and copy it to memory
     def extract_copy(self, mem, memstart, datastart, size):
-        for i in range(size):
-            if datastart + i < self.size:
-                mem[memstart + i] = self.data[self.offset + datastart + i]
-            else:
-                mem[memstart + i] = 0
+        if datastart < self.size:
+            start = self.offset + datastart
+            copy_data(mem, memstart,
+                      self.data[start: min(start + size, self.rlimit)], size)
+        else:
+            copy_data(mem, memstart, b'', size)
+
+
+# Copies `data` to mem[memstart: memstart + size] (which must already
+# exist), zero-filling whatever `data` is too short to cover
+def copy_data(mem, memstart, data, size):
+    if not size:
+        return
+    n = min(len(data), size)
+    mem[memstart: memstart + n] = data[:n]
+    if n < size:
+        mem[memstart + n: memstart + size] = bytearray(size - n)
 
 
 # Stores a message object, including context data like sender,
@@ -81,7 +88,7 @@ class Message(object):
         self.to = to
         self.value = value
         self.gas = gas
-        self.data = CallData(list(map(utils.safe_ord, data))) if isinstance(
+        self.data = CallData(utils.to_string(data)) if isinstance(
             data, (str, bytes)) else data
         self.depth = depth
         self.logs = []
@@ -121,27 +128,6 @@ class Compustate():
         self.prev_gas = self.gas
 
 
-# Preprocesses code, and determines which locations are in the middle
-# of pushdata and thus invalid
-@lru_cache(128)
-def preprocess_code(code):
-    o = 0
-    i = 0
-    pushcache = {}
-    code = code + b'\x00' * 32
-    while i < len(code) - 32:
-        codebyte = safe_ord(code[i])
-        if codebyte == 0x5b:
-            o |= 1 << i
-        if 0x60 <= codebyte <= 0x7f:
-            pushcache[i] = utils.big_endian_to_int(
-                code[i + 1: i + codebyte - 0x5e])
-            i += codebyte - 0x5e
-        else:
-            i += 1
-    return o, pushcache
-
-
 # Extends memory, and pays gas for it
 def mem_extend(mem, compustate, op, start, sz):
     if sz and start + sz > len(mem):
@@ -242,6 +228,612 @@ def vm_trace(ext, msg, compustate, opcode, pushcache, tracer=log_vm_op):
     compustate.prev_prev_op = op
 
 
+# Opcode handlers. Each takes the compustate and its stack, and returns
+# None to continue or a (result, gas, data) triple to stop execution.
+# Handlers whose behaviour depends on the fork are built per fork by
+# mk_opcode_table, which binds the fork flags once.
+
+def op_stop(c, stk):
+    return peaceful_exit('STOP', c.gas, [])
+
+
+def op_add(c, stk):
+    stk.append((stk.pop() + stk.pop()) & TT256M1)
+
+
+def op_sub(c, stk):
+    stk.append((stk.pop() - stk.pop()) & TT256M1)
+
+
+def op_mul(c, stk):
+    stk.append((stk.pop() * stk.pop()) & TT256M1)
+
+
+def op_div(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    stk.append(0 if s1 == 0 else s0 // s1)
+
+
+def op_mod(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    stk.append(0 if s1 == 0 else s0 % s1)
+
+
+def op_sdiv(c, stk):
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(0 if s1 == 0 else (abs(s0) // abs(s1) *
+                                  (-1 if s0 * s1 < 0 else 1)) & TT256M1)
+
+
+def op_smod(c, stk):
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(0 if s1 == 0 else (abs(s0) % abs(s1) *
+                                  (-1 if s0 < 0 else 1)) & TT256M1)
+
+
+def op_addmod(c, stk):
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    stk.append((s0 + s1) % s2 if s2 else 0)
+
+
+def op_mulmod(c, stk):
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    stk.append((s0 * s1) % s2 if s2 else 0)
+
+
+def op_signextend(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    if s0 <= 31:
+        testbit = s0 * 8 + 7
+        if s1 & (1 << testbit):
+            stk.append(s1 | (TT256 - (1 << testbit)))
+        else:
+            stk.append(s1 & ((1 << testbit) - 1))
+    else:
+        stk.append(s1)
+
+
+def op_lt(c, stk):
+    stk.append(1 if stk.pop() < stk.pop() else 0)
+
+
+def op_gt(c, stk):
+    stk.append(1 if stk.pop() > stk.pop() else 0)
+
+
+def op_slt(c, stk):
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(1 if s0 < s1 else 0)
+
+
+def op_sgt(c, stk):
+    s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
+    stk.append(1 if s0 > s1 else 0)
+
+
+def op_eq(c, stk):
+    stk.append(1 if stk.pop() == stk.pop() else 0)
+
+
+def op_iszero(c, stk):
+    stk.append(0 if stk.pop() else 1)
+
+
+def op_and(c, stk):
+    stk.append(stk.pop() & stk.pop())
+
+
+def op_or(c, stk):
+    stk.append(stk.pop() | stk.pop())
+
+
+def op_xor(c, stk):
+    stk.append(stk.pop() ^ stk.pop())
+
+
+def op_not(c, stk):
+    stk.append(TT256M1 - stk.pop())
+
+
+def op_byte(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    if s0 >= 32:
+        stk.append(0)
+    else:
+        stk.append((s1 // 256 ** (31 - s0)) % 256)
+
+
+def op_sha3(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    c.gas -= opcodes.GSHA3WORD * (utils.ceil32(s1) // 32)
+    if c.gas < 0:
+        return vm_exception('OOG PAYING FOR SHA3')
+    if not mem_extend(c.memory, c, 'SHA3', s0, s1):
+        return vm_exception('OOG EXTENDING MEMORY')
+    data = bytearray_to_bytestr(c.memory[s0: s0 + s1])
+    stk.append(utils.big_endian_to_int(utils.sha3(data)))
+
+
+def op_address(c, stk):
+    stk.append(utils.coerce_to_int(c.msg.to))
+
+
+def op_origin(c, stk):
+    stk.append(utils.coerce_to_int(c.ext.tx_origin))
+
+
+def op_caller(c, stk):
+    stk.append(utils.coerce_to_int(c.msg.sender))
+
+
+def op_callvalue(c, stk):
+    stk.append(c.msg.value)
+
+
+def op_calldataload(c, stk):
+    stk.append(c.msg.data.extract32(stk.pop()))
+
+
+def op_calldatasize(c, stk):
+    stk.append(c.msg.data.size)
+
+
+def op_calldatacopy(c, stk):
+    mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, 'CALLDATACOPY', mstart, size):
+        return vm_exception('OOG EXTENDING MEMORY')
+    if not data_copy(c, size):
+        return vm_exception('OOG COPY DATA')
+    c.msg.data.extract_copy(c.memory, mstart, dstart, size)
+
+
+def op_codesize(c, stk):
+    stk.append(c.codelen)
+
+
+def op_codecopy(c, stk):
+    mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
+    mem = c.memory
+    if not mem_extend(mem, c, 'CODECOPY', mstart, size):
+        return vm_exception('OOG EXTENDING MEMORY')
+    if not data_copy(c, size):
+        return vm_exception('OOG COPY DATA')
+    copy_data(mem, mstart, memoryview(c.code)[dstart: dstart + size], size)
+
+
+def op_returndatacopy(c, stk):
+    mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, 'RETURNDATACOPY', mstart, size):
+        return vm_exception('OOG EXTENDING MEMORY')
+    if not data_copy(c, size):
+        return vm_exception('OOG COPY DATA')
+    if dstart + size > len(c.last_returned):
+        return vm_exception('RETURNDATACOPY out of range')
+    c.memory[mstart: mstart + size] = c.last_returned[dstart: dstart + size]
+
+
+def op_returndatasize(c, stk):
+    stk.append(len(c.last_returned))
+
+
+def op_gasprice(c, stk):
+    stk.append(c.ext.tx_gasprice)
+
+
+def op_blockhash(c, stk):
+    stk.append(utils.big_endian_to_int(c.ext.block_hash(stk.pop())))
+
+
+def op_coinbase(c, stk):
+    stk.append(utils.big_endian_to_int(c.ext.block_coinbase))
+
+
+def op_timestamp(c, stk):
+    stk.append(c.ext.block_timestamp)
+
+
+def op_number(c, stk):
+    stk.append(c.ext.block_number)
+
+
+def op_difficulty(c, stk):
+    stk.append(c.ext.block_difficulty)
+
+
+def op_gaslimit(c, stk):
+    stk.append(c.ext.block_gas_limit)
+
+
+def op_pop(c, stk):
+    stk.pop()
+
+
+def op_mload(c, stk):
+    s0 = stk.pop()
+    if not mem_extend(c.memory, c, 'MLOAD', s0, 32):
+        return vm_exception('OOG EXTENDING MEMORY')
+    stk.append(utils.bytes_to_int(c.memory[s0: s0 + 32]))
+
+
+def op_mstore(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, 'MSTORE', s0, 32):
+        return vm_exception('OOG EXTENDING MEMORY')
+    c.memory[s0: s0 + 32] = utils.encode_int32(s1)
+
+
+def op_mstore8(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, 'MSTORE8', s0, 1):
+        return vm_exception('OOG EXTENDING MEMORY')
+    c.memory[s0] = s1 % 256
+
+
+def op_sstore(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    msg, ext = c.msg, c.ext
+    if msg.static:
+        return vm_exception(
+            'Cannot SSTORE inside a static context')
+    if ext.get_storage_data(msg.to, s0):
+        gascost = opcodes.GSTORAGEMOD if s1 else opcodes.GSTORAGEKILL
+        refund = 0 if s1 else opcodes.GSTORAGEREFUND
+    else:
+        gascost = opcodes.GSTORAGEADD if s1 else opcodes.GSTORAGEMOD
+        refund = 0
+    if c.gas < gascost:
+        return vm_exception('OUT OF GAS')
+    c.gas -= gascost
+    if ext.tracer is not None and ext.tracer.on_sstore is not None:
+        ext.tracer.on_sstore(msg.to, s0, s1)
+    # adds neg gascost as a refund if below zero
+    ext.add_refund(refund)
+    ext.set_storage_data(msg.to, s0, s1)
+
+
+def op_jump(c, stk):
+    c.pc = pc = stk.pop()
+    if pc >= c.codelen or not (c.jumpdests[pc >> 3] & (1 << (pc & 7))):
+        return vm_exception('BAD JUMPDEST')
+
+
+def op_jumpi(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    if s1:
+        c.pc = s0
+        if s0 >= c.codelen or not (c.jumpdests[s0 >> 3] & (1 << (s0 & 7))):
+            return vm_exception('BAD JUMPDEST')
+
+
+def op_pc(c, stk):
+    stk.append(c.pc - 1)
+
+
+def op_msize(c, stk):
+    stk.append(len(c.memory))
+
+
+def op_gas(c, stk):
+    stk.append(c.gas)  # AFTER subtracting cost 1
+
+
+def op_noop(c, stk):
+    pass
+
+
+def mk_dup(n):
+    # DUPn (eg. DUP1: a b c -> a b c c, DUP3: a b c -> a b c a)
+    def op_dup(c, stk):
+        stk.append(stk[-n])
+    return op_dup
+
+
+def mk_swap(n):
+    # SWAPn (eg. SWAP1: a b c d -> a b d c, SWAP3: a b c d -> d b c a)
+    def op_swap(c, stk):
+        temp = stk[-n - 1]
+        stk[-n - 1] = stk[-1]
+        stk[-1] = temp
+    return op_swap
+
+
+def mk_log(depth):
+    """
+    0xa0 ... 0xa4, 32/64/96/128/160 + len(data) gas
+    a. Opcodes LOG0...LOG4 are added, takes 2-6 stack arguments
+            MEMSTART MEMSZ (TOPIC1) (TOPIC2) (TOPIC3) (TOPIC4)
+    b. Logs are kept track of during tx execution exactly the same way as suicides
+       (except as an ordered list, not a set).
+       Each log is in the form [address, [topic1, ... ], data] where:
+       * address is what the ADDRESS opcode would output
+       * data is mem[MEMSTART: MEMSTART + MEMSZ]
+       * topics are as provided by the opcode
+    c. The ordered list of logs in the transaction are expressed as [log0, log1, ..., logN].
+    """
+    def op_log(c, stk):
+        msg = c.msg
+        mstart, msz = stk.pop(), stk.pop()
+        topics = [stk.pop() for x in range(depth)]
+        c.gas -= msz * opcodes.GLOGBYTE
+        if msg.static:
+            return vm_exception('Cannot LOG inside a static context')
+        if not mem_extend(c.memory, c, 'LOG', mstart, msz):
+            return vm_exception('OOG EXTENDING MEMORY')
+        data = bytearray_to_bytestr(c.memory[mstart: mstart + msz])
+        c.ext.log(msg.to, topics, data)
+        log_log.trace('LOG', to=msg.to, topics=topics,
+                      data=list(map(utils.safe_ord, data)))
+    return op_log
+
+
+def op_return(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, 'RETURN', s0, s1):
+        return vm_exception('OOG EXTENDING MEMORY')
+    return peaceful_exit('RETURN', c.gas, c.memory[s0: s0 + s1])
+
+
+def op_revert(c, stk):
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(c.memory, c, 'REVERT', s0, s1):
+        return vm_exception('OOG EXTENDING MEMORY')
+    return revert(c.gas, c.memory[s0: s0 + s1])
+
+
+def mk_opcode_table(homestead, anti_dos, spurious_dragon, metropolis):
+    """builds the dispatch table for one fork configuration
+
+    :returns: a list of 256 entries, each either None for an invalid
+              opcode or a tuple (name, in_args, out_args, fee, handler)
+    """
+
+    def op_exp(c, stk):
+        base, exponent = stk.pop(), stk.pop()
+        # fee for exponent is dependent on its bytes
+        # calc n bytes to represent exponent
+        nbytes = len(utils.encode_int(exponent))
+        expfee = nbytes * opcodes.GEXPONENTBYTE
+        if spurious_dragon:
+            expfee += opcodes.EXP_SUPPLEMENTAL_GAS * nbytes
+        if c.gas < expfee:
+            c.gas = 0
+            return vm_exception('OOG EXPONENT')
+        c.gas -= expfee
+        stk.append(pow(base, exponent, TT256))
+
+    def op_balance(c, stk):
+        if anti_dos:
+            if not eat_gas(c, opcodes.BALANCE_SUPPLEMENTAL_GAS):
+                return vm_exception("OUT OF GAS")
+        addr = utils.coerce_addr_to_hex(stk.pop() % 2**160)
+        stk.append(c.ext.get_balance(addr))
+
+    def op_extcodesize(c, stk):
+        if anti_dos:
+            if not eat_gas(c, opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
+                return vm_exception("OUT OF GAS")
+        addr = utils.coerce_addr_to_hex(stk.pop() % 2**160)
+        stk.append(len(c.ext.get_code(addr) or b''))
+
+    def op_extcodecopy(c, stk):
+        if anti_dos:
+            if not eat_gas(c, opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
+                return vm_exception("OUT OF GAS")
+        addr = utils.coerce_addr_to_hex(stk.pop() % 2**160)
+        start, s2, size = stk.pop(), stk.pop(), stk.pop()
+        extcode = c.ext.get_code(addr) or b''
+        assert utils.is_string(extcode)
+        mem = c.memory
+        if not mem_extend(mem, c, 'EXTCODECOPY', start, size):
+            return vm_exception('OOG EXTENDING MEMORY')
+        if not data_copy(c, size):
+            return vm_exception('OOG COPY DATA')
+        copy_data(mem, start, memoryview(extcode)[s2: s2 + size], size)
+
+    def op_sload(c, stk):
+        if anti_dos:
+            if not eat_gas(c, opcodes.SLOAD_SUPPLEMENTAL_GAS):
+                return vm_exception("OUT OF GAS")
+        stk.append(c.ext.get_storage_data(c.msg.to, stk.pop()))
+
+    def op_create(c, stk):
+        msg, ext = c.msg, c.ext
+        value, mstart, msz = stk.pop(), stk.pop(), stk.pop()
+        if not mem_extend(c.memory, c, 'CREATE', mstart, msz):
+            return vm_exception('OOG EXTENDING MEMORY')
+        if msg.static:
+            return vm_exception('Cannot CREATE inside a static context')
+        if ext.get_balance(msg.to) >= value and msg.depth < MAX_DEPTH:
+            cd = CallData(c.memory, mstart, msz)
+            ingas = c.gas
+            if anti_dos:
+                ingas = all_but_1n(ingas, opcodes.CALL_CHILD_LIMIT_DENOM)
+            create_msg = Message(msg.to, b'', value, ingas, cd, msg.depth + 1)
+            o, gas, data = ext.create(create_msg)
+            if o:
+                stk.append(utils.coerce_to_int(data))
+                c.last_returned = bytearray(b'')
+            else:
+                stk.append(0)
+                c.last_returned = bytearray(data)
+            c.gas = c.gas - ingas + gas
+        else:
+            stk.append(0)
+            c.last_returned = bytearray(b'')
+
+    def mk_call(op):
+        def op_call(c, stk):
+            msg, ext, mem = c.msg, c.ext, c.memory
+            # Pull arguments from the stack
+            if op in ('CALL', 'CALLCODE'):
+                gas, to, value, meminstart, meminsz, memoutstart, memoutsz = \
+                    stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
+            else:
+                gas, to, meminstart, meminsz, memoutstart, memoutsz = \
+                    stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
+                value = 0
+            # Static context prohibition
+            if msg.static and value > 0 and op == 'CALL':
+                return vm_exception(
+                    'Cannot make a non-zero-value call inside a static context')
+            # Expand memory
+            if not mem_extend(mem, c, op, meminstart, meminsz) or \
+                    not mem_extend(mem, c, op, memoutstart, memoutsz):
+                return vm_exception('OOG EXTENDING MEMORY')
+            to = utils.int_to_addr(to)
+            # Extra gas costs based on various factors
+            extra_gas = 0
+            # Creating a new account
+            if op == 'CALL' and not ext.account_exists(to) and (
+                    value > 0 or not spurious_dragon):
+                extra_gas += opcodes.GCALLNEWACCOUNT
+            # Value transfer
+            if value > 0:
+                extra_gas += opcodes.GCALLVALUETRANSFER
+            # Cost increased from 40 to 700 in Tangerine Whistle
+            if anti_dos:
+                extra_gas += opcodes.CALL_SUPPLEMENTAL_GAS
+            # Compute child gas limit
+            if anti_dos:
+                if c.gas < extra_gas:
+                    return vm_exception('OUT OF GAS', needed=extra_gas)
+                gas = min(
+                    gas,
+                    all_but_1n(
+                        c.gas -
+                        extra_gas,
+                        opcodes.CALL_CHILD_LIMIT_DENOM))
+            else:
+                if c.gas < gas + extra_gas:
+                    return vm_exception('OUT OF GAS', needed=gas + extra_gas)
+            submsg_gas = gas + opcodes.GSTIPEND * (value > 0)
+            # Verify that there is sufficient balance and depth
+            if ext.get_balance(msg.to) < value or msg.depth >= MAX_DEPTH:
+                c.gas -= (gas + extra_gas - submsg_gas)
+                stk.append(0)
+                c.last_returned = bytearray(b'')
+            else:
+                # Subtract gas from parent
+                c.gas -= (gas + extra_gas)
+                assert c.gas >= 0
+                cd = CallData(mem, meminstart, meminsz)
+                # Generate the message
+                if op == 'CALL':
+                    call_msg = Message(msg.to, to, value, submsg_gas, cd,
+                                       msg.depth + 1, code_address=to, static=msg.static)
+                elif homestead and op == 'DELEGATECALL':
+                    call_msg = Message(msg.sender, msg.to, msg.value, submsg_gas, cd,
+                                       msg.depth + 1, code_address=to, transfers_value=False, static=msg.static)
+                elif metropolis and op == 'STATICCALL':
+                    call_msg = Message(msg.to, to, value, submsg_gas, cd,
+                                       msg.depth + 1, code_address=to, static=True)
+                elif op in ('DELEGATECALL', 'STATICCALL'):
+                    return vm_exception('OPCODE %s INACTIVE' % op)
+                elif op == 'CALLCODE':
+                    call_msg = Message(msg.to, msg.to, value, submsg_gas, cd,
+                                       msg.depth + 1, code_address=to, static=msg.static)
+                else:
+                    raise Exception("Lolwut")
+                # Get result
+                result, gas, data = ext.msg(call_msg)
+                if result == 0:
+                    stk.append(0)
+                else:
+                    stk.append(1)
+                # Set output memory
+                n = min(len(data), memoutsz)
+                mem[memoutstart: memoutstart + n] = data[:n]
+                c.gas += gas
+                c.last_returned = bytearray(data)
+        return op_call
+
+    def op_suicide(c, stk):
+        msg, ext = c.msg, c.ext
+        if msg.static:
+            return vm_exception('Cannot SUICIDE inside a static context')
+        to = utils.encode_int(stk.pop())
+        to = ((b'\x00' * (32 - len(to))) + to)[12:]
+        xfer = ext.get_balance(msg.to)
+        if anti_dos:
+            extra_gas = opcodes.SUICIDE_SUPPLEMENTAL_GAS + \
+                (not ext.account_exists(to)) * (xfer >
+                                                0 or not spurious_dragon) * opcodes.GCALLNEWACCOUNT
+            if not eat_gas(c, extra_gas):
+                return vm_exception("OUT OF GAS")
+        ext.set_balance(to, ext.get_balance(to) + xfer)
+        ext.set_balance(msg.to, 0)
+        ext.add_suicide(msg.to)
+        log_msg.debug(
+            'SUICIDING',
+            addr=utils.checksum_encode(
+                msg.to),
+            to=utils.checksum_encode(to),
+            xferring=xfer)
+        return peaceful_exit('SUICIDED', c.gas, [])
+
+    handlers = {
+        'STOP': op_stop, 'ADD': op_add, 'SUB': op_sub, 'MUL': op_mul,
+        'DIV': op_div, 'MOD': op_mod, 'SDIV': op_sdiv, 'SMOD': op_smod,
+        'ADDMOD': op_addmod, 'MULMOD': op_mulmod, 'EXP': op_exp,
+        'SIGNEXTEND': op_signextend,
+        'LT': op_lt, 'GT': op_gt, 'SLT': op_slt, 'SGT': op_sgt,
+        'EQ': op_eq, 'ISZERO': op_iszero, 'AND': op_and, 'OR': op_or,
+        'XOR': op_xor, 'NOT': op_not, 'BYTE': op_byte,
+        'SHA3': op_sha3, 'ADDRESS': op_address, 'BALANCE': op_balance,
+        'ORIGIN': op_origin, 'CALLER': op_caller,
+        'CALLVALUE': op_callvalue, 'CALLDATALOAD': op_calldataload,
+        'CALLDATASIZE': op_calldatasize, 'CALLDATACOPY': op_calldatacopy,
+        'CODESIZE': op_codesize, 'CODECOPY': op_codecopy,
+        'RETURNDATACOPY': op_returndatacopy,
+        'RETURNDATASIZE': op_returndatasize, 'GASPRICE': op_gasprice,
+        'EXTCODESIZE': op_extcodesize, 'EXTCODECOPY': op_extcodecopy,
+        'BLOCKHASH': op_blockhash, 'COINBASE': op_coinbase,
+        'TIMESTAMP': op_timestamp, 'NUMBER': op_number,
+        'DIFFICULTY': op_difficulty, 'GASLIMIT': op_gaslimit,
+        'POP': op_pop, 'MLOAD': op_mload, 'MSTORE': op_mstore,
+        'MSTORE8': op_mstore8, 'SLOAD': op_sload, 'SSTORE': op_sstore,
+        'JUMP': op_jump, 'JUMPI': op_jumpi, 'PC': op_pc,
+        'MSIZE': op_msize, 'GAS': op_gas, 'CREATE': op_create,
+        'CALL': mk_call('CALL'), 'CALLCODE': mk_call('CALLCODE'),
+        'DELEGATECALL': mk_call('DELEGATECALL'),
+        'STATICCALL': mk_call('STATICCALL'),
+        'RETURN': op_return, 'REVERT': op_revert, 'SUICIDE': op_suicide,
+    }
+    for i in range(1, 17):
+        handlers['DUP' + str(i)] = mk_dup(i)
+        handlers['SWAP' + str(i)] = mk_swap(i)
+    for i in range(5):
+        handlers['LOG' + str(i)] = mk_log(i)
+
+    table = [None] * 256
+    for opcode, (op, in_args, out_args, fee) in opcodes.opcodes.items():
+        if opcode in opcodes.opcodesMetropolis and not metropolis:
+            continue
+        # PUSHes are handled inline by the interpreter loop; JUMPDEST and
+        # the unused CALLBLACKBOX do nothing
+        table[opcode] = (op, in_args, out_args, fee,
+                         handlers.get(op, op_noop))
+    return table
+
+
+_opcode_tables = {}
+
+
+# The fork flags that mk_opcode_table depends on
+def fork_flags(ext):
+    return (ext.post_homestead_hardfork(), ext.post_anti_dos_hardfork(),
+            ext.post_spurious_dragon_hardfork(),
+            ext.post_metropolis_hardfork())
+
+
+def get_opcode_table(ext, forks=None):
+    if forks is None:
+        forks = fork_flags(ext)
+    if forks not in _opcode_tables:
+        _opcode_tables[forks] = mk_opcode_table(*forks)
+    return _opcode_tables[forks]
+
+
 # Main function
 def vm_execute(ext, msg, code):
     # precompute trace flag
@@ -249,13 +841,15 @@ def vm_execute(ext, msg, code):
     trace_vm = log_vm_op.is_active('trace')
 
     # Initialize stack, memory, program counter, etc
-    compustate = Compustate(gas=msg.gas)
+    analysis = code_cache.get(code)
+    compustate = Compustate(gas=msg.gas, msg=msg, ext=ext, code=code,
+                            codelen=len(code), jumpdests=analysis.jumpdests)
     stk = compustate.stack
-    mem = compustate.memory
-
-    # Compute
-    jumpdest_mask, pushcache = preprocess_code(code)
+    pushcache = analysis.pushcache
+    codebytes = bytearray(code)
     codelen = len(code)
+    table = get_opcode_table(ext)
+    on_step = ext.tracer.on_step if ext.tracer is not None else None
 
     # For tracing purposes
     op = None
@@ -263,16 +857,17 @@ def vm_execute(ext, msg, code):
     steps = 0
     while compustate.pc < codelen:
 
-        opcode = safe_ord(code[compustate.pc])
+        opcode = codebytes[compustate.pc]
+        entry = table[opcode]
+
+        if on_step is not None:
+            on_step(compustate.pc, opcode, compustate.gas, stk)
 
         # Invalid operation
-        if opcode not in opcodes.opcodes:
+        if entry is None:
             return vm_exception('INVALID OP', opcode=opcode)
 
-        if opcode in opcodes.opcodesMetropolis and not ext.post_metropolis_hardfork():
-            return vm_exception('INVALID OP (not yet enabled)', opcode=opcode)
-
-        op, in_args, out_args, fee = opcodes.opcodes[opcode]
+        op, in_args, out_args, fee, handler = entry
 
         # Apply operation
         if trace_vm:
@@ -322,455 +917,26 @@ def vm_execute(ext, msg, code):
             return vm_exception('OUT OF GAS')
 
         # empty stack error
-        if in_args > len(compustate.stack):
+        if in_args > len(stk):
             return vm_exception('INSUFFICIENT STACK',
                                 op=op, needed=to_string(in_args),
-                                available=to_string(len(compustate.stack)))
+                                available=to_string(len(stk)))
 
         # overfull stack error
-        if len(compustate.stack) - in_args + out_args > 1024:
+        if len(stk) - in_args + out_args > 1024:
             return vm_exception('STACK SIZE LIMIT EXCEEDED',
                                 op=op,
-                                pre_height=to_string(len(compustate.stack)))
+                                pre_height=to_string(len(stk)))
 
-        # Valid operations
-        # Pushes first because they are very frequent
+        # Pushes are inline because they are very frequent
         if 0x60 <= opcode <= 0x7f:
             stk.append(pushcache[compustate.pc - 1])
             # Move 1 byte forward for 0x60, up to 32 bytes for 0x7f
             compustate.pc += opcode - 0x5f
-        # Arithmetic
-        elif opcode < 0x10:
-            if op == 'STOP':
-                return peaceful_exit('STOP', compustate.gas, [])
-            elif op == 'ADD':
-                stk.append((stk.pop() + stk.pop()) & TT256M1)
-            elif op == 'SUB':
-                stk.append((stk.pop() - stk.pop()) & TT256M1)
-            elif op == 'MUL':
-                stk.append((stk.pop() * stk.pop()) & TT256M1)
-            elif op == 'DIV':
-                s0, s1 = stk.pop(), stk.pop()
-                stk.append(0 if s1 == 0 else s0 // s1)
-            elif op == 'MOD':
-                s0, s1 = stk.pop(), stk.pop()
-                stk.append(0 if s1 == 0 else s0 % s1)
-            elif op == 'SDIV':
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(0 if s1 == 0 else (abs(s0) // abs(s1) *
-                                              (-1 if s0 * s1 < 0 else 1)) & TT256M1)
-            elif op == 'SMOD':
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(0 if s1 == 0 else (abs(s0) % abs(s1) *
-                                              (-1 if s0 < 0 else 1)) & TT256M1)
-            elif op == 'ADDMOD':
-                s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-                stk.append((s0 + s1) % s2 if s2 else 0)
-            elif op == 'MULMOD':
-                s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-                stk.append((s0 * s1) % s2 if s2 else 0)
-            elif op == 'EXP':
-                base, exponent = stk.pop(), stk.pop()
-                # fee for exponent is dependent on its bytes
-                # calc n bytes to represent exponent
-                nbytes = len(utils.encode_int(exponent))
-                expfee = nbytes * opcodes.GEXPONENTBYTE
-                if ext.post_spurious_dragon_hardfork():
-                    expfee += opcodes.EXP_SUPPLEMENTAL_GAS * nbytes
-                if compustate.gas < expfee:
-                    compustate.gas = 0
-                    return vm_exception('OOG EXPONENT')
-                compustate.gas -= expfee
-                stk.append(pow(base, exponent, TT256))
-            elif op == 'SIGNEXTEND':
-                s0, s1 = stk.pop(), stk.pop()
-                if s0 <= 31:
-                    testbit = s0 * 8 + 7
-                    if s1 & (1 << testbit):
-                        stk.append(s1 | (TT256 - (1 << testbit)))
-                    else:
-                        stk.append(s1 & ((1 << testbit) - 1))
-                else:
-                    stk.append(s1)
-        # Comparisons
-        elif opcode < 0x20:
-            if op == 'LT':
-                stk.append(1 if stk.pop() < stk.pop() else 0)
-            elif op == 'GT':
-                stk.append(1 if stk.pop() > stk.pop() else 0)
-            elif op == 'SLT':
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(1 if s0 < s1 else 0)
-            elif op == 'SGT':
-                s0, s1 = utils.to_signed(stk.pop()), utils.to_signed(stk.pop())
-                stk.append(1 if s0 > s1 else 0)
-            elif op == 'EQ':
-                stk.append(1 if stk.pop() == stk.pop() else 0)
-            elif op == 'ISZERO':
-                stk.append(0 if stk.pop() else 1)
-            elif op == 'AND':
-                stk.append(stk.pop() & stk.pop())
-            elif op == 'OR':
-                stk.append(stk.pop() | stk.pop())
-            elif op == 'XOR':
-                stk.append(stk.pop() ^ stk.pop())
-            elif op == 'NOT':
-                stk.append(TT256M1 - stk.pop())
-            elif op == 'BYTE':
-                s0, s1 = stk.pop(), stk.pop()
-                if s0 >= 32:
-                    stk.append(0)
-                else:
-                    stk.append((s1 // 256 ** (31 - s0)) % 256)
-        # SHA3 and environment info
-        elif opcode < 0x40:
-            if op == 'SHA3':
-                s0, s1 = stk.pop(), stk.pop()
-                compustate.gas -= opcodes.GSHA3WORD * (utils.ceil32(s1) // 32)
-                if compustate.gas < 0:
-                    return vm_exception('OOG PAYING FOR SHA3')
-                if not mem_extend(mem, compustate, op, s0, s1):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                data = bytearray_to_bytestr(mem[s0: s0 + s1])
-                stk.append(utils.big_endian_to_int(utils.sha3(data)))
-            elif op == 'ADDRESS':
-                stk.append(utils.coerce_to_int(msg.to))
-            elif op == 'BALANCE':
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate,
-                                   opcodes.BALANCE_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                addr = utils.coerce_addr_to_hex(stk.pop() % 2**160)
-                stk.append(ext.get_balance(addr))
-            elif op == 'ORIGIN':
-                stk.append(utils.coerce_to_int(ext.tx_origin))
-            elif op == 'CALLER':
-                stk.append(utils.coerce_to_int(msg.sender))
-            elif op == 'CALLVALUE':
-                stk.append(msg.value)
-            elif op == 'CALLDATALOAD':
-                stk.append(msg.data.extract32(stk.pop()))
-            elif op == 'CALLDATASIZE':
-                stk.append(msg.data.size)
-            elif op == 'CALLDATACOPY':
-                mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, mstart, size):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                if not data_copy(compustate, size):
-                    return vm_exception('OOG COPY DATA')
-                msg.data.extract_copy(mem, mstart, dstart, size)
-            elif op == 'CODESIZE':
-                stk.append(codelen)
-            elif op == 'CODECOPY':
-                mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, mstart, size):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                if not data_copy(compustate, size):
-                    return vm_exception('OOG COPY DATA')
-                for i in range(size):
-                    if dstart + i < codelen:
-                        mem[mstart + i] = safe_ord(code[dstart + i])
-                    else:
-                        mem[mstart + i] = 0
-            elif op == 'RETURNDATACOPY':
-                mstart, dstart, size = stk.pop(), stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, mstart, size):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                if not data_copy(compustate, size):
-                    return vm_exception('OOG COPY DATA')
-                if dstart + size > len(compustate.last_returned):
-                    return vm_exception('RETURNDATACOPY out of range')
-                mem[mstart: mstart + size] = compustate.last_returned[dstart: dstart + size]
-            elif op == 'RETURNDATASIZE':
-                stk.append(len(compustate.last_returned))
-            elif op == 'GASPRICE':
-                stk.append(ext.tx_gasprice)
-            elif op == 'EXTCODESIZE':
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate,
-                                   opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                addr = utils.coerce_addr_to_hex(stk.pop() % 2**160)
-                stk.append(len(ext.get_code(addr) or b''))
-            elif op == 'EXTCODECOPY':
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate,
-                                   opcodes.EXTCODELOAD_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                addr = utils.coerce_addr_to_hex(stk.pop() % 2**160)
-                start, s2, size = stk.pop(), stk.pop(), stk.pop()
-                extcode = ext.get_code(addr) or b''
-                assert utils.is_string(extcode)
-                if not mem_extend(mem, compustate, op, start, size):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                if not data_copy(compustate, size):
-                    return vm_exception('OOG COPY DATA')
-                for i in range(size):
-                    if s2 + i < len(extcode):
-                        mem[start + i] = safe_ord(extcode[s2 + i])
-                    else:
-                        mem[start + i] = 0
-        # Block info
-        elif opcode < 0x50:
-            if op == 'BLOCKHASH':
-                if ext.post_constantinople_hardfork() and False:
-                    bh_addr = ext.blockhash_store
-                    stk.append(ext.get_storage_data(bh_addr, stk.pop()))
-                else:
-                    stk.append(
-                        utils.big_endian_to_int(
-                            ext.block_hash(
-                                stk.pop())))
-            elif op == 'COINBASE':
-                stk.append(utils.big_endian_to_int(ext.block_coinbase))
-            elif op == 'TIMESTAMP':
-                stk.append(ext.block_timestamp)
-            elif op == 'NUMBER':
-                stk.append(ext.block_number)
-            elif op == 'DIFFICULTY':
-                stk.append(ext.block_difficulty)
-            elif op == 'GASLIMIT':
-                stk.append(ext.block_gas_limit)
-        # VM state manipulations
-        elif opcode < 0x60:
-            if op == 'POP':
-                stk.pop()
-            elif op == 'MLOAD':
-                s0 = stk.pop()
-                if not mem_extend(mem, compustate, op, s0, 32):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                stk.append(utils.bytes_to_int(mem[s0: s0 + 32]))
-            elif op == 'MSTORE':
-                s0, s1 = stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, s0, 32):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                mem[s0: s0 + 32] = utils.encode_int32(s1)
-            elif op == 'MSTORE8':
-                s0, s1 = stk.pop(), stk.pop()
-                if not mem_extend(mem, compustate, op, s0, 1):
-                    return vm_exception('OOG EXTENDING MEMORY')
-                mem[s0] = s1 % 256
-            elif op == 'SLOAD':
-                if ext.post_anti_dos_hardfork():
-                    if not eat_gas(compustate, opcodes.SLOAD_SUPPLEMENTAL_GAS):
-                        return vm_exception("OUT OF GAS")
-                stk.append(ext.get_storage_data(msg.to, stk.pop()))
-            elif op == 'SSTORE':
-                s0, s1 = stk.pop(), stk.pop()
-                if msg.static:
-                    return vm_exception(
-                        'Cannot SSTORE inside a static context')
-                if ext.get_storage_data(msg.to, s0):
-                    gascost = opcodes.GSTORAGEMOD if s1 else opcodes.GSTORAGEKILL
-                    refund = 0 if s1 else opcodes.GSTORAGEREFUND
-                else:
-                    gascost = opcodes.GSTORAGEADD if s1 else opcodes.GSTORAGEMOD
-                    refund = 0
-                if compustate.gas < gascost:
-                    return vm_exception('OUT OF GAS')
-                compustate.gas -= gascost
-                # adds neg gascost as a refund if below zero
-                ext.add_refund(refund)
-                ext.set_storage_data(msg.to, s0, s1)
-            elif op == 'JUMP':
-                compustate.pc = stk.pop()
-                if compustate.pc >= codelen or not (
-                        (1 << compustate.pc) & jumpdest_mask):
-                    return vm_exception('BAD JUMPDEST')
-            elif op == 'JUMPI':
-                s0, s1 = stk.pop(), stk.pop()
-                if s1:
-                    compustate.pc = s0
-                    if compustate.pc >= codelen or not (
-                            (1 << compustate.pc) & jumpdest_mask):
-                        return vm_exception('BAD JUMPDEST')
-            elif op == 'PC':
-                stk.append(compustate.pc - 1)
-            elif op == 'MSIZE':
-                stk.append(len(mem))
-            elif op == 'GAS':
-                stk.append(compustate.gas)  # AFTER subtracting cost 1
-        # DUPn (eg. DUP1: a b c -> a b c c, DUP3: a b c -> a b c a)
-        elif op[:3] == 'DUP':
-            # 0x7f - opcode is a negative number, -1 for 0x80 ... -16 for 0x8f
-            stk.append(stk[0x7f - opcode])
-        # SWAPn (eg. SWAP1: a b c d -> a b d c, SWAP3: a b c d -> d b c a)
-        elif op[:4] == 'SWAP':
-            # 0x8e - opcode is a negative number, -2 for 0x90 ... -17 for 0x9f
-            temp = stk[0x8e - opcode]
-            stk[0x8e - opcode] = stk[-1]
-            stk[-1] = temp
-        # Logs (aka "events")
-        elif op[:3] == 'LOG':
-            """
-            0xa0 ... 0xa4, 32/64/96/128/160 + len(data) gas
-            a. Opcodes LOG0...LOG4 are added, takes 2-6 stack arguments
-                    MEMSTART MEMSZ (TOPIC1) (TOPIC2) (TOPIC3) (TOPIC4)
-            b. Logs are kept track of during tx execution exactly the same way as suicides
-               (except as an ordered list, not a set).
-               Each log is in the form [address, [topic1, ... ], data] where:
-               * address is what the ADDRESS opcode would output
-               * data is mem[MEMSTART: MEMSTART + MEMSZ]
-               * topics are as provided by the opcode
-            c. The ordered list of logs in the transaction are expressed as [log0, log1, ..., logN].
-            """
-            depth = int(op[3:])
-            mstart, msz = stk.pop(), stk.pop()
-            topics = [stk.pop() for x in range(depth)]
-            compustate.gas -= msz * opcodes.GLOGBYTE
-            if msg.static:
-                return vm_exception('Cannot LOG inside a static context')
-            if not mem_extend(mem, compustate, op, mstart, msz):
-                return vm_exception('OOG EXTENDING MEMORY')
-            data = bytearray_to_bytestr(mem[mstart: mstart + msz])
-            ext.log(msg.to, topics, data)
-            log_log.trace('LOG', to=msg.to, topics=topics,
-                          data=list(map(utils.safe_ord, data)))
-            # print('LOG', msg.to, topics, list(map(ord, data)))
-        # Create a new contract
-        elif op == 'CREATE':
-            value, mstart, msz = stk.pop(), stk.pop(), stk.pop()
-            if not mem_extend(mem, compustate, op, mstart, msz):
-                return vm_exception('OOG EXTENDING MEMORY')
-            if msg.static:
-                return vm_exception('Cannot CREATE inside a static context')
-            if ext.get_balance(msg.to) >= value and msg.depth < MAX_DEPTH:
-                cd = CallData(mem, mstart, msz)
-                ingas = compustate.gas
-                if ext.post_anti_dos_hardfork():
-                    ingas = all_but_1n(ingas, opcodes.CALL_CHILD_LIMIT_DENOM)
-                create_msg = Message(msg.to, b'', value, ingas, cd, msg.depth + 1)
-                o, gas, data = ext.create(create_msg)
-                if o:
-                    stk.append(utils.coerce_to_int(data))
-                    compustate.last_returned = bytearray(b'')
-                else:
-                    stk.append(0)
-                    compustate.last_returned = bytearray(data)
-                compustate.gas = compustate.gas - ingas + gas
-            else:
-                stk.append(0)
-                compustate.last_returned = bytearray(b'')
-        # Calls
-        elif op in ('CALL', 'CALLCODE', 'DELEGATECALL', 'STATICCALL'):
-            # Pull arguments from the stack
-            if op in ('CALL', 'CALLCODE'):
-                gas, to, value, meminstart, meminsz, memoutstart, memoutsz = \
-                    stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
-            else:
-                gas, to, meminstart, meminsz, memoutstart, memoutsz = \
-                    stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
-                value = 0
-            # Static context prohibition
-            if msg.static and value > 0 and op == 'CALL':
-                return vm_exception(
-                    'Cannot make a non-zero-value call inside a static context')
-            # Expand memory
-            if not mem_extend(mem, compustate, op, meminstart, meminsz) or \
-                    not mem_extend(mem, compustate, op, memoutstart, memoutsz):
-                return vm_exception('OOG EXTENDING MEMORY')
-            to = utils.int_to_addr(to)
-            # Extra gas costs based on various factors
-            extra_gas = 0
-            # Creating a new account
-            if op == 'CALL' and not ext.account_exists(to) and (
-                    value > 0 or not ext.post_spurious_dragon_hardfork()):
-                extra_gas += opcodes.GCALLNEWACCOUNT
-            # Value transfer
-            if value > 0:
-                extra_gas += opcodes.GCALLVALUETRANSFER
-            # Cost increased from 40 to 700 in Tangerine Whistle
-            if ext.post_anti_dos_hardfork():
-                extra_gas += opcodes.CALL_SUPPLEMENTAL_GAS
-            # Compute child gas limit
-            if ext.post_anti_dos_hardfork():
-                if compustate.gas < extra_gas:
-                    return vm_exception('OUT OF GAS', needed=extra_gas)
-                gas = min(
-                    gas,
-                    all_but_1n(
-                        compustate.gas -
-                        extra_gas,
-                        opcodes.CALL_CHILD_LIMIT_DENOM))
-            else:
-                if compustate.gas < gas + extra_gas:
-                    return vm_exception('OUT OF GAS', needed=gas + extra_gas)
-            submsg_gas = gas + opcodes.GSTIPEND * (value > 0)
-            # Verify that there is sufficient balance and depth
-            if ext.get_balance(msg.to) < value or msg.depth >= MAX_DEPTH:
-                compustate.gas -= (gas + extra_gas - submsg_gas)
-                stk.append(0)
-                compustate.last_returned = bytearray(b'')
-            else:
-                # Subtract gas from parent
-                compustate.gas -= (gas + extra_gas)
-                assert compustate.gas >= 0
-                cd = CallData(mem, meminstart, meminsz)
-                # Generate the message
-                if op == 'CALL':
-                    call_msg = Message(msg.to, to, value, submsg_gas, cd,
-                                       msg.depth + 1, code_address=to, static=msg.static)
-                elif ext.post_homestead_hardfork() and op == 'DELEGATECALL':
-                    call_msg = Message(msg.sender, msg.to, msg.value, submsg_gas, cd,
-                                       msg.depth + 1, code_address=to, transfers_value=False, static=msg.static)
-                elif ext.post_metropolis_hardfork() and op == 'STATICCALL':
-                    call_msg = Message(msg.to, to, value, submsg_gas, cd,
-                                       msg.depth + 1, code_address=to, static=True)
-                elif op in ('DELEGATECALL', 'STATICCALL'):
-                    return vm_exception('OPCODE %s INACTIVE' % op)
-                elif op == 'CALLCODE':
-                    call_msg = Message(msg.to, msg.to, value, submsg_gas, cd,
-                                       msg.depth + 1, code_address=to, static=msg.static)
-                else:
-                    raise Exception("Lolwut")
-                # Get result
-                result, gas, data = ext.msg(call_msg)
-                if result == 0:
-                    stk.append(0)
-                else:
-                    stk.append(1)
-                # Set output memory
-                for i in range(min(len(data), memoutsz)):
-                    mem[memoutstart + i] = data[i]
-                compustate.gas += gas
-                compustate.last_returned = bytearray(data)
-        # Return opcode
-        elif op == 'RETURN':
-            s0, s1 = stk.pop(), stk.pop()
-            if not mem_extend(mem, compustate, op, s0, s1):
-                return vm_exception('OOG EXTENDING MEMORY')
-            return peaceful_exit('RETURN', compustate.gas, mem[s0: s0 + s1])
-        # Revert opcode (Metropolis)
-        elif op == 'REVERT':
-            if not ext.post_metropolis_hardfork():
-                return vm_exception('Opcode not yet enabled')
-            s0, s1 = stk.pop(), stk.pop()
-            if not mem_extend(mem, compustate, op, s0, s1):
-                return vm_exception('OOG EXTENDING MEMORY')
-            return revert(compustate.gas, mem[s0: s0 + s1])
-        # SUICIDE opcode (also called SELFDESTRUCT)
-        elif op == 'SUICIDE':
-            if msg.static:
-                return vm_exception('Cannot SUICIDE inside a static context')
-            to = utils.encode_int(stk.pop())
-            to = ((b'\x00' * (32 - len(to))) + to)[12:]
-            xfer = ext.get_balance(msg.to)
-            if ext.post_anti_dos_hardfork():
-                extra_gas = opcodes.SUICIDE_SUPPLEMENTAL_GAS + \
-                    (not ext.account_exists(to)) * (xfer >
-                                                    0 or not ext.post_spurious_dragon_hardfork()) * opcodes.GCALLNEWACCOUNT
-                if not eat_gas(compustate, extra_gas):
-                    return vm_exception("OUT OF GAS")
-            ext.set_balance(to, ext.get_balance(to) + xfer)
-            ext.set_balance(msg.to, 0)
-            ext.add_suicide(msg.to)
-            log_msg.debug(
-                'SUICIDING',
-                addr=utils.checksum_encode(
-                    msg.to),
-                to=utils.checksum_encode(to),
-                xferring=xfer)
-            return peaceful_exit('SUICIDED', compustate.gas, [])
+        else:
+            res = handler(compustate, stk)
+            if res is not None:
+                return res
 
         if trace_vm:
             vm_trace(ext, msg, compustate, opcode, pushcache)
@@ -801,6 +967,7 @@ class VmExtBase():
         self.block_difficulty = 0
         self.block_gas_limit = 0
         self.log = lambda addr, topics, data: 0
+        self.tracer = None
         self.tx_origin = b'0' * 40
         self.tx_gasprice = 0
         self.create = lambda msg: 0, 0, 0